@@ -9,7 +9,7 @@ from Utils.config import db
 
 def clean_up_table(table, pk):
     # empty users
-    rows = db.select(table, [pk], fetchone=False)
+    rows = db.select(table, [pk], stream=True)
     for _id in rows:
         db.delete_entry(table, pk, _id[pk])
 
@@ -1,9 +1,20 @@
 import datetime
+import json
+import threading
 import time
 import unittest
 
-from Utils.config import db
-from Utils.util_basic import create_workout, get_last_sunday
+from Utils import migrations
+from Utils.async_db import AsyncDatabase
+from Utils.config import LEADER_BOARD_CACHE, db
+from Utils.db import Database, generate_connection_string
+from Utils.db_pool import PoolTimeout
+from Utils.instrumentation import QueryStats
+from Utils.leader_board_cache import LeaderBoardCache
+from Utils.result_cache import ResultCache
+from Utils.slow_queries import SlowQueryLog
+from Utils.util_basic import (build_graph_data, create_workout, current_week_start, format_leader_arr,
+                              generate_leader_board, get_last_sunday, leader_board_window)
 
 
 def create_user(user_name):
@@ -23,7 +34,7 @@ def create_user(user_name):
 
 def clean_up_table(table, pk,):
     # empty users
-    rows = db.select(table, [pk], fetchone=False)
+    rows = db.select(table, [pk], stream=True)
     for _id in rows:
         db.delete_entry(table, pk, _id[pk])
 
@@ -64,6 +75,27 @@ class TestAutoDB(unittest.TestCase):
         # assert empty
         self.assertEqual([], db.select('users', ['ALL'], fetchone=False))
 
+    def test_insert_many(self):
+        """
+        test multi-row insert functionality
+        :return:
+        """
+        rows = [['many1', 'a', 'b', '123', '1 east green', 1],
+                ['many2', 'c', 'd', '123', '1 east green', 2],
+                ['many3', 'e', 'f', '123', '1 east green', 3]]
+        ids = db.insert_many('users', ['username', 'first', 'last', 'password', 'address', 'num_seats'], rows,
+                             returning='user_id')
+
+        # one id per row, in insert order
+        self.assertEqual(3, len(ids))
+        self.assertEqual('many2', db.select('users', ['username'], ['user_id'], [ids[1]])['username'])
+
+        # nothing to insert
+        self.assertEqual([], db.insert_many('users', ['username'], [], returning='user_id'))
+
+        clean_up_table('users', 'user_id')
+        self.assertEqual([], db.select('users', ['ALL'], fetchone=False))
+
     def test_select(self):
         """
         tests select functionality
@@ -147,6 +179,71 @@ class TestAutoDB(unittest.TestCase):
         rows = db.select(table, ['user_id'], fetchone=False)
         self.assertEqual([], rows, 'not all deleted!')
 
+    def test_update_many(self):
+        """
+        test set-based update functionality
+        :return:
+        """
+        user_id = create_user('bulk_user')
+        create_workout(user_id, db, [2000, 2000, 2000], [7, 7, 7], [0, 0, 0], True)
+
+        pieces = db.select('erg', ['erg_id'], order_by=['erg_id'], fetchone=False)
+
+        # new times for all three pieces in one statement; strings are cast to the column types
+        db.update_many('erg', 'erg_id', ['minutes', 'seconds'],
+                       [(pieces[0]['erg_id'], 6, 58.5), (pieces[1]['erg_id'], '7', '1.2'),
+                        (pieces[2]['erg_id'], 6, 59)])
+
+        rows = db.select('erg', ['minutes', 'seconds'], order_by=['erg_id'], fetchone=False)
+        self.assertEqual([(6, 58.5), (7, 1.2), (6, 59)], [(row['minutes'], row['seconds']) for row in rows])
+
+        clean_up_all()
+
+    def test_select_stream(self):
+        """
+        test that streamed selects yield the same rows as fetchall
+        :return:
+        """
+        for i in range(5):
+            create_user('stream{}'.format(i))
+
+        rows = db.select('users', ['username'], order_by=['username'], stream=True, itersize=2)
+
+        # a generator, not a list
+        self.assertFalse(isinstance(rows, list))
+        self.assertEqual(db.select('users', ['username'], order_by=['username'], fetchone=False), list(rows))
+
+        clean_up_table('users', 'user_id')
+
+    def test_row_formats(self):
+        """
+        test that every row format holds the same values
+        :return:
+        """
+        for i in range(3):
+            create_user('format{}'.format(i))
+
+        cols = ['username', 'num_seats']
+        rows = db.select('users', cols, order_by=['username'], fetchone=False)
+        names = [row['username'] for row in rows]
+
+        self.assertEqual([(row['username'], row['num_seats']) for row in rows],
+                         db.select('users', cols, order_by=['username'], fetchone=False, row_format='tuple'))
+
+        records = db.select('users', cols, order_by=['username'], fetchone=False, row_format='record')
+        self.assertEqual(names, [record.username for record in records])
+
+        columns = db.select('users', cols, order_by=['username'], fetchone=False, row_format='columns')
+        self.assertEqual({'username': names, 'num_seats': [3, 3, 3]}, columns)
+
+        arrays = db.select('users', cols, order_by=['username'], fetchone=False, row_format='numpy')
+        self.assertEqual(9, arrays['num_seats'].sum())
+
+        with self.assertRaises(ValueError):
+            db.select('users', cols, stream=True, row_format='numpy')
+
+        clean_up_table('users', 'user_id')
+
     def test_update(self):
         """
         test update functionality
@@ -171,6 +268,453 @@ class TestAutoDB(unittest.TestCase):
         self.assertEqual([], db.select('users', ['ALL'], fetchone=False))
 
 
+class TestConnectionPool(unittest.TestCase):
+    """
+    test the pooled mode of the database object
+    """
+
+    def test_pooled_queries(self):
+        pooled_db = Database(True, pool_config={'min_size': 1, 'max_size': 2, 'timeout': 5})
+        self.addCleanup(pooled_db.close)
+
+        user_id = create_user('pool_user')
+
+        results = []
+
+        def run_select():
+            results.append(pooled_db.select('users', ['username'], ['user_id'], [user_id]))
+
+        threads = [threading.Thread(target=run_select) for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # every thread saw the committed user and the pool never grew past its max
+        self.assertEqual(6, len(results))
+        self.assertTrue(all(res['username'] == 'pool_user' for res in results))
+
+        stats = pooled_db.pool.stats()
+        self.assertLessEqual(stats['open'], 2)
+        self.assertEqual(stats['checkouts'], 6)
+
+        # writes through the pool are committed when the connection is returned
+        pooled_db.update('users', ['first'], ['pooled'], ['user_id'], [user_id])
+        self.assertEqual('pooled', db.select('users', ['first'], ['user_id'], [user_id])['first'])
+
+        clean_up_table('users', 'user_id')
+
+    def test_checkout_timeout(self):
+        pooled_db = Database(True, pool_config={'min_size': 0, 'max_size': 1, 'timeout': 0.1})
+        self.addCleanup(pooled_db.close)
+
+        conn = pooled_db.pool.getconn()
+
+        # the only connection is checked out, so the next checkout must time out
+        with self.assertRaises(PoolTimeout):
+            pooled_db.pool.getconn()
+
+        pooled_db.pool.putconn(conn)
+        self.assertEqual(1, pooled_db.pool.stats()['timeouts'])
+
+
+class TestTransactions(unittest.TestCase):
+
+    def test_commit_at_end_of_block(self):
+        with db.transaction():
+            user_id = create_user('txn_user')
+            db.update('users', ['first'], ['changed'], ['user_id'], [user_id])
+
+        row = db.select('users', ['first'], ['user_id'], [user_id])
+        self.assertEqual('changed', row['first'])
+
+        clean_up_table('users', 'user_id')
+
+    def test_rollback_on_error(self):
+        try:
+            with db.transaction():
+                create_user('txn_rollback')
+                raise RuntimeError('abort the unit of work')
+        except RuntimeError:
+            pass
+
+        # neither the user nor its profile were saved
+        self.assertIsNone(db.select('users', ['user_id'], ['username'], ['txn_rollback']))
+        self.assertFalse(db.in_transaction())
+
+
+class TestPreparedStatements(unittest.TestCase):
+
+    def test_statement_reuse(self):
+        user_id = create_user('prepared_user')
+
+        before = db.statements.stats()
+
+        # the first lookup may prepare the statement, every later one must reuse it
+        db.get_user(user_id)
+        first = db.statements.stats()
+        user = db.get_user(user_id)
+        second = db.statements.stats()
+
+        self.assertEqual(user['username'], 'prepared_user')
+        self.assertEqual(first['statements'], second['statements'], 'same shape must not compile twice')
+        self.assertEqual(second['hits'], first['hits'] + 1)
+        self.assertGreaterEqual(second['hits'] + second['misses'], before['hits'] + before['misses'] + 2)
+
+        # different where shapes are separate statements
+        db.select('users', ['last', 'username'], ['user_id'], [user_id])
+        db.select('users', ['last', 'username'], ['user_id'], [user_id], ['>='])
+        self.assertEqual(db.statements.stats()['statements'], second['statements'] + 2)
+
+        clean_up_table('users', 'user_id')
+
+
+class TestQueryStats(unittest.TestCase):
+
+    def test_histogram(self):
+        stats = QueryStats(slow_threshold=10)
+        stats.record('shape', 0.002, rows=3)
+        stats.record('shape', 0.2, rows=1)
+        stats.record('shape', 0.3, error=True)
+
+        shape = stats.snapshot()['shape']
+        self.assertEqual(3, shape['count'])
+        self.assertEqual(1, shape['errors'])
+        self.assertEqual(4, shape['rows'])
+        self.assertEqual(0.3, shape['max_time'])
+        self.assertEqual(1, shape['histogram']['<=0.0025'])
+        self.assertEqual(2, shape['histogram']['<=0.25'] + shape['histogram']['<=0.5'])
+
+    def test_database_records_queries(self):
+        user_id = create_user('stats_user')
+
+        before = db.stats()['queries'].get('get_user', {'count': 0})['count']
+        db.get_user(user_id)
+        after = db.stats()['queries']['get_user']
+
+        self.assertEqual(before + 1, after['count'])
+        self.assertEqual(sum(after['histogram'].values()), after['count'])
+
+        clean_up_table('users', 'user_id')
+
+
+class TestSlowQueryLog(unittest.TestCase):
+
+    def test_capture_plan(self):
+        # every statement counts as slow
+        slow_log = SlowQueryLog(threshold=0)
+        slow_db = Database(True, slow_query_log=slow_log)
+        self.addCleanup(slow_db.close)
+
+        user_id = create_user('slow_user')
+        slow_db.get_user(user_id)
+        slow_db.update('users', ['first'], ['slow'], ['user_id'], [user_id])
+
+        # plans are gathered in the background
+        for i in range(50):
+            if len(slow_log.entries()) >= 2:
+                break
+            time.sleep(0.1)
+
+        entries = {entry['shape']: entry for entry in slow_log.entries()}
+        self.assertIn('Execution Time', entries['get_user']['plan'])
+        self.assertIn(str(user_id), entries['get_user']['query'])
+
+        # writes are captured but never re-run
+        self.assertIsNone(entries['update:users:first:user_id']['plan'])
+        self.assertEqual('slow', db.select('users', ['first'], ['user_id'], [user_id])['first'])
+        self.assertFalse(entries['get_user']['replica'])
+
+        # replica reads are explained on the replica; the unit test database stands in for its own replica
+        replica_log = SlowQueryLog(threshold=0)
+        replica_db = Database(True, slow_query_log=replica_log, replica_dsn=generate_connection_string(True))
+        self.addCleanup(replica_db.close)
+        replica_db.find_all_workout_names(user_id)
+        for i in range(50):
+            entries = {entry['shape']: entry for entry in replica_log.entries()}
+            if 'find_all_workout_names' in entries:
+                break
+            time.sleep(0.1)
+
+        entry = entries['find_all_workout_names']
+        self.assertTrue(entry['replica'])
+        self.assertIn('Execution Time', entry['plan'])
+
+        clean_up_table('users', 'user_id')
+
+
+class TestReadReplica(unittest.TestCase):
+
+    def test_read_only_routing(self):
+        # the unit test database stands in for its own replica
+        replica_db = Database(True, replica_dsn=generate_connection_string(True), read_your_writes=60)
+        self.addCleanup(replica_db.close)
+        user_id = create_user('replica_user')
+
+        replica_db.find_all_workout_names(user_id)
+        statement = replica_db.statements.get(('find_all_workout_names',), None)
+        self.assertIn(statement.name, replica_db.replica_conn.prepared)
+        self.assertNotIn(statement.name, replica_db.conn.prepared)
+
+        # streamed reads are routed too
+        list(replica_db.get_aggregate_workouts_by_id(user_id, stream=True))
+        self.assertIn('stream:get_aggregate_workouts_by_id', replica_db.stats()['queries'])
+
+        # the user's own reads stay on the primary after a write
+        replica_db.mark_write(user_id)
+        self.assertTrue(replica_db.recently_wrote(user_id))
+        replica_db.find_all_workout_names(user_id)
+        self.assertIn(statement.name, replica_db.conn.prepared)
+
+        # writes never go to the replica
+        replica_db.update('users', ['first'], ['replica'], ['user_id'], [user_id])
+        update = replica_db.statements.get(('update', 'users', ('first',), ('user_id',), None), None)
+        self.assertNotIn(update.name, replica_db.replica_conn.prepared)
+
+        clean_up_table('users', 'user_id')
+
+
+class TestAsyncDatabase(unittest.TestCase):
+
+    def test_fan_out(self):
+        async_db = AsyncDatabase(generate_connection_string(True), database=db)
+        self.addCleanup(async_db.shutdown)
+        user_id = create_user('async_user')
+        create_workout(user_id, db, [2000], [7], [1], True)
+        last_sunday = get_last_sunday(datetime.datetime.utcnow())
+
+        user, profile, meters = async_db.gather(async_db.get_user(user_id),
+                                                async_db.select('profile', ['ALL'], ['user_id'], [user_id]),
+                                                async_db.get_leader_board_meters(last_sunday))
+
+        # the same shapes give the same rows as the synchronous database
+        self.assertEqual(db.get_user(user_id), user)
+        self.assertEqual('hello', profile['bio'])
+        self.assertEqual(db.get_leader_board_meters(last_sunday), meters)
+
+        async_db.gather(async_db.update('users', ['first'], ['async'], ['user_id'], [user_id]))
+        self.assertEqual('async', db.select('users', ['first'], ['user_id'], [user_id])['first'])
+
+        # the shapes of formatted rows match too
+        self.assertEqual(db.get_last_three_workouts(user_id),
+                         async_db.gather(async_db.get_last_three_workouts(user_id))[0])
+
+        clean_up_all()
+
+    def test_writes_invalidate(self):
+        cached_db = Database(True, result_cache=ResultCache(max_bytes=1024 * 1024))
+        self.addCleanup(cached_db.close)
+        boards = LeaderBoardCache()
+        async_db = AsyncDatabase(generate_connection_string(True), database=cached_db, leader_board_cache=boards)
+        self.addCleanup(async_db.shutdown)
+        user_id = create_user('async_writer')
+
+        # a cached read is dropped by a write made through the async pool
+        self.assertEqual('hello', cached_db.get_user(user_id)['first'])
+        async_db.gather(async_db.update('users', ['first'], ['async'], ['user_id'], [user_id]))
+        self.assertEqual('async', cached_db.get_user(user_id)['first'])
+
+        # and so are the leader boards, by workout writes
+        boards.get(datetime.datetime(2024, 3, 3, 23, 59, 59), lambda: 'boards')
+        async_db.gather(async_db.insert('workout', ['user_id', 'time', 'by_distance', 'name'],
+                                        [user_id, datetime.datetime.utcnow(), True, '0x'], 'workout_id'))
+        self.assertEqual(0, boards.stats()['weeks'])
+
+        clean_up_all()
+
+
+class TestResultCache(unittest.TestCase):
+
+    def test_lru_memory_cap(self):
+        cache = ResultCache(max_bytes=2000)
+        for i in range(20):
+            key = ('select', i)
+            cache.put(key, [{'username': 'user{}'.format(i)}], [('users', 'user_id', i)], cache.token([('users',)]))
+
+        stats = cache.stats()
+        self.assertLessEqual(stats['bytes'], 2000)
+        self.assertGreater(stats['evictions'], 0)
+
+        # the most recent entries survive
+        self.assertTrue(cache.get(('select', 19))[0])
+        self.assertFalse(cache.get(('select', 0))[0])
+
+    def test_write_invalidation(self):
+        cached_db = Database(True, result_cache=ResultCache())
+        self.addCleanup(cached_db.close)
+        user_id = create_user('cache_user')
+        other_id = create_user('other_cache_user')
+
+        cached_db.get_user(user_id)
+        cached_db.get_user(other_id)
+        cached_db.get_names()
+        self.assertEqual(user_id, cached_db.get_user(user_id)['user_id'])
+        self.assertEqual(1, cached_db.result_cache.stats()['hits'])
+
+        # cached copies can't be changed by the caller
+        cached_db.get_user(user_id)['first'] = 'changed'
+        self.assertEqual('hello', cached_db.get_user(user_id)['first'])
+
+        # a row level write keeps the other user's entry
+        cached_db.update('users', ['first'], ['cached'], ['user_id'], [user_id])
+        self.assertEqual('cached', cached_db.get_user(user_id)['first'])
+        hits = cached_db.result_cache.stats()['hits']
+        cached_db.get_user(other_id)
+        self.assertEqual(hits + 1, cached_db.result_cache.stats()['hits'])
+
+        # a new user changes the table wide read
+        cached_db.insert('users', ['username', 'first', 'last'], ['cache_new', 'a', 'b'], 'user_id')
+        self.assertIn('cache_new', cached_db.get_names())
+
+        # deletes cascade to the profile
+        self.assertIsNotNone(cached_db.select('profile', ['bio'], ['user_id'], [str(other_id)]))
+        cached_db.delete_entry('users', 'user_id', other_id)
+        self.assertIsNone(cached_db.select('profile', ['bio'], ['user_id'], [str(other_id)]))
+
+        clean_up_table('users', 'user_id')
+
+    def test_trigger_invalidation(self):
+        cached_db = Database(True, result_cache=ResultCache())
+        self.addCleanup(cached_db.close)
+        user_id = create_user('trigger_cache_user')
+        create_workout(user_id, cached_db, [2000], [7], [0], True)
+
+        workout = cached_db.select('workout', ['workout_id', 'total_distance'], ['user_id'], [user_id])
+        self.assertEqual(2000, workout['total_distance'])
+
+        # editing a piece changes its workout's totals through the erg triggers
+        erg = cached_db.select('erg', ['erg_id'], ['workout_id'], [workout['workout_id']])
+        cached_db.update('erg', ['distance'], [2500], ['erg_id'], [erg['erg_id']])
+        workout = cached_db.select('workout', ['workout_id', 'total_distance'], ['user_id'], [user_id])
+        self.assertEqual(2500, workout['total_distance'])
+
+        clean_up_all()
+
+
+class TestLeaderBoardCache(unittest.TestCase):
+
+    def test_hits_and_invalidation(self):
+        cache = LeaderBoardCache(max_age=None)
+        this_week = datetime.datetime(2024, 3, 10, 23, 59, 59)
+        last_week = datetime.datetime(2024, 3, 3, 23, 59, 59)
+        computed = []
+
+        def compute(week):
+            computed.append(week)
+            return [week]
+
+        self.assertEqual([this_week], cache.get(this_week, lambda: compute(this_week)))
+        self.assertEqual([this_week], cache.get(this_week, lambda: compute(this_week)))
+        cache.get(last_week, lambda: compute(last_week))
+        self.assertEqual([this_week, last_week], computed)
+
+        # a workout logged during last week only changes the boards that cover it
+        cache.invalidate(datetime.datetime(2024, 3, 8, 7))
+        cache.get(this_week, lambda: compute(this_week))
+        cache.get(last_week, lambda: compute(last_week))
+        self.assertEqual([this_week, last_week, last_week], computed)
+
+        cache.invalidate()
+        self.assertEqual(0, cache.stats()['weeks'])
+
+        stats = cache.stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(3, stats['invalidations'])
+
+    def test_write_during_compute(self):
+        cache = LeaderBoardCache(max_age=None)
+        week = datetime.datetime(2024, 3, 10, 23, 59, 59)
+
+        def compute():
+            cache.invalidate()
+            return ['stale']
+
+        # a board computed while a write was made is returned but not kept
+        self.assertEqual(['stale'], cache.get(week, compute))
+        self.assertEqual(['fresh'], cache.get(week, lambda: ['fresh']))
+
+    def test_max_age(self):
+        cache = LeaderBoardCache(max_age=0.05)
+        week = datetime.datetime(2024, 3, 10, 23, 59, 59)
+        cache.get(week, lambda: ['first'])
+        time.sleep(0.1)
+        self.assertEqual(['second'], cache.get(week, lambda: ['second']))
+
+    def test_pruning(self):
+        cache = LeaderBoardCache(max_age=0.05, max_weeks=2)
+        week = datetime.datetime(2024, 3, 10, 23, 59, 59)
+
+        # boards of other scopes or windows don't pile up once expired
+        cache.get(week, lambda: ['old'], ('vm',))
+        time.sleep(0.1)
+        cache.get(week, lambda: ['all'])
+        self.assertEqual(1, cache.stats()['weeks'])
+
+        # and never past max_weeks, dropping the oldest
+        cache.get(week, lambda: ['vm'], ('vm',))
+        cache.get(week, lambda: ['nm'], ('nm',))
+        self.assertEqual(2, cache.stats()['weeks'])
+        self.assertEqual(['nm'], cache.get(week, lambda: ['recomputed'], ('nm',)))
+        self.assertEqual(['recomputed'], cache.get(week, lambda: ['recomputed']))
+
+
+class TestMigrations(unittest.TestCase):
+
+    def test_migrate(self):
+        db.init_tables()
+        self.assertEqual(migrations.latest_version(), migrations.current_version(db))
+        self.assertTrue(migrations.check(db))
+
+        # a migrated database has nothing left to apply
+        self.assertEqual([], db.init_tables())
+
+    def test_lookup_indexes(self):
+        db.init_tables()
+        rows = db.fetch_all("SELECT indexname FROM pg_indexes WHERE tablename IN ('users', 'workout', 'erg')")
+        indexes = {row['indexname'] for row in rows}
+        for index in ['workout_user_history_idx', 'workout_time_idx', 'erg_workout_id_idx',
+                      'users_username_idx', 'users_email_idx']:
+            self.assertIn(index, indexes)
+
+    def test_partitions(self):
+        db.init_tables()
+        # the current month and the ones ahead were created on start up
+        self.assertEqual(0, migrations.ensure_partitions(db))
+
+        month = datetime.datetime.utcnow().strftime('%Y_%m')
+        rows = db.fetch_all("SELECT relname FROM pg_class WHERE relname IN ('workout_{0}', 'erg_{0}')".format(month))
+        self.assertEqual(2, len(rows))
+
+        # a workout is stored in its month and its pieces follow it when it moves
+        user_id = create_user('123user123')
+        create_workout(user_id, db, [2000, 500], [7, 1], [1, 40], True)
+        workout = db.select('workout', ['workout_id'], ['user_id'], [user_id])
+        self.assertEqual(1, len(db.fetch_all('SELECT * FROM workout_{}'.format(month))))
+
+        db.update('workout', ['time'], [datetime.datetime(2000, 1, 1)], ['workout_id'], [workout['workout_id']])
+        pieces = db.select('erg', ['workout_time'], ['workout_id'], [workout['workout_id']], fetchone=False)
+        self.assertEqual([datetime.datetime(2000, 1, 1)] * 2, [piece['workout_time'] for piece in pieces])
+        self.assertEqual(0, len(db.fetch_all('SELECT * FROM erg_{}'.format(month))))
+
+        # a workout past the months made on start up gets its month's partitions instead of the default ones
+        ahead = migrations.last_partition_month(datetime.datetime.utcnow(), 2 * migrations.PARTITION_MONTHS_AHEAD)
+        db.insert_workout(user_id, datetime.datetime.combine(ahead, datetime.time(12)), True, '1x2000m',
+                          [(2000, 7, 1)])
+        month = ahead.strftime('%Y_%m')
+        self.assertEqual(1, len(db.fetch_all('SELECT * FROM workout_{}'.format(month))))
+        self.assertEqual(1, len(db.fetch_all('SELECT * FROM erg_{}'.format(month))))
+        self.assertEqual(0, db.ensure_partitions(ahead))
+
+        # and so does a back dated one
+        db.insert_workout(user_id, datetime.datetime(1999, 6, 15, 12), True, '1x2000m', [(2000, 7, 1)])
+        self.assertEqual(1, len(db.fetch_all('SELECT * FROM workout_1999_06')))
+        self.assertEqual(1, len(db.fetch_all('SELECT * FROM erg_1999_06')))
+
+        clean_up_table('users', 'user_id')
+        self.assertEqual(0, len(db.select('erg', ['ALL'], fetchone=False)))
+
+
 class TestDBSpecific(unittest.TestCase):
     """
     test queries for specific purposes
@@ -225,6 +769,22 @@ class TestDBSpecific(unittest.TestCase):
         clean_up_table('users', 'user_id')
         self.assertEqual(0, len(db.select('users', ['ALL'], fetchone=False)))
 
+    def test_graph_data(self):
+        user_id = create_user('graph_user')
+        create_workout(user_id, db, [2000, 2000], [7, 7], [0, 0], True)
+
+        graph = json.loads(build_graph_data(db.get_aggregate_workouts_by_name(user_id, '2x2000m', row_format='numpy'),
+                                            '2x2000m'))
+        self.assertEqual('Minutes', graph['y_axis'])
+        self.assertEqual([7.0], graph['data'])
+
+        # a name without workouts gives empty axes
+        graph = json.loads(build_graph_data(db.get_aggregate_workouts_by_name(user_id, '4x500m', row_format='numpy'),
+                                            '4x500m'))
+        self.assertEqual({'data': [], 'labels': [], 'name': '4x500m', 'y_axis': '', '_ids': []}, graph)
+
+        clean_up_all()
+
     def test_get_workout_names(self):
         """
         test that the unique names of the workouts are returned
@@ -382,6 +942,47 @@ class TestDBSpecific(unittest.TestCase):
         self.assertEqual(format(((416 / 4) % 60), '.2f'), aggregates[0]['avg_sec'], 'average second')
         self.assertEqual(int(416 / 4 / 60), aggregates[0]['avg_min'], 'average minute')
 
+        # the column-wise split math matches the per-row one
+        for row_format in ['columns', 'numpy']:
+            columns = db.get_aggregate_workouts_by_id(user_id, row_format=row_format)
+            self.assertEqual([a['avg_sec'] for a in aggregates], list(columns['avg_sec']))
+            self.assertEqual([a['avg_min'] for a in aggregates], list(columns['avg_min']))
+
+    def test_workout_pages(self):
+        user_id = create_user('paula')
+        for meters in [1000, 2000, 3000, 4000, 5000]:
+            create_workout(user_id, db, [meters, meters], [4, 4], [0, 0], True)
+
+        # pages come newest first and never overlap
+        seen = []
+        before = None
+        for expected in [2, 2, 1]:
+            workouts, before = db.get_aggregate_workouts_page(user_id, 2, before)
+            self.assertEqual(expected, len(workouts))
+            seen.extend(workout['distance'] for workout in workouts)
+        self.assertIsNone(before)
+        self.assertEqual([5000, 4000, 3000, 2000, 1000], seen)
+
+        # raw pieces page by workout, so a page holds every piece of its workouts
+        pieces, before = db.get_workouts_page(user_id, 2)
+        self.assertEqual(4, len(pieces))
+        self.assertEqual([5000, 5000, 4000, 4000], [piece['distance'] for piece in pieces])
+        pieces, before = db.get_workouts_page(user_id, 2, before)
+        self.assertEqual([3000, 3000, 2000, 2000], [piece['distance'] for piece in pieces])
+
+        clean_up_all()
+
+    def test_insert_workout_without_pieces(self):
+        user_id = create_user('nora')
+
+        workout_id = db.insert_workout(user_id, datetime.datetime.now(), True, '0x', [])
+
+        workouts = db.select('workout', ['workout_id'], ['user_id'], [user_id], fetchone=False)
+        self.assertEqual([workout_id], [workout['workout_id'] for workout in workouts])
+        self.assertEqual([], db.select('erg', ['erg_id'], ['workout_id'], [workout_id], fetchone=False))
+
+        clean_up_all()
+
 
 class TestTriggers(unittest.TestCase):
 
@@ -462,6 +1063,91 @@ class TestTriggers(unittest.TestCase):
         clean_up_table('users', 'user_id')
         self.assertEqual(0, len(db.select('users', ['ALL'], fetchone=False)))
 
+    def test_workout_totals(self):
+        """
+        the totals on the workout row follow its pieces through inserts, edits and deletes
+        :return:
+        """
+        user_id = create_user('123user123')
+        create_workout(user_id, db, [2000, 1000], [7, 3], [0, 30], True)
+
+        workout = db.select('workout', ['ALL'], ['user_id'], [user_id])
+        self.assertEqual(2, workout['piece_count'])
+        self.assertEqual(3000, workout['total_distance'])
+        self.assertEqual(630, workout['total_seconds'])
+        self.assertEqual(1500, workout['avg_distance'])
+        self.assertEqual(105, workout['avg_split'])
+
+        pieces = db.select('erg', ['erg_id'], ['workout_id'], [workout['workout_id']], order_by=['erg_id'],
+                           fetchone=False)
+        db.update_many('erg', 'erg_id', ['distance'], [(pieces[1]['erg_id'], 2000)])
+        workout = db.select('workout', ['ALL'], ['user_id'], [user_id])
+        self.assertEqual(4000, workout['total_distance'])
+
+        db.delete_entry('erg', 'erg_id', pieces[0]['erg_id'])
+        workout = db.select('workout', ['ALL'], ['user_id'], [user_id])
+        self.assertEqual(1, workout['piece_count'])
+        self.assertEqual(210, workout['total_seconds'])
+        self.assertEqual(2000, workout['avg_distance'])
+
+        clean_up_table('users', 'user_id')
+
+    def test_daily_activity(self):
+        """
+        the heat map rollup follows workouts as they are added, moved and deleted
+        :return:
+        """
+        user_id = create_user('123user123')
+        create_workout(user_id, db, [2000, 1000], [7, 3], [0, 30], True)
+        create_workout(user_id, db, [500], [1, 0], [40, 0], True)
+
+        days = db.get_heat_map_calendar_results(user_id)
+        self.assertEqual(1, len(days))
+        self.assertEqual(2, days[0]['count'])
+        self.assertEqual(3500, days[0]['meters'])
+        self.assertAlmostEqual(12.5, days[0]['minutes'])
+
+        workouts = db.select('workout', ['workout_id'], ['user_id'], [user_id], order_by=['workout_id'],
+                             fetchone=False)
+        db.update('workout', ['time'], [datetime.datetime(2000, 1, 1, 18)], ['workout_id'],
+                  [workouts[1]['workout_id']])
+        days = db.get_heat_map_calendar_results(user_id)
+        self.assertEqual([1, 1], [day['count'] for day in days])
+        self.assertEqual(datetime.date(2000, 1, 1), days[0]['date'])
+
+        # the range only returns the days inside it
+        days = db.get_heat_map_calendar_results(user_id, datetime.date(1999, 12, 1), datetime.date(2000, 2, 1))
+        self.assertEqual(1, len(days))
+        self.assertEqual(500, days[0]['meters'])
+
+        db.delete_entry('workout', 'workout_id', workouts[1]['workout_id'])
+        self.assertEqual(1, len(db.get_heat_map_calendar_results(user_id)))
+
+        clean_up_table('users', 'user_id')
+
+    def test_delete_user_cascades(self):
+        """
+        deleting a user removes their profile, workouts and pieces
+        :return:
+        """
+        user_id = create_user('123user123')
+        other_id = create_user('456user456')
+        create_workout(user_id, db, [2000, 500], [7, 1], [1, 40], True)
+        create_workout(other_id, db, [1000], [3, 30], [20], True)
+
+        db.delete_entry('users', 'user_id', user_id)
+
+        self.assertIsNone(db.select('profile', ['ALL'], ['user_id'], [user_id]))
+        self.assertEqual(0, len(db.select('workout', ['ALL'], ['user_id'], [user_id], fetchone=False)))
+
+        # the other user's workout is untouched
+        workouts = db.select('workout', ['ALL'], fetchone=False)
+        self.assertEqual(1, len(workouts))
+        self.assertEqual(other_id, workouts[0]['user_id'])
+        self.assertEqual(1, len(db.select('erg', ['ALL'], fetchone=False)))
+
+        clean_up_table('users', 'user_id')
+
 
 class TestLeaderBoardQueries(unittest.TestCase):
 
@@ -572,6 +1258,255 @@ class TestLeaderBoardQueries(unittest.TestCase):
         # clean up everything
         clean_up_all()
 
+    def test_week_rollup_matches_workouts(self):
+        """
+        the weekly rollup gives the same boards as the queries over the workouts
+        :return:
+        """
+        clean_up_all()
+        date = get_last_sunday(datetime.datetime.utcnow())
+
+        id1 = create_user('bob')
+        id2 = create_user('sue')
+        create_workout(id1, db, [2000, 1000], [7, 3], [10, 45.5], True)
+        create_workout(id2, db, [5000], [19], [59.9], True)
+        create_workout(id1, db, [3000], [12], [0], True)
+
+        # edit and delete pieces so the rollup has to follow the totals
+        pieces = db.select('erg', ['erg_id'], order_by=['erg_id'], fetchone=False)
+        db.update_many('erg', 'erg_id', ['distance'], [(pieces[0]['erg_id'], 2500)])
+        db.delete_entry('erg', 'erg_id', pieces[1]['erg_id'])
+
+        self.assertEqual(db.get_leader_board_meters(date), db.get_leader_board_meters(date, use_rollup=True))
+        for board, key in [(db.get_leader_board_minutes, 'total_seconds'), (db.get_leader_board_split, 'split')]:
+            rolled_rows = board(date, use_rollup=True)
+            raw_rows = board(date)
+            self.assertEqual(len(raw_rows), len(rolled_rows))
+            for rolled, raw in zip(rolled_rows, raw_rows):
+                self.assertEqual(raw['username'], rolled['username'])
+                self.assertAlmostEqual(raw[key], rolled[key])
+
+        # only the end of a week can be read from the rollup
+        with self.assertRaises(ValueError):
+            db.get_leader_board_meters(date + datetime.timedelta(microseconds=1), use_rollup=True)
+
+        clean_up_all()
+        self.assertEqual([], db.get_leader_board_meters(date, use_rollup=True))
+
+    def test_combined_board_matches_boards(self):
+        """
+        the single query gives the same totals as the three board queries
+        :return:
+        """
+        clean_up_all()
+        date = get_last_sunday(datetime.datetime.utcnow())
+
+        id1 = create_user('bob')
+        id2 = create_user('sue')
+        create_workout(id1, db, [2000, 1000], [7, 3], [10, 45.5], True)
+        create_workout(id2, db, [5000], [19], [59.9], True)
+
+        for cutoff in [date, date + datetime.timedelta(microseconds=1)]:
+            rows = {row['username']: row for row in db.get_leader_board(cutoff)}
+            self.assertEqual(2, len(rows))
+            for board, key in [(db.get_leader_board_meters, 'total_meters'),
+                               (db.get_leader_board_minutes, 'total_seconds'),
+                               (db.get_leader_board_split, 'split')]:
+                for row in board(cutoff):
+                    self.assertAlmostEqual(row[key], rows[row['username']][key])
+
+        clean_up_all()
+        self.assertEqual([], db.get_leader_board(date))
+
+    def test_top_of_leader_board(self):
+        """
+        only the top places of each board and the viewer's row come back, with the viewer's rank
+        :return:
+        """
+        clean_up_all()
+        date = get_last_sunday(datetime.datetime.utcnow())
+
+        create_workout(create_user('bob'), db, [2000, 1000], [7, 3], [10, 45.5], True)
+        create_workout(create_user('sue'), db, [5000], [19], [59.9], True)
+        create_workout(create_user('ann'), db, [1000], [3], [0], True)
+
+        for use_rollup in [False, True]:
+            rows = {row['username']: row for row in db.get_leader_board_top(date, 'ann', 1, use_rollup=use_rollup)}
+            # sue leads meters and minutes, ann leads split
+            self.assertEqual({'sue', 'ann'}, set(rows))
+            self.assertEqual(3, rows['ann']['meters_rank'])
+            self.assertEqual(1, rows['ann']['split_rank'])
+            self.assertEqual(1, rows['sue']['meters_place'])
+
+            # bob's row comes back once bob is the viewer
+            self.assertEqual({'sue', 'ann', 'bob'}, set(row['username'] for row in
+                                                        db.get_leader_board_top(date, 'bob', 1, use_rollup=use_rollup)))
+
+            # without a viewer only the top places, without places only the viewer's row
+            self.assertEqual({'sue', 'ann'}, set(row['username'] for row in
+                                                 db.get_leader_board_top(date, None, 1, use_rollup=use_rollup)))
+            rows = db.get_leader_board_top(date, 'bob', 0, use_rollup=use_rollup)
+            self.assertEqual([('bob', 2)], [(row['username'], row['meters_rank']) for row in rows])
+
+        clean_up_all()
+
+    def test_team_leader_boards(self):
+        """
+        squad boards only rank the athletes of the squad or group
+        :return:
+        """
+        clean_up_all()
+        date = get_last_sunday(datetime.datetime.utcnow())
+
+        bob, sue, ann = create_user('bob'), create_user('sue'), create_user('ann')
+        db.update('users', ['team'], ['vm'], ['user_id'], [bob])
+        db.update('users', ['team'], ['vw'], ['user_id'], [sue])
+        db.update('users', ['team'], ['vm'], ['user_id'], [ann])
+        create_workout(bob, db, [2000], [7], [10], True)
+        create_workout(sue, db, [5000], [19], [59.9], True)
+        create_workout(ann, db, [1000], [3], [0], True)
+
+        for cutoff in [date, date + datetime.timedelta(microseconds=1)]:
+            rows = db.get_leader_board_top(cutoff, 'sue', 5, teams=['vm'])
+            self.assertEqual({'bob', 'ann'}, {row['username'] for row in rows})
+            self.assertEqual(1, [row for row in rows if row['username'] == 'bob'][0]['meters_rank'])
+
+            rows = db.get_leader_board(cutoff, teams=['vm', 'vw'])
+            self.assertEqual(3, len(rows))
+
+            rows = db.get_leader_board(cutoff, user_ids=[sue, ann])
+            self.assertEqual({'sue', 'ann'}, {row['username'] for row in rows})
+            self.assertEqual([], db.get_leader_board(cutoff, user_ids=[]))
+
+        with self.assertRaises(ValueError):
+            db.get_leader_board(date, teams=['vm'], user_ids=[bob])
+
+        clean_up_all()
+
+    def test_window_leader_boards(self):
+        """
+        rolling windows are answered from the running daily totals and follow workouts that move
+        :return:
+        """
+        clean_up_all()
+        today = db.get_activity_today()
+
+        bob, sue = create_user('bob'), create_user('sue')
+        create_workout(bob, db, [2000, 1000], [7, 3], [10, 45.5], True)
+        create_workout(sue, db, [5000], [19], [59.9], True)
+        create_workout(bob, db, [3000], [12], [0], True)
+
+        # move one of bob's workouts back 40 days
+        workouts = db.select('workout', ['workout_id'], ['user_id'], [bob], order_by=['workout_id'], fetchone=False)
+        db.update('workout', ['time'], [datetime.datetime.utcnow() - datetime.timedelta(days=40)], ['workout_id'],
+                  [workouts[0]['workout_id']])
+
+        def totals(window):
+            start, end = leader_board_window(window, today)
+            return {row['username']: row['total_meters'] for row in db.get_leader_board_window(start, end, 'bob')}
+
+        self.assertEqual({'bob': 3000, 'sue': 5000}, totals('30d'))
+        self.assertEqual({'bob': 6000, 'sue': 5000}, totals('all'))
+        self.assertEqual([], db.get_leader_board_window(today + datetime.timedelta(days=1), today, 'bob'))
+
+        rows = db.get_leader_board_window(datetime.date.min, today, 'bob')
+        self.assertEqual(1, [row for row in rows if row['username'] == 'bob'][0]['meters_rank'])
+
+        self.assertEqual((datetime.date(2023, 9, 1), datetime.date(2024, 3, 10)),
+                         leader_board_window('season', datetime.date(2024, 3, 10)))
+        self.assertEqual(datetime.date(2024, 3, 4), leader_board_window('7d', datetime.date(2024, 3, 10))[0])
+
+        clean_up_all()
+        self.assertEqual([], db.get_leader_board_window(datetime.date.min, today, 'bob'))
+
+    def test_generate_leader_board(self):
+        """
+        the cached top places are shared by every viewer, and a viewer below them still sees their own row
+        :return:
+        """
+        clean_up_all()
+        LEADER_BOARD_CACHE.invalidate()
+        for i in range(1, 8):
+            # rower1 is last on every board
+            create_workout(create_user('rower{}'.format(i)), db, [1000 * i], [3 + i], [0], True)
+
+        meters, minutes, split = generate_leader_board('rower1')
+        self.assertEqual(['rower7', 'rower6', 'rower5', 'rower4', 'rower3', 'rower1'],
+                         [row['username'] for row in meters])
+
+        hits = LEADER_BOARD_CACHE.stats()['hits']
+        meters, minutes, split = generate_leader_board('rower7')
+        self.assertEqual(['rower7', 'rower6', 'rower5', 'rower4', 'rower3', 'rower2'],
+                         [row['username'] for row in meters])
+        self.assertEqual(hits + 1, LEADER_BOARD_CACHE.stats()['hits'])
+        self.assertEqual(1, LEADER_BOARD_CACHE.stats()['weeks'])
+
+        clean_up_all()
+        LEADER_BOARD_CACHE.invalidate()
+
+    def test_format_leader_arr(self):
+        # a viewer without a row is shown below the top places, and empty places are filled in
+        board = format_leader_arr([{'username': 'sue', 'total_meters': 5000},
+                                   {'username': 'ann', 'total_meters': 1000}], 'total_meters', 'bob')
+        self.assertEqual(['sue', 'ann', 'bob', 'Unclaimed', 'Unclaimed', 'Unclaimed'],
+                         [row['username'] for row in board])
+
+        # a viewer in the top places makes room for the next place
+        rows = [{'username': 'rower{}'.format(i), 'total_meters': 1000 * (8 - i)} for i in range(1, 8)]
+        board = format_leader_arr(rows, 'total_meters', 'rower2')
+        self.assertEqual(['rower1', 'rower2', 'rower3', 'rower4', 'rower5', 'rower6'],
+                         [row['username'] for row in board])
+
+    def test_archive_finished_weeks(self):
+        """
+        finished weeks are archived once and their archive follows later edits
+        :return:
+        """
+        clean_up_all()
+        db.fetch_all('DELETE FROM leader_board_archive RETURNING week_start')
+        current_week = current_week_start(datetime.datetime.utcnow())
+        last_week = current_week - datetime.timedelta(days=7)
+
+        bob, sue = create_user('bob'), create_user('sue')
+        create_workout(bob, db, [2000], [7], [10], True)
+        create_workout(sue, db, [5000], [19], [59.9], True)
+        create_workout(sue, db, [1000], [3], [30], True)
+
+        # move bob's workout and one of sue's into last week
+        for user_id in [bob, sue]:
+            workout = db.select('workout', ['workout_id'], ['user_id'], [user_id], order_by=['workout_id'])
+            db.update('workout', ['time'], [datetime.datetime.combine(last_week, datetime.time(12))],
+                      ['workout_id'], [workout['workout_id']])
+
+        self.assertEqual(2, db.archive_leader_board_weeks(current_week))
+        self.assertEqual(0, db.archive_leader_board_weeks(current_week))
+
+        rows = {row['username']: row for row in db.get_leader_board_archive(last_week, 'bob')}
+        self.assertEqual(5000, rows['sue']['total_meters'])
+        self.assertEqual(1, rows['sue']['meters_rank'])
+        self.assertEqual(2, rows['bob']['meters_rank'])
+
+        self.assertEqual({'previous': None, 'next': None}, db.get_leader_board_archive_weeks(last_week))
+        self.assertEqual(last_week, db.get_leader_board_archive_weeks(current_week)['previous'])
+
+        # an edit to a piece of the week ranks it again
+        workout = db.select('workout', ['workout_id'], ['user_id'], [bob])
+        erg = db.select('erg', ['erg_id'], ['workout_id'], [workout['workout_id']])
+        db.update('erg', ['distance'], [6000], ['erg_id'], [erg['erg_id']])
+        rows = {row['username']: row for row in db.get_leader_board_archive(last_week, 'bob')}
+        self.assertEqual(6000, rows['bob']['total_meters'])
+        self.assertEqual(1, rows['bob']['meters_rank'])
+        self.assertEqual(2, rows['sue']['meters_rank'])
+
+        # and so does moving a workout out of it or deleting one
+        db.update('workout', ['time'], [datetime.datetime.utcnow()], ['workout_id'], [workout['workout_id']])
+        self.assertEqual(['sue'], [row['username'] for row in db.get_leader_board_archive(last_week, 'bob')])
+        clean_up_table('workout', 'workout_id')
+        self.assertEqual([], db.get_leader_board_archive(last_week, 'bob'))
+
+        db.fetch_all('DELETE FROM leader_board_archive RETURNING week_start')
+        clean_up_all()
+
     def test_get_leader_board_minutes(self):
 
         # start with clean db
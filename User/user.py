@@ -81,10 +81,13 @@ class User:
 
         col_names = attr_dict.keys()
         col_vals = attr_dict.values()
-        user_id = db.insert('users', col_names, col_vals, 'user_id')
 
-        bio_string = 'Hi, my name is %s!' % form_data['first']
-        db.insert('profile', ['bio', 'user_id'], [bio_string, user_id], 'user_id')
+        # a user is never saved without a profile
+        with db.transaction():
+            user_id = db.insert('users', col_names, col_vals, 'user_id')
+
+            bio_string = 'Hi, my name is %s!' % form_data['first']
+            db.insert('profile', ['bio', 'user_id'], [bio_string, user_id], 'user_id')
 
         return cls(user_id, active)
 
@@ -94,17 +97,19 @@ class User:
         col_names = list(csv_data.keys())
         col_values = list(csv_data.values())
 
-        username_select = db.select(table_name='users', select_cols=['user_id'], where_cols=['username'],
-                                    where_params=[csv_data['username']])
-        if username_select is not None:
-            user_id = username_select['user_id']
-            db.update('users', col_names, col_values, where_cols=['user_id'], where_params=[user_id], operators=['='])
-            log.info('Updated {}'.format(user_id))
-        else:
-            user_id = db.insert('users', col_names, col_values, 'user_id')
-            bio_string = 'Hi, my name is %s!' % csv_data['first']
-            db.insert('profile', ['bio', 'user_id'], [bio_string, user_id], 'user_id')
-            log.info('Inserted new user {}'.format(user_id))
+        with db.transaction():
+            username_select = db.select(table_name='users', select_cols=['user_id'], where_cols=['username'],
+                                        where_params=[csv_data['username']])
+            if username_select is not None:
+                user_id = username_select['user_id']
+                db.update('users', col_names, col_values, where_cols=['user_id'], where_params=[user_id],
+                          operators=['='])
+                log.info('Updated {}'.format(user_id))
+            else:
+                user_id = db.insert('users', col_names, col_values, 'user_id')
+                bio_string = 'Hi, my name is %s!' % csv_data['first']
+                db.insert('profile', ['bio', 'user_id'], [bio_string, user_id], 'user_id')
+                log.info('Inserted new user {}'.format(user_id))
 
     def __repr__(self):
         return '<User %s>' % self.username
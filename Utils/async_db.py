@@ -0,0 +1,311 @@
+import asyncio
+import datetime
+import threading
+import time
+
+import aiopg
+import psycopg2
+from psycopg2 import extras, sql as SQL
+
+from Utils.db import (KEYSET_START, build_insert, build_named_query, build_select, build_update,
+                      format_aggregate_workout, inserted_rows, leader_board_query, page_cursor, select_list,
+                      updated_rows, window_leader_board_query)
+from Utils.instrumentation import QueryStats
+from Utils.log import log
+from Utils.statements import StatementRegistry
+
+
+class AsyncDatabase:
+    """
+    asyncio twin of Database backed by an aiopg pool; it builds the same query shapes and runs the same
+    named queries, so independent reads can be awaited together instead of one after another.
+    aiopg connections are always in autocommit mode, so every statement commits on its own; writes that
+    must be atomic belong in Database.transaction()
+    """
+
+    def __init__(self, connect_str, min_size=1, max_size=10, timeout=5.0, query_stats=None, database=None,
+                 leader_board_cache=None):
+        """
+
+        :param connect_str: the libpq connection string of the database
+        :param min_size: connections the pool opens up front
+        :param max_size: most connections the pool opens at once
+        :param timeout: seconds to wait for a connection or a statement
+        :param query_stats: optional QueryStats, e.g. the one the Database uses; a default one is created if omitted
+        :param database: optional; the Database of this process, whose cached results and read-your-writes window
+        follow the writes made here
+        :param leader_board_cache: optional; the LeaderBoardCache of this process, dropped on workout writes
+        """
+        self.connect_str = connect_str
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.query_stats = query_stats or QueryStats()
+        self.database = database
+        self.leader_board_cache = leader_board_cache
+        # only used to cache the composed shapes; aiopg runs them directly
+        self.statements = StatementRegistry(enabled=False)
+        self.pool = None
+        self._pool_lock = None
+        self._loop = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    async def get_pool(self):
+        """
+        :return: the aiopg pool, created on first use on the running event loop
+        """
+        if self.pool is None:
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+            async with self._pool_lock:
+                if self.pool is None:
+                    self.pool = await aiopg.create_pool(self.connect_str, minsize=self.min_size,
+                                                        maxsize=self.max_size, timeout=self.timeout)
+                    log.info('Opened async database pool (max {})'.format(self.max_size))
+        return self.pool
+
+    async def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
+            self.pool = None
+
+    async def fetch(self, sql_statement, params=None, fetchone=True, shape='async'):
+        """
+        runs a statement on a pooled connection
+        :param sql_statement: a composable or a string
+        :param params: the query parameters
+        :param fetchone: true to return the first row, false for every row
+        :param shape: a label for the statement in self.query_stats
+        :return: the row or rows, or None if the statement returns nothing
+        """
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor(cursor_factory=extras.RealDictCursor) as cur:
+                start = time.perf_counter()
+                try:
+                    await cur.execute(sql_statement, params)
+                except psycopg2.Error:
+                    self.query_stats.record(shape, time.perf_counter() - start, error=True,
+                                            query_text=lambda: str(cur.query))
+                    raise
+                self.query_stats.record(shape, time.perf_counter() - start, cur.rowcount)
+
+                if cur.description is None:
+                    return None
+                if fetchone:
+                    return await cur.fetchone()
+                return await cur.fetchall()
+
+    async def named(self, name, params=None, fetchone=False):
+        """
+        :param name: a key of QUERIES
+        :param params: the query parameters
+        :param fetchone: true to return only the first row
+        :return: the result of the named query
+        """
+        statement = self.statements.get((name,), lambda: build_named_query(name))
+        return await self.fetch(statement.query, params, fetchone, shape='async:' + statement.label)
+
+    async def insert(self, table_name, col_names, col_params, pk):
+        """
+        :param table_name: name of the table to insert into
+        :param col_names: the names of the columns
+        :param col_params: the data to insert
+        :param pk: the primary key column to return
+        :return: the id of the new row
+        """
+        col_names = tuple(col_names)
+        statement = self.statements.get(('insert', table_name, col_names, pk),
+                                        lambda: build_insert(table_name, col_names, pk))
+        row = await self.fetch(statement.query, list(col_params), shape='async:' + statement.label)
+        self.written(table_name, inserted_rows(col_names, col_params, pk, row[pk]))
+        return row[pk]
+
+    async def select(self, table_name, select_cols, where_cols=None, where_params=None, operators=None,
+                     order_by=None, fetchone=True):
+        """
+        same as Database.select; can set select_cols to ['ALL'] to use '*'
+        :return: the row(s), if any, matching the query
+        """
+        select_cols = tuple(select_cols)
+        order_by = tuple(order_by) if order_by else None
+
+        if where_cols is None:
+            statement = self.statements.get(('select', table_name, select_cols, None, None, order_by),
+                                            lambda: build_select(table_name, select_cols, order_by=order_by))
+            return await self.fetch(statement.query, None, fetchone=False, shape='async:' + statement.label)
+
+        params_tuple = tuple(where_params)
+        if type(params_tuple[0]) == list:
+            sql = SQL.SQL("SELECT {} FROM {} WHERE {} IN ({});").format(
+                select_list(select_cols), SQL.Identifier(table_name), SQL.Identifier(where_cols[0]),
+                SQL.SQL(', ').join(map(SQL.Literal, params_tuple[0])))
+            return await self.fetch(sql, None, fetchone=False, shape='async:select_in:' + table_name)
+
+        where_cols = tuple(where_cols)
+        operators = tuple(operators) if operators else None
+        statement = self.statements.get(('select', table_name, select_cols, where_cols, operators, order_by),
+                                        lambda: build_select(table_name, select_cols, where_cols, operators,
+                                                             order_by))
+        return await self.fetch(statement.query, params_tuple, fetchone, shape='async:' + statement.label)
+
+    async def update(self, table_name, update_cols, update_params, where_cols, where_params, operators=None):
+        """
+        same as Database.update
+        :return: nothing
+        """
+        update_cols = tuple(update_cols)
+        where_cols = tuple(where_cols)
+        operators = tuple(operators) if operators else None
+        statement = self.statements.get(('update', table_name, update_cols, where_cols, operators),
+                                        lambda: build_update(table_name, update_cols, where_cols, operators))
+        await self.fetch(statement.query, tuple(update_params) + tuple(where_params),
+                         shape='async:' + statement.label)
+        self.written(table_name, updated_rows(update_cols, update_params, where_cols, where_params, operators))
+
+    def written(self, table_name, rows=None):
+        """
+        does what the Database does after a committed write: drops the cached results and leader boards it could
+        have changed and starts the read-your-writes window of the users it wrote
+        :param table_name: the table written to
+        :param rows: optional dictionary of column to the values identifying the written rows
+        :return: nothing
+        """
+        if self.database is not None:
+            self.database.invalidate(table_name, rows)
+            for user_id in (rows or {}).get('user_id', ()):
+                self.database.mark_write(user_id)
+        if self.leader_board_cache is not None and table_name in ('workout', 'erg'):
+            self.leader_board_cache.invalidate()
+
+    async def get_user(self, user_id):
+        return await self.named('get_user', (user_id,), fetchone=True)
+
+    async def get_profile_stats(self, user_id):
+        return await self.named('get_profile_stats', (user_id,), fetchone=True)
+
+    async def get_workouts(self, user_id):
+        return await self.named('get_workouts', (user_id,))
+
+    async def get_workouts_by_id(self, user_id, workout_id):
+        return await self.named('get_workouts_by_id', (user_id, workout_id))
+
+    async def get_aggregate_workouts_by_name(self, user_id, workout_name):
+        return await self.named('get_aggregate_workouts_by_name', (user_id, workout_name))
+
+    async def get_aggregate_workouts_by_id(self, user_id):
+        result = await self.named('get_aggregate_workouts_by_id', (user_id,))
+        for res in result:
+            format_aggregate_workout(res)
+        return result
+
+    async def get_aggregate_workouts_page(self, user_id, limit, before=None):
+        time_before, id_before = before or KEYSET_START
+        result = await self.named('get_aggregate_workouts_page', (user_id, time_before, time_before, id_before, limit))
+        cursor = page_cursor(result, limit)
+        for res in result:
+            format_aggregate_workout(res)
+        return result, cursor
+
+    async def get_workouts_page(self, user_id, limit, before=None):
+        time_before, id_before = before or KEYSET_START
+        result = await self.named('get_workouts_page', (user_id, time_before, time_before, id_before, limit))
+        return result, page_cursor(result, limit)
+
+    async def get_last_three_workouts(self, user_id):
+        result = await self.named('get_last_three_workouts', (user_id,))
+        for res in result:
+            format_aggregate_workout(res)
+        return result
+
+    async def find_all_workout_names(self, user_id):
+        return await self.named('find_all_workout_names', (user_id,))
+
+    async def get_total_meters(self, user_id):
+        return await self.named('get_total_meters', (user_id,), fetchone=True)
+
+    async def get_names(self):
+        result = await self.named('get_names', fetchone=True)
+        return result['names'] if result else None
+
+    async def get_emails(self):
+        result = await self.named('get_emails', fetchone=True)
+        return result['emails'] if result else None
+
+    async def get_leader_board(self, date, teams=None, user_ids=None, use_rollup=False):
+        if user_ids is not None and not user_ids:
+            return []
+        return await self.named(*leader_board_query(None, date, teams, user_ids, use_rollup))
+
+    async def get_leader_board_top(self, date, username, k=5, teams=None, user_ids=None, use_rollup=False):
+        if user_ids is not None and not user_ids:
+            return []
+        name, params = leader_board_query('top', date, teams, user_ids, use_rollup)
+        return await self.named(name, params + (k, username))
+
+    async def get_leader_board_window(self, start, end, username, k=5, teams=None, user_ids=None):
+        if user_ids is not None and not user_ids:
+            return []
+        name, params = window_leader_board_query(start, end, teams, user_ids)
+        return await self.named(name, params + (k, username))
+
+    async def get_leader_board_archive(self, week_start, username, k=5):
+        return await self.named('get_leader_board_archive', (week_start, k, username))
+
+    async def get_leader_board_archive_weeks(self, week_start):
+        return await self.named('get_leader_board_archive_weeks', (week_start, week_start), fetchone=True)
+
+    async def get_leader_board_meters(self, date, use_rollup=False):
+        return await self.named(*leader_board_query('meters', date, use_rollup=use_rollup))
+
+    async def get_leader_board_minutes(self, date, use_rollup=False):
+        return await self.named(*leader_board_query('minutes', date, use_rollup=use_rollup))
+
+    async def get_leader_board_split(self, date, use_rollup=False):
+        return await self.named(*leader_board_query('split', date, use_rollup=use_rollup))
+
+    async def get_heat_map_calendar_results(self, user_id, start=None, end=None):
+        return await self.named('get_heat_map_calendar_results',
+                                (user_id, start or datetime.date.min, end or datetime.date.max))
+
+    def loop(self):
+        """
+        :return: the event loop the pool lives on, running on a background thread started by the first gather,
+        so processes that never fan out never start it
+        """
+        with self._thread_lock:
+            if self._thread is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='async-db', daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def gather(self, *coroutines):
+        """
+        runs coroutines concurrently on the background loop and waits for all of them; lets synchronous
+        request handlers fan out independent queries
+        :param coroutines: coroutines of this AsyncDatabase, e.g. async_db.get_user(1), async_db.get_names()
+        :return: a list of their results, in the same order
+        """
+        async def run_all():
+            return await asyncio.gather(*coroutines)
+
+        return asyncio.run_coroutine_threadsafe(run_all(), self.loop()).result()
+
+    def shutdown(self):
+        """
+        closes the pool on the background loop, then stops the loop and its thread; a later gather starts them again
+        :return: nothing
+        """
+        with self._thread_lock:
+            if self._thread is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+            self._pool_lock = None
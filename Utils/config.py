@@ -1,8 +1,13 @@
 import os
 import sys
 
-from Utils.db import Database
+from Utils.async_db import AsyncDatabase
+from Utils.db import Database, generate_connection_string
+from Utils.instrumentation import QueryStats
+from Utils.leader_board_cache import LeaderBoardCache
 from Utils.log import log
+from Utils.result_cache import ResultCache
+from Utils.slow_queries import SlowQueryLog
 
 TESTING = bool(os.environ.get('TESTING'))
 
@@ -11,9 +16,60 @@ try:
 except KeyError:
     DB_INIT = False
 
-log.info('DB_INIT: {}\nTESTING: {}\n'.format(DB_INIT, TESTING))
+# a pool is used when DB_POOL_MAX is set; otherwise every request shares one connection
+try:
+    DB_POOL_CONFIG = {
+        'max_size': int(os.environ['DB_POOL_MAX']),
+        'min_size': int(os.environ.get('DB_POOL_MIN', 1)),
+        'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+        'health_check_interval': float(os.environ.get('DB_POOL_HEALTH_CHECK', 30))
+    }
+except KeyError:
+    DB_POOL_CONFIG = None
+
+# server-side prepared statements can be switched off, e.g. behind a transaction-pooling proxy
+DB_PREPARE = os.environ.get('DB_PREPARE', 'true').lower() != 'false'
+
+# query text is only logged for a sampled fraction of statements and for slow ones
+SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', 0.5))
+QUERY_STATS = QueryStats(sample_rate=float(os.environ.get('QUERY_SAMPLE_RATE', 0)),
+                         slow_threshold=SLOW_QUERY_SECONDS)
+
+# slow statements can also be captured with an EXPLAIN ANALYZE plan
+if os.environ.get('SLOW_QUERY_EXPLAIN', 'false').lower() == 'true':
+    SLOW_QUERY_LOG = SlowQueryLog(threshold=SLOW_QUERY_SECONDS,
+                                  capacity=int(os.environ.get('SLOW_QUERY_CAPACITY', 100)))
+else:
+    SLOW_QUERY_LOG = None
+
+# read only analytics queries go to a replica when one is configured
+DB_REPLICA_URL = os.environ.get('DB_REPLICA_URL')
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+
+# repeated reads can be served from memory; only safe while this process makes every write
+try:
+    RESULT_CACHE = ResultCache(max_bytes=int(float(os.environ['RESULT_CACHE_MB']) * 1024 * 1024))
+except KeyError:
+    RESULT_CACHE = None
+
+# the weekly leader boards are kept until a workout write changes them, or this many seconds at most
+LEADER_BOARD_CACHE = LeaderBoardCache(max_age=float(os.environ.get('LEADER_BOARD_CACHE_SECONDS', 60)))
+
+log.info('DB_INIT: {}\nTESTING: {}\nDB_POOL: {}\nDB_PREPARE: {}\nDB_REPLICA: {}\n'.format(
+    DB_INIT, TESTING, DB_POOL_CONFIG, DB_PREPARE, bool(DB_REPLICA_URL)))
 
-db = Database(TESTING)
+db = Database(TESTING, pool_config=DB_POOL_CONFIG, prepare=DB_PREPARE, query_stats=QUERY_STATS,
+              slow_query_log=SLOW_QUERY_LOG, replica_dsn=DB_REPLICA_URL, read_your_writes=READ_YOUR_WRITES_SECONDS,
+              result_cache=RESULT_CACHE)
+
+# independent reads of one request are fanned out concurrently through an async pool when ASYNC_DB_POOL_MAX is set;
+# otherwise they run one after another on db. /team/history is the only request with such reads: the team page ranks
+# its three boards in one query, and the profile page's get_user runs in load_user before its own read
+try:
+    async_db = AsyncDatabase(generate_connection_string(TESTING), max_size=int(os.environ['ASYNC_DB_POOL_MAX']),
+                             query_stats=QUERY_STATS, database=db, leader_board_cache=LEADER_BOARD_CACHE)
+except KeyError:
+    async_db = None
 
 environ_twilio = True
 try:
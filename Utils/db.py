@@ -1,13 +1,25 @@
+import datetime
+import functools
+import inspect
 import os
 import re
 import sqlite3
 import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 
+import numpy as np
 import psycopg2
-from psycopg2 import extras, sql as SQL
+from psycopg2 import extensions, extras, sql as SQL
 
-from Utils import config
+from Utils import config, migrations
+from Utils.db_pool import ConnectionPool, connect
+from Utils.instrumentation import QueryStats
 from Utils.log import log
+from Utils.result_cache import cascaded_tables
+from Utils.statements import PreparedStatement, StatementRegistry
 
 
 def generate_connection_string(unit_test=False):
@@ -59,260 +71,965 @@ def set_where_clause(cols, operators=None):
     return SQL.SQL("{} {}").format(base, SQL.SQL(" ").join(where_col_to_str))
 
 
+def select_list(select_cols):
+    """
+    :param select_cols: the names of the columns to select, or ['ALL'] for '*'
+    :return: the composable select list
+    """
+    if list(select_cols) == ['ALL']:
+        return SQL.SQL('*')
+    return SQL.SQL(', ').join(map(SQL.Identifier, select_cols))
+
+
+def build_select(table_name, select_cols, where_cols=None, operators=None, order_by=None):
+    """
+    builds the query shape used by Database.select
+    :return: a composable 'SELECT ... FROM ... [WHERE ...] [ORDER BY ...]' with placeholders for the where params
+    """
+    sql = SQL.SQL("SELECT {} FROM {}").format(select_list(select_cols), SQL.Identifier(table_name))
+
+    if where_cols:
+        sql += SQL.SQL(" WHERE {}").format(set_where_clause(where_cols, operators))
+
+    if order_by:
+        sql += SQL.SQL(" ORDER BY {}").format(SQL.SQL(", ").join(map(SQL.Identifier, order_by)))
+
+    return sql
+
+
+def build_insert(table_name, col_names, pk):
+    """
+    builds the query shape used by Database.insert
+    :return: a composable 'INSERT ... RETURNING pk' with one placeholder per column
+    """
+    return SQL.SQL("insert into {} ({}) values ({}) returning {}").format(SQL.Identifier(table_name),
+                                                                         SQL.SQL(', ').join(
+                                                                             map(SQL.Identifier, col_names)),
+                                                                         SQL.SQL(', ').join(
+                                                                             SQL.Placeholder() * len(col_names)),
+                                                                         SQL.Identifier(pk))
+
+
+def build_update(table_name, update_cols, where_cols, operators=None):
+    """
+    builds the query shape used by Database.update
+    :return: a composable 'UPDATE ... SET ... WHERE ...' with placeholders for the set and where params
+    """
+    set_str = [SQL.SQL("{}={}").format(SQL.Identifier(col), SQL.Placeholder()) for col in update_cols]
+    set_str = SQL.SQL(", ").join(set_str)
+
+    where_str = set_where_clause(where_cols, operators)
+
+    return SQL.SQL("UPDATE {} SET {} WHERE {}").format(SQL.Identifier(table_name), set_str, where_str)
+
+
+# the cursor each row format reads with; 'columns' and 'numpy' are transposed after fetching
+ROW_CURSORS = {
+    'dict': extras.RealDictCursor,
+    'tuple': extensions.cursor,
+    'record': extras.NamedTupleCursor,
+    'columns': extensions.cursor,
+    'numpy': extensions.cursor
+}
+
+COLUMN_FORMATS = {'columns', 'numpy'}
+
+
+def to_columns(cur, rows, row_format):
+    """
+    :param cur: the cursor the rows were fetched from
+    :param rows: a list of tuples
+    :param row_format: 'columns' for a dictionary of lists, 'numpy' for a dictionary of numpy arrays
+    :return: a dictionary of column name to that column's values, in row order
+    """
+    names = [column[0] for column in cur.description]
+    values = list(zip(*rows)) if rows else [()] * len(names)
+    if row_format == 'numpy':
+        return {name: np.array(column) for name, column in zip(names, values)}
+    return {name: list(column) for name, column in zip(names, values)}
+
+
+# Database methods that only pass statements through; skipped when naming a statement's shape
+EXECUTE_HELPERS = {'execute', 'safe_execute', 'safe_execute_sql_only', 'safe_stream', 'fetch_all'}
+
+
+def read_only(method):
+    """
+    marks a Database query method as safe to run on the read replica; calls about a user who wrote
+    within the read-your-writes window, and calls made inside db.transaction(), stay on the primary
+    :param method: a Database method; if it takes a user_id argument that user's recent writes are honoured
+    :return: the wrapped method
+    """
+    params = list(inspect.signature(method).parameters)[1:]
+    user_index = params.index('user_id') if 'user_id' in params else None
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not self.has_replica() or self.in_transaction() or getattr(self._local, 'replica', False):
+            return method(self, *args, **kwargs)
+
+        user_id = kwargs.get('user_id')
+        if user_id is None and user_index is not None and user_index < len(args):
+            user_id = args[user_index]
+        if user_id is not None and self.recently_wrote(user_id):
+            return method(self, *args, **kwargs)
+
+        self._local.replica = True
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._local.replica = False
+
+    return wrapper
+
+
+def format_query(cur):
+    """
+    :param cur: a cursor that has run a statement
+    :return: the last statement sent on the cursor, with its parameters, on one line
+    """
+    query = cur.query
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return re.sub(r'\s+', ' ', str(query)).strip()
+
+
+def format_aggregate_workout(res):
+    """
+    converts an aggregated workout row for JSON and adds its average split
+    :param res: a row from get_aggregate_workouts_by_id or get_last_three_workouts
+    :return: the same row, modified in place
+    """
+    res['total_seconds'] = float(res['total_seconds'])
+    res['distance'] = float(res['distance'])
+    res['time'] = res['time'].strftime('%Y-%m-%dT%H:%M:00.000Z')
+    splits = float(res['distance']) / float(500)
+    res['avg_sec'] = format(((res['total_seconds'] / splits) % 60), '.2f')
+    res['avg_min'] = int(res['total_seconds'] / splits / 60)
+    return res
+
+
+def inserted_rows(col_names, col_params, pk, row_id):
+    """
+    :param col_names: the columns an insert set
+    :param col_params: their values
+    :param pk: the primary key column
+    :param row_id: the primary key of the new row
+    :return: the rows the insert wrote, as Database.invalidate takes them
+    """
+    rows = {col: {value} for col, value in zip(col_names, col_params)}
+    rows.setdefault(pk, set()).add(row_id)
+    return rows
+
+
+def updated_rows(update_cols, update_params, where_cols, where_params, operators=None):
+    """
+    an update identified by one column only touches the rows with that value, unless it changes the column
+    :return: the rows an update wrote, as Database.invalidate takes them, or None if it may have written any row
+    """
+    if len(where_cols) != 1 or (operators and operators[0] != '='):
+        return None
+    rows = {where_cols[0]: {where_params[0]}}
+    if where_cols[0] in update_cols:
+        rows[where_cols[0]].add(update_params[list(update_cols).index(where_cols[0])])
+    return rows
+
+
+def format_aggregate_columns(cols):
+    """
+    the column-oriented version of format_aggregate_workout; the split math runs once per column
+    :param cols: get_aggregate_workouts_by_id columns, as lists or numpy arrays
+    :return: the same dictionary, modified in place
+    """
+    if isinstance(cols['distance'], np.ndarray):
+        total_seconds = cols['total_seconds'].astype(float)
+        distance = cols['distance'].astype(float)
+        per_split = total_seconds / (distance / 500)
+        cols['total_seconds'] = total_seconds
+        cols['distance'] = distance
+        cols['avg_sec'] = np.char.mod('%.2f', per_split % 60)
+        cols['avg_min'] = (per_split // 60).astype(int)
+        cols['time'] = np.array([stamp.strftime('%Y-%m-%dT%H:%M:00.000Z') for stamp in cols['time']])
+        return cols
+
+    cols['total_seconds'] = [float(t) for t in cols['total_seconds']]
+    cols['distance'] = [float(d) for d in cols['distance']]
+    per_split = [t / (d / 500) for t, d in zip(cols['total_seconds'], cols['distance'])]
+    cols['avg_sec'] = [format(p % 60, '.2f') for p in per_split]
+    cols['avg_min'] = [int(p / 60) for p in per_split]
+    cols['time'] = [stamp.strftime('%Y-%m-%dT%H:%M:00.000Z') for stamp in cols['time']]
+    return cols
+
+
+# cursor that sorts after every (time, workout_id) key, so the first page uses the same query as the rest
+KEYSET_START = (datetime.datetime.max, 2147483647)
+
+
+def page_cursor(rows, limit):
+    """
+    :param rows: one page of rows, newest first, each with the raw 'time' and 'workout_id' of its workout
+    :param limit: the page size in workouts
+    :return: the (time, workout_id) cursor of the next page, or None if this is the last page
+    """
+    if len({row['workout_id'] for row in rows}) < limit:
+        return None
+    return rows[-1]['time'], rows[-1]['workout_id']
+
+
+# the named queries behind the Database methods of the same name, shared with AsyncDatabase; each {} is a parameter.
+# per workout averages come from the totals the erg triggers keep on each workout row (migration 0005)
+# workout and erg are partitioned by month (migration 0008): erg joins match on workout_time too, and time bounds are
+# repeated on both tables so the planner skips the other months
+QUERIES = {
+    'get_workouts': '''
+        SELECT *
+        FROM workout AS w
+        JOIN erg AS e
+        ON e.workout_id = w.workout_id
+        AND e.workout_time = w.time
+        WHERE w.user_id={}
+        ORDER BY w.time DESC''',
+    'get_workouts_page': '''
+        SELECT *
+        FROM (SELECT *
+              FROM workout
+              WHERE user_id={}
+              AND time <= {}
+              AND (time, workout_id) < ({}, {})
+              ORDER BY time DESC, workout_id DESC
+              LIMIT {}) AS w
+        JOIN erg AS e
+        ON e.workout_id = w.workout_id
+        AND e.workout_time = w.time
+        ORDER BY w.time DESC, w.workout_id DESC, e.erg_id''',
+    'get_workouts_by_id': '''
+        SELECT *, to_char(time, 'yyyy-mm-ddThh24:mi:ss.000Z') as time
+        FROM workout AS w
+        JOIN erg AS e
+        ON e.workout_id = w.workout_id
+        AND e.workout_time = w.time
+        WHERE w.user_id={}
+        AND e.workout_id={}
+        ORDER BY e.erg_id''',
+    'get_aggregate_workouts_by_name': '''
+        SELECT avg_distance AS distance, avg_seconds AS total_seconds, workout_id, time, by_distance
+        FROM workout
+        WHERE user_id={}
+        AND name={}
+        AND piece_count > 0
+        ORDER BY time''',
+    'get_aggregate_workouts_by_id': '''
+        SELECT avg_distance AS distance, avg_seconds AS total_seconds, workout_id, time, by_distance, name
+        FROM workout
+        WHERE user_id={}
+        AND piece_count > 0
+        ORDER BY time DESC''',
+    'get_aggregate_workouts_page': '''
+        SELECT avg_distance AS distance, avg_seconds AS total_seconds, workout_id, time, by_distance, name
+        FROM workout
+        WHERE user_id={}
+        AND time <= {}
+        AND (time, workout_id) < ({}, {})
+        AND piece_count > 0
+        ORDER BY time DESC, workout_id DESC
+        LIMIT {}''',
+    'find_all_workout_names': '''
+        SELECT DISTINCT name
+        FROM workout
+        WHERE user_id={}
+        GROUP BY name
+        HAVING COUNT(workout_id) > 1''',
+    'get_total_meters': '''
+        SELECT SUM(total_distance) AS total_meters
+        FROM workout
+        WHERE user_id={}
+        GROUP BY user_id''',
+    'get_user': '''
+        SELECT *
+        FROM users as u
+        JOIN profile as p
+        ON u.user_id = p.user_id
+        WHERE u.user_id={}''',
+    'get_names': 'SELECT ARRAY_AGG(username) as names FROM users',
+    'get_emails': 'SELECT ARRAY_AGG(email) as emails FROM users',
+    'get_leader_board_meters': '''
+        SELECT SUM(tbl.distance) AS total_meters,  u.username
+        FROM (
+            SELECT distance, user_id
+            FROM workout AS w
+            JOIN erg AS e
+            ON w.workout_id = e.workout_id
+            AND e.workout_time = w.time
+            WHERE w.time>{}
+            AND e.workout_time>{}
+            ) AS tbl
+        JOIN users AS u
+        ON u.user_id = tbl.user_id
+        GROUP BY u.username
+        ORDER BY total_meters DESC''',
+    'get_leader_board_minutes': '''
+        SELECT (SUM(tbl.minutes) * 60) + SUM(tbl.seconds) AS total_seconds,  u.username
+        FROM (
+            SELECT user_id, minutes, seconds
+            FROM workout AS w
+            JOIN erg AS e
+            ON w.workout_id = e.workout_id
+            AND e.workout_time = w.time
+            WHERE w.time>{}
+            AND e.workout_time>{}
+            ) AS tbl
+        JOIN users AS u
+        ON u.user_id = tbl.user_id
+        GROUP BY u.username
+        ORDER BY total_seconds DESC''',
+    'get_leader_board_split': '''
+        SELECT (((SUM(tbl.minutes) * 60) + SUM(tbl.seconds))::FLOAT / SUM(tbl.distance)) * 500 AS split,  u.username
+        FROM (
+            SELECT user_id, minutes, seconds, distance
+            FROM workout AS w
+            JOIN erg AS e
+            ON w.workout_id = e.workout_id
+            AND e.workout_time = w.time
+            WHERE w.time>{}
+            AND e.workout_time>{}
+            ) AS tbl
+        JOIN users AS u
+        ON u.user_id = tbl.user_id
+        GROUP BY u.username
+        ORDER BY split''',
+    'get_leader_board': '''
+        SELECT u.username,
+               SUM(w.total_distance)::BIGINT AS total_meters,
+               SUM(w.total_seconds) AS total_seconds,
+               (SUM(w.total_seconds) / NULLIF(SUM(w.total_distance), 0)::FLOAT) * 500 AS split
+        FROM workout AS w
+        JOIN users AS u
+        ON u.user_id = w.user_id
+        WHERE w.time>{}
+        AND w.piece_count > 0
+        GROUP BY u.username''',
+    'get_leader_board_week': '''
+        SELECT u.username,
+               SUM(lb.meters)::BIGINT AS total_meters,
+               SUM(lb.seconds) AS total_seconds,
+               (SUM(lb.seconds) / NULLIF(SUM(lb.meters), 0)::FLOAT) * 500 AS split
+        FROM leader_board_week AS lb
+        JOIN users AS u
+        ON u.user_id = lb.user_id
+        WHERE lb.week_start >= {}
+        GROUP BY u.username''',
+    'get_leader_board_window': '''
+        SELECT u.username,
+               hi.cum_meters - COALESCE(lo.cum_meters, 0) AS total_meters,
+               hi.cum_seconds - COALESCE(lo.cum_seconds, 0) AS total_seconds,
+               ((hi.cum_seconds - COALESCE(lo.cum_seconds, 0))
+                / NULLIF(hi.cum_meters - COALESCE(lo.cum_meters, 0), 0)::FLOAT) * 500 AS split
+        FROM users AS u
+        JOIN LATERAL (
+            SELECT cum_workouts, cum_meters, cum_seconds
+            FROM daily_activity
+            WHERE user_id = u.user_id
+            AND day <= {}
+            ORDER BY day DESC
+            LIMIT 1
+        ) AS hi ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT cum_workouts, cum_meters, cum_seconds
+            FROM daily_activity
+            WHERE user_id = u.user_id
+            AND day < {}
+            ORDER BY day DESC
+            LIMIT 1
+        ) AS lo ON TRUE
+        WHERE hi.cum_workouts > COALESCE(lo.cum_workouts, 0)
+        ORDER BY u.username''',
+    'archive_leader_board_weeks': '''
+        SELECT COALESCE(SUM(archive_leader_board_week(week_start)), 0) AS archived
+        FROM (
+            SELECT DISTINCT lb.week_start
+            FROM leader_board_week AS lb
+            WHERE lb.week_start < {}
+            AND NOT EXISTS (SELECT 1 FROM leader_board_archive AS a WHERE a.week_start = lb.week_start)
+        ) AS finished''',
+    'get_leader_board_archive': '''
+        SELECT username, total_meters, total_seconds, split, meters_rank, minutes_rank, split_rank,
+               meters_place, minutes_place, split_place
+        FROM leader_board_archive
+        WHERE week_start = {}
+        AND (LEAST(meters_place, minutes_place, split_place) <= {}
+             OR username = {})''',
+    'get_leader_board_archive_weeks': '''
+        SELECT (SELECT MAX(week_start) FROM leader_board_archive WHERE week_start < {}) AS previous,
+               (SELECT MIN(week_start) FROM leader_board_archive WHERE week_start > {}) AS next''',
+    'get_activity_today': '''
+        SELECT activity_day((now() AT TIME ZONE 'UTC')::TIMESTAMP) AS today''',
+    'get_leader_board_week_meters': '''
+        SELECT SUM(lb.meters)::BIGINT AS total_meters, u.username
+        FROM leader_board_week AS lb
+        JOIN users AS u
+        ON u.user_id = lb.user_id
+        WHERE lb.week_start >= {}
+        GROUP BY u.username
+        ORDER BY total_meters DESC''',
+    'get_leader_board_week_minutes': '''
+        SELECT SUM(lb.seconds) AS total_seconds, u.username
+        FROM leader_board_week AS lb
+        JOIN users AS u
+        ON u.user_id = lb.user_id
+        WHERE lb.week_start >= {}
+        GROUP BY u.username
+        ORDER BY total_seconds DESC''',
+    'get_leader_board_week_split': '''
+        SELECT (SUM(lb.seconds) / NULLIF(SUM(lb.meters), 0)::FLOAT) * 500 AS split, u.username
+        FROM leader_board_week AS lb
+        JOIN users AS u
+        ON u.user_id = lb.user_id
+        WHERE lb.week_start >= {}
+        GROUP BY u.username
+        ORDER BY split''',
+    'get_profile_stats': '''
+        SELECT weight, height, show_age, show_height, show_weight, EXTRACT(YEAR FROM AGE(birthday))::INTEGER AS age
+        FROM profile
+        WHERE user_id={}''',
+    'get_heat_map_calendar_results': '''
+        SELECT day AS date, workouts AS count, meters, seconds / 60 AS minutes
+        FROM daily_activity
+        WHERE user_id={}
+        AND day BETWEEN {} AND {}
+        ORDER BY day''',
+    'get_last_three_workouts': '''
+        SELECT avg_distance AS distance, avg_seconds AS total_seconds, workout_id, time, by_distance, name
+        FROM workout
+        WHERE user_id={}
+        AND piece_count > 0
+        ORDER BY time DESC
+        LIMIT 3''',
+}
+
+
+def top_of_leader_board(totals):
+    """
+    wraps a leader board query with a rank on each board, keeping only the rows placed in the top k of any
+    board plus the row of one athlete; the parameters of the totals come first, then k and the username
+    :param totals: a query with username, total_meters, total_seconds and split per athlete
+    :return: the query text
+    """
+    # rank is shown to the athlete, place breaks ties by name so each board has exactly k rows in its top k
+    return '''
+        SELECT *
+        FROM (
+            SELECT totals.*,
+                   rank() OVER (ORDER BY total_meters DESC) AS meters_rank,
+                   rank() OVER (ORDER BY total_seconds DESC) AS minutes_rank,
+                   rank() OVER (ORDER BY split NULLS LAST) AS split_rank,
+                   row_number() OVER (ORDER BY total_meters DESC, username) AS meters_place,
+                   row_number() OVER (ORDER BY total_seconds DESC, username) AS minutes_place,
+                   row_number() OVER (ORDER BY split NULLS LAST, username) AS split_place
+            FROM (''' + totals + '''
+            ) AS totals
+        ) AS ranked
+        WHERE LEAST(meters_place, minutes_place, split_place) <= {}
+        OR username = {}'''
+
+
+# squad boards rank only some athletes: a list of teams, or a list of user ids
+LEADER_BOARD_SCOPES = {
+    'team': 'AND u.team = ANY({})',
+    'group': 'AND u.user_id = ANY({})'
+}
+
+
+def scoped_leader_board(totals, scope):
+    """
+    :param totals: a leader board query over users AS u, ending in its GROUP BY or ORDER BY line
+    :param scope: a key of LEADER_BOARD_SCOPES
+    :return: the query text, limited to the athletes of the scope; its parameter follows the cutoff
+    """
+    head, group_by = totals.rsplit('\n', 1)
+    return head + '\n        ' + LEADER_BOARD_SCOPES[scope] + '\n' + group_by
+
+
+for _totals in ['get_leader_board', 'get_leader_board_week', 'get_leader_board_window']:
+    for _scope in LEADER_BOARD_SCOPES:
+        QUERIES[_totals + '_' + _scope] = scoped_leader_board(QUERIES[_totals], _scope)
+    for _scope in [None] + list(LEADER_BOARD_SCOPES):
+        _name = _totals + ('_' + _scope if _scope else '')
+        QUERIES[_name + '_top'] = top_of_leader_board(QUERIES[_name])
+
+
+def leader_board_scope(teams, user_ids):
+    """
+    :param teams: optional; a list of team codes
+    :param user_ids: optional; a list of user ids
+    :return: a (query name suffix, params) tuple for the scope
+    """
+    if teams is not None and user_ids is not None:
+        raise ValueError('a leader board is scoped by teams or by user ids, not both')
+    if teams is not None:
+        return '_team', (list(teams),)
+    if user_ids is not None:
+        return '_group', ([int(user_id) for user_id in user_ids],)
+    return '', ()
+
+
+def window_leader_board_query(start, end, teams=None, user_ids=None):
+    """
+    the ranked top of each board over the days start through end, from the running totals of daily_activity
+    :param start: the first local day of the window
+    :param end: the last local day of the window
+    :param teams: optional; only rank athletes of these teams
+    :param user_ids: optional; only rank these athletes
+    :return: a (query name, params) tuple; k and the username follow these params
+    """
+    scope, scope_params = leader_board_scope(teams, user_ids)
+    return 'get_leader_board_window' + scope + '_top', (end, start) + scope_params
+
+
+def leader_board_query(board, date, teams=None, user_ids=None, use_rollup=False):
+    """
+    picks the query for a leader board, read from the workouts themselves or from the weekly rollup
+    :param board: 'meters', 'minutes' or 'split'; None for all three columns in one unsorted query, or 'top'
+    for the ranked top of each board
+    :param date: the datetime cutoff
+    :param teams: optional; only rank athletes of these teams, e.g. ['vm', 'nm']. not for single boards
+    :param user_ids: optional; only rank these athletes. not for single boards
+    :param use_rollup: true to read the weekly rollup; date must then end a week, as get_last_sunday makes it
+    :return: a (query name, params) tuple; 'top' takes k and the username after these params
+    """
+    scope, scope_params = leader_board_scope(teams, user_ids)
+    if scope and board in ('meters', 'minutes', 'split'):
+        raise ValueError('single boards are not scoped; use get_leader_board_top')
+
+    suffix = scope + ('_' + board if board else '')
+    if use_rollup:
+        week_start = date + datetime.timedelta(seconds=1)
+        if week_start.isoweekday() != 1 or week_start.time() != datetime.time.min:
+            raise ValueError('the weekly rollup needs a cutoff at the end of a sunday, not {}'.format(date))
+        return 'get_leader_board_week' + suffix, (week_start.date(),) + scope_params
+    if board in ('meters', 'minutes', 'split'):
+        return 'get_leader_board' + suffix, (date, date)
+    return 'get_leader_board' + suffix, (date,) + scope_params
+
+
+def build_named_query(name):
+    """
+    :param name: a key of QUERIES
+    :return: the query as a Composable with a Placeholder for each of its parameters
+    """
+    query = QUERIES[name]
+    return SQL.SQL(query).format(*[SQL.Placeholder()] * query.count('{}'))
+
+
 class Database:
-    def __init__(self, unit_test=False):
+    def __init__(self, unit_test=False, pool_config=None, prepare=True, itersize=2000, query_stats=None,
+                 slow_query_log=None, replica_dsn=None, read_your_writes=5.0, result_cache=None):
         """
 
         :param unit_test: a boolean; true if a connection to the unit test db should be opened
+        :param pool_config: optional dictionary of ConnectionPool keyword arguments (min_size, max_size,
+        timeout, health_check_interval); when given, every statement checks out its own pooled connection
+        instead of sharing self.conn
+        :param prepare: true if query shapes should run as server-side prepared statements
+        :param itersize: default number of rows streaming queries fetch from the server per round trip
+        :param query_stats: optional QueryStats collecting per-statement timings; a default one is created if omitted
+        :param slow_query_log: optional SlowQueryLog; statements over its threshold are captured with their plan
+        :param replica_dsn: optional connection string of a read replica; methods marked @read_only run there
+        :param read_your_writes: seconds after mark_write(user_id) during which that user's reads stay on the primary
+        :param result_cache: optional ResultCache for the results of get_user, get_names, get_emails,
+        find_all_workout_names and select; insert, update and delete_entry invalidate it
         """
+        self.conn = None
+        self.pool = None
+        self.statements = StatementRegistry(prepare)
+        self._local = threading.local()
+        self._column_types = {}
+        self.itersize = itersize
+        self.query_stats = query_stats or QueryStats()
+        self.slow_query_log = slow_query_log
+        self.replica_conn = None
+        self.replica_pool = None
+        self.read_your_writes = read_your_writes
+        self._recent_writes = {}
+        self._writes_lock = threading.Lock()
+        self.result_cache = result_cache
+        # the first days of the months this process made sure have their partitions
+        self._partitioned_months = set()
         try:
             connect_str = generate_connection_string(unit_test)
-            self.conn = psycopg2.connect(connect_str, cursor_factory=extras.RealDictCursor)
+            if slow_query_log is not None:
+                slow_query_log.start(connect_str, replica_dsn)
+            if pool_config:
+                self.pool = ConnectionPool(connect_str, **pool_config)
+            else:
+                self.conn = connect(connect_str)
+            if replica_dsn:
+                if pool_config:
+                    self.replica_pool = ConnectionPool(replica_dsn, **pool_config)
+                else:
+                    self.replica_conn = connect(replica_dsn)
             if config.DB_INIT:
                 self.init_tables()
+                self.ensure_partitions()
+                self.archive_leader_board_weeks()
+            elif migrations.check(self):
+                self.ensure_partitions()
             log.info('Return new database object from connect_str: {}'.format(connect_str))
         except sqlite3.Error as e:
             log.error(e, exc_info=True)
             self.conn = None
 
     def valid_connection(self):
-        if self.conn is not None:
+        if self.conn is not None or self.pool is not None:
             return True
         return False
 
-    def safe_execute(self, sql_statement, params=None, fetchone=True):
+    def has_replica(self):
+        return self.replica_conn is not None or self.replica_pool is not None
+
+    def close(self):
         """
+        closes the connections and pools of the primary and the replica, and stops the slow query log's worker
+        :return: nothing
+        """
+        for pool in (self.pool, self.replica_pool):
+            if pool is not None:
+                pool.closeall()
+        for conn in (self.conn, self.replica_conn):
+            if conn is not None:
+                conn.close()
+        if self.slow_query_log is not None:
+            self.slow_query_log.stop()
+
+    def mark_write(self, user_id):
+        """
+        start the read-your-writes window for a user, so their next reads see what they just wrote
+        even while the replica is catching up
+        :param user_id: the user whose data was written
+        :return: nothing
+        """
+        if not self.has_replica():
+            return
+        now = time.monotonic()
+        with self._writes_lock:
+            if len(self._recent_writes) > 1000:
+                self._recent_writes = {k: v for k, v in self._recent_writes.items() if v > now}
+            self._recent_writes[user_id] = now + self.read_your_writes
+
+    def recently_wrote(self, user_id):
+        """
+        :param user_id: a user id
+        :return: true if mark_write was called for the user within the read-your-writes window
+        """
+        deadline = self._recent_writes.get(user_id)
+        return deadline is not None and deadline > time.monotonic()
 
-        :return:
+    def cached(self, key, deps, run):
         """
+        returns a read's result from the result cache, running and caching it on a miss; reads inside
+        db.transaction() may see uncommitted rows, so they skip the cache
+        :param key: a hashable statement shape and parameters
+        :param deps: the rows the read depends on; (table, None) for a whole table or (table, column, value)
+        :param run: a function running the read
+        :return: the result of the read
+        """
+        if self.result_cache is None or self.in_transaction():
+            return run()
 
-        log.info("Is valid connection? -- {}".format(self.valid_connection()))
+        hit, value = self.result_cache.get(key)
+        if hit:
+            return value
 
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute(sql_statement, params)
-                log.info((re.sub('[\s]{2,}', '', str(cur.query))).replace('\\n', ''))
-                if fetchone:
-                    return cur.fetchone()
-                return cur.fetchall()
-
-        except psycopg2.InternalError or psycopg2.OperationalError as e:
-            self.conn.rollback()
-            log.error(e)
-            log.error(sql_statement)
-            log.error(params)
-            log.error('roll back required')
-            return None
+        token = self.result_cache.token(deps)
+        value = run()
+        self.result_cache.put(key, value, deps, token)
+        return value
 
-    def safe_execute_sql_only(self, sql_statement, params=None):
+    def invalidate(self, table, rows=None, cascade=False):
+        """
+        drop cached results a write could have changed
+        :param table: the table written to
+        :param rows: optional dictionary of column to the values identifying the written rows; see
+        ResultCache.invalidate
+        :param cascade: true for deletes; every table the delete cascades to is invalidated too. the tables
+        the write reaches through triggers always are
+        :return: nothing
+        """
+        if self.result_cache is None:
+            return
+
+        targets = [(table, rows)]
+        targets.extend((child, None) for child in cascaded_tables(table, cascade))
+
+        for target, target_rows in targets:
+            self.result_cache.invalidate(target, target_rows)
+            if self.in_transaction():
+                self._local.invalidations.append((target, target_rows))
+
+    def in_transaction(self):
+        """
+        :return: true if the current thread is inside a db.transaction() block
+        """
+        return getattr(self._local, 'conn', None) is not None
+
+    @contextmanager
+    def transaction(self):
+        """
+        runs every statement in the block on one connection as a single unit of work; insert, update
+        and delete_entry stop committing on their own, the block commits once when it finishes and
+        rolls everything back if it raises. nested blocks join the outermost transaction
+        """
+        if self.in_transaction():
+            yield self
+            return
+
+        conn = self.pool.getconn() if self.pool is not None else self.conn
+        self._local.conn = conn
+        self._local.invalidations = []
+        discard = False
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(sql_statement, params)
-                log.info((re.sub('[\s]{2,}', '', str(cur.query))).replace('\\n', ''))
-
-        except psycopg2.InternalError as e:
-            self.conn.rollback()
-            log.error(e)
-            log.error(sql_statement)
-            log.error('roll back required')
-
-    def create_users(self):
-        # cur.execute("DROP TABLE IF EXISTS users")
-
-        sql = '''CREATE TABLE IF NOT EXISTS users ()'''
-        self.safe_execute_sql_only(sql)
-
-        column_list = [{'col_name': 'password', 'd_type': 'VARCHAR(255)', 'config': []},
-                       {'col_name': 'user_id', 'd_type': 'SERIAL', 'config': ['PRIMARY_KEY']},
-                       {'col_name': 'role', 'd_type': 'INTEGER', 'config': ['DEFAULT(1)']},
-                       {'col_name': 'first', 'd_type': 'VARCHAR(20)', 'config': ['NOT NULL']},
-                       {'col_name': 'last', 'd_type': 'VARCHAR(20)', 'config': ['NOT NULL']},
-                       {'col_name': 'username', 'd_type': 'VARCHAR(20)', 'config': ['NOT NULL', 'UNIQUE']},
-                       {'col_name': 'email', 'd_type': 'VARCHAR(255)', 'config': ['NOT NULL', 'UNIQUE']},
-                       {'col_name': 'confirm_email', 'd_type': 'Boolean', 'config': ['Default(False)']},
-                       {'col_name': 'address', 'd_type': 'VARCHAR(150)', 'config': []},
-                       {'col_name': 'city', 'd_type': 'VARCHAR(255)', 'config': []},
-                       {'col_name': 'state', 'd_type': 'VARCHAR(255)', 'config': []},
-                       {'col_name': 'zip', 'd_type': 'INTEGER', 'config': []},
-                       {'col_name': 'num_seats', 'd_type': 'INTEGER', 'config': ['DEFAULT(0)']},
-                       {'col_name': 'phone', 'd_type': 'BIGINT', 'config': []},
-                       {'col_name': 'team', 'd_type': 'VARCHAR(20)', 'config': []},
-                       {'col_name': 'x', 'd_type': 'REAL', 'config': []},
-                       {'col_name': 'y', 'd_type': 'REAL', 'config': []}]
-
-        for column in column_list:
-            self.add_column(table='users', col_name=column['col_name'],
-                            data_type=column['d_type'],
-                            config=column['config'])
+            yield self
+            conn.commit()
+            # other threads may have cached the old rows while the transaction was open
+            for table, rows in self._local.invalidations:
+                self.result_cache.invalidate(table, rows)
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self._local.conn = None
+            if self.pool is not None:
+                self.pool.putconn(conn, discard=discard)
+
+    @contextmanager
+    def connection(self):
+        """
+        yields the connection a statement should run on; inside a transaction that is the transaction's
+        connection, in pooled mode a connection is checked out for the block, committed when the block
+        succeeds and rolled back if it raises
+        """
+        if self.in_transaction():
+            yield self._local.conn
+            return
 
+        if getattr(self._local, 'replica', False):
+            with self.replica_connection() as conn:
+                yield conn
+            return
+
+        if self.pool is None:
+            yield self.conn
+            return
+
+        conn = self.pool.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self.pool.putconn(conn, discard=discard)
+
+    @contextmanager
+    def replica_connection(self):
+        """
+        yields a connection to the read replica; the read is committed when the block finishes so
+        the replica never holds an old snapshot open
+        """
+        pool = self.replica_pool
+        conn = pool.getconn() if pool is not None else self.replica_conn
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            if pool is not None:
+                pool.putconn(conn, discard=discard)
+
+    def commit(self):
+        """
+        commit the shared connection; pooled connections are committed as they are returned and
+        statements inside db.transaction() are committed when the block ends
+        :return: nothing
+        """
+        if self.pool is None and not self.in_transaction():
             self.conn.commit()
 
-    def add_column(self, table='', col_name='', data_type='', config=[]):
-        sql = '''ALTER TABLE {} ADD {} {}'''.format(table, col_name, data_type, ' '.join(config))
+    def named_query(self, name):
+        """
+        :param name: a key of QUERIES
+        :return: the PreparedStatement for the named query
+        """
+        return self.statements.get((name,), lambda: build_named_query(name))
 
+    @contextmanager
+    def instrument(self, cur, shape, query=None, params=None, replica=None):
+        """
+        times the statement(s) run on cur inside the block and records them under shape in self.query_stats
+        :param cur: the cursor the statement runs on
+        :param shape: a label for the statement shape
+        :param query: optional; the statement, so a slow run can be handed to the slow query log
+        :param params: optional; the statement's parameters
+        :param replica: optional; true if cur is on the read replica. defaults to whether a @read_only
+        method is running
+        """
+        start = time.perf_counter()
         try:
-            self.safe_execute_sql_only(sql)
-        except psycopg2.ProgrammingError as e:
-            log.error('{}'.format(e))
-
-    def create_profile(self):
-        # cur.execute("DROP TABLE IF EXISTS profile")
-
-        sql = '''CREATE TABLE IF NOT EXISTS profile (
-                        user_id INTEGER      UNIQUE PRIMARY KEY NOT NULL,
-                        picture VARCHAR(255) NOT NULL DEFAULT ('defaults/profile.jpg'),
-                        bio     VARCHAR(250) NOT NULL,
-                        birthday     DATE,
-                        height  DOUBLE PRECISION      DEFAULT(0),
-                        weight  DOUBLE PRECISION      DEFAULT(0),
-                        show_age BOOLEAN     DEFAULT(FALSE),
-                        show_height BOOLEAN  DEFAULT(FALSE),
-                        show_weight BOOLEAN DEFAULT(FALSE)
-              );'''
-        self.safe_execute_sql_only(sql)
-        self.conn.commit()
-
-        # trigger on profile
-        sql = '''CREATE OR REPLACE FUNCTION remove_user() RETURNS trigger AS
-                $$
-                BEGIN
-                    DELETE FROM users
-                    WHERE users.user_id = old.user_id;
-                    RETURN NEW;
-                END;
-                $$
-                LANGUAGE plpgsql;
-                '''
-
-        self.safe_execute_sql_only(sql)
-
-        self.safe_execute_sql_only("DROP TRIGGER IF EXISTS delete_user on profile;")
-
-        sql = '''CREATE TRIGGER delete_user
-                     AFTER DELETE
-                     ON profile
-                     FOR EACH ROW
-                     EXECUTE PROCEDURE remove_user();'''
-
-        self.safe_execute_sql_only(sql)
-
-        # trigger on user
-        sql = '''CREATE OR REPLACE FUNCTION remove_profile() RETURNS trigger AS
-                $$
-                BEGIN
-                    DELETE FROM profile
-                    WHERE profile.user_id IN (old.user_id);
-                    RETURN NEW;
-                END;
-                $$
-                LANGUAGE plpgsql;
-                '''
-
-        self.safe_execute_sql_only(sql)
-
-        self.safe_execute_sql_only("DROP TRIGGER IF EXISTS delete_profile on users;")
-
-        sql = '''CREATE TRIGGER delete_profile
-                     AFTER DELETE
-                     ON users
-                     FOR EACH ROW
-                     EXECUTE PROCEDURE remove_profile();'''
-
-        self.safe_execute_sql_only(sql)
-        self.conn.commit()
-
-    def create_workouts(self):
-        # cur.execute("DROP TABLE IF EXISTS workout")
-
-        sql = '''CREATE TABLE IF NOT EXISTS workout (
-                    workout_id  SERIAL         PRIMARY KEY,
-                    user_id     INTEGER        NOT NULL,
-                    time        TIMESTAMP      NOT NULL,
-                    by_distance BOOLEAN        NOT NULL,
-                    name        VARCHAR(25)    NOT NULL
-                );'''
-
-        self.safe_execute_sql_only(sql)
-
-        # remove  pieces in workout if workout is deleted
-
-        sql = '''CREATE OR REPLACE FUNCTION remove_all_pieces() RETURNS trigger AS
-                $$
-                BEGIN
-                  DELETE FROM erg
-                    WHERE erg.workout_id IN (
-                        SELECT erg.workout_id
-                        FROM erg
-                        WHERE erg.workout_id = old.workout_id
-                    );
-                    RETURN NEW;
-                END;
-                $$
-                LANGUAGE plpgsql;
-                '''
-
-        self.safe_execute_sql_only(sql)
-
-        self.safe_execute_sql_only("DROP TRIGGER IF EXISTS delete_all_pieces on workout;")
-
-        sql = '''CREATE TRIGGER delete_all_pieces
-                     AFTER DELETE
-                     ON workout
-                     FOR EACH ROW
-                     EXECUTE PROCEDURE remove_all_pieces();'''
-
-        self.safe_execute_sql_only(sql)
-        self.conn.commit()
-
-    def create_erg(self):
-        sql = '''CREATE TABLE IF NOT EXISTS erg (
-                    erg_id     SERIAL  NOT NULL PRIMARY KEY,
-                    workout_id INTEGER NOT NULL,
-                    distance   INTEGER NOT NULL,
-                    minutes    INTEGER NOT NULL,
-                    seconds    FLOAT NOT NULL
-                );'''
-
-        self.safe_execute_sql_only(sql)
-
-        sql = '''CREATE OR REPLACE FUNCTION remove_workouts_without_pieces() RETURNS trigger AS
-                $$
-                BEGIN
-                    DELETE FROM workout
-                    WHERE workout.workout_id NOT IN (
-                        SELECT erg.workout_id
-                        FROM erg
-                        GROUP BY erg.workout_id
-                    );
-                    RETURN NEW;
-                END
-                $$
-                LANGUAGE plpgsql;
-              '''
-
-        self.safe_execute_sql_only(sql)
-
-        self.safe_execute_sql_only("DROP TRIGGER IF EXISTS delete_workouts_without_pieces on erg;")
-
-        sql = '''CREATE TRIGGER delete_workouts_without_pieces
-                 AFTER DELETE
-                 ON erg
-                 EXECUTE PROCEDURE remove_workouts_without_pieces();'''
-
-        self.safe_execute_sql_only(sql)
-
-        self.conn.commit()
+            yield
+        except psycopg2.Error:
+            self.query_stats.record(shape, time.perf_counter() - start, error=True,
+                                    query_text=lambda: format_query(cur))
+            raise
+        duration = time.perf_counter() - start
+        self.query_stats.record(shape, duration, cur.rowcount, query_text=lambda: format_query(cur))
+
+        if query is not None and self.slow_query_log is not None and duration >= self.slow_query_log.threshold:
+            bound = cur.mogrify(query, params)
+            if replica is None:
+                replica = getattr(self._local, 'replica', False)
+            self.slow_query_log.submit(shape, duration, bound.decode('utf-8', 'replace'), replica)
+
+    def execute(self, cur, sql_statement, params=None, shape=None, replica=None):
+        """
+        run a statement on a cursor, going through the statement registry for registered query shapes
+        :param cur: an open cursor
+        :param sql_statement: a PreparedStatement, a composable or a string
+        :param params: the query parameters
+        :param shape: optional label for the statistics; defaults to the statement's registry label, or else
+        the name of the Database method that issued it
+        :param replica: optional; true if cur is on the read replica, see instrument
+        :return: nothing; results are read from the cursor
+        """
+        if isinstance(sql_statement, PreparedStatement):
+            with self.instrument(cur, shape or sql_statement.label, sql_statement.query, params, replica):
+                self.statements.execute(cur, sql_statement, params)
+        else:
+            if shape is None:
+                # label ad hoc statements with the query method that issued them
+                frame = sys._getframe(1)
+                while frame.f_code.co_name in EXECUTE_HELPERS:
+                    frame = frame.f_back
+                shape = frame.f_code.co_name
+            with self.instrument(cur, shape, sql_statement, params, replica):
+                cur.execute(sql_statement, params)
 
-    def init_tables(self):
+    def safe_execute(self, sql_statement, params=None, fetchone=True, row_format='dict'):
         """
-        sets up the database by calling functions to create each table
-        and its relevant triggers
+
+        :param row_format: 'dict' (the default), 'tuple', 'record' (namedtuples), 'columns' (a dictionary of
+        lists) or 'numpy' (a dictionary of numpy arrays)
         :return:
         """
-        self.create_users()
-        self.create_workouts()
-        self.create_erg()
-        self.create_profile()
+
+        with self.connection() as conn:
+            try:
+                with conn.cursor(cursor_factory=ROW_CURSORS[row_format]) as cur:
+                    self.execute(cur, sql_statement, params)
+                    if row_format in COLUMN_FORMATS:
+                        rows = cur.fetchall()
+                        return to_columns(cur, rows[:1] if fetchone else rows, row_format)
+                    if fetchone:
+                        return cur.fetchone()
+                    return cur.fetchall()
+
+            except psycopg2.InternalError or psycopg2.OperationalError as e:
+                if self.in_transaction():
+                    # let transaction() roll back the whole unit of work
+                    raise
+                conn.rollback()
+                log.error(e)
+                log.error(sql_statement)
+                log.error(params)
+                log.error('roll back required')
+                return None
+
+    def safe_execute_sql_only(self, sql_statement, params=None):
+        with self.connection() as conn:
+            try:
+                with conn.cursor() as cur:
+                    self.execute(cur, sql_statement, params)
+
+            except psycopg2.InternalError as e:
+                if self.in_transaction():
+                    raise
+                conn.rollback()
+                log.error(e)
+                log.error(sql_statement)
+                log.error('roll back required')
+
+    def safe_stream(self, sql_statement, params=None, itersize=None, row_format='dict'):
+        """
+        runs a query through a named server-side cursor and yields its rows lazily, so only itersize
+        rows are held in memory at a time; the connection stays in use until the generator is exhausted or closed
+        :param sql_statement: a PreparedStatement, a composable or a string; must be a SELECT
+        :param params: the query parameters
+        :param itersize: optional; rows fetched per round trip, defaults to self.itersize
+        :param row_format: 'dict', 'tuple' or 'record'
+        :return: a generator of rows
+        """
+        if row_format in COLUMN_FORMATS:
+            raise ValueError('cannot stream rows as {}'.format(row_format))
+        # the generator body runs after a @read_only method has returned, so decide where it runs now
+        return self._stream(sql_statement, params, itersize, getattr(self._local, 'replica', False), row_format)
+
+    def _stream(self, sql_statement, params, itersize, replica, row_format):
+        # DECLARE cannot wrap an EXECUTE, so prepared shapes run their underlying query here
+        shape = 'stream'
+        if isinstance(sql_statement, PreparedStatement):
+            shape = 'stream:' + sql_statement.label
+            sql_statement = sql_statement.query
+
+        with (self.replica_connection() if replica else self.connection()) as conn:
+            # WITH HOLD keeps the cursor open across commits made by other statements on this connection
+            with conn.cursor('stream_{}'.format(uuid.uuid4().hex), withhold=True,
+                             cursor_factory=ROW_CURSORS[row_format]) as cur:
+                cur.itersize = itersize or self.itersize
+                # a stream runs once iterated, after its @read_only method has returned
+                self.execute(cur, sql_statement, params, shape=shape, replica=replica)
+                for row in cur:
+                    yield row
+
+    def stats(self):
+        """
+        :return: a dictionary of pool, replica pool, result cache, prepared statement and per-query statistics
+        """
+        return {
+            'pool': self.pool.stats() if self.pool is not None else None,
+            'replica_pool': self.replica_pool.stats() if self.replica_pool is not None else None,
+            'result_cache': self.result_cache.stats() if self.result_cache is not None else None,
+            'statements': self.statements.stats(),
+            'queries': self.query_stats.snapshot(),
+            'slow_queries': self.slow_query_log.stats() if self.slow_query_log is not None else None
+        }
+
+    def fetch_all(self, sql_statement, params=None, stream=False, itersize=None, row_format='dict'):
+        """
+        :return: the list of result rows, or a generator over them if stream is true; see safe_execute for
+        the row formats
+        """
+        if stream:
+            return self.safe_stream(sql_statement, params, itersize, row_format)
+        return self.safe_execute(sql_statement, params, fetchone=False, row_format=row_format)
+
+    def init_tables(self):
+        """
+        sets up the database by applying any schema migrations it has not seen yet
+        :return: the list of migration versions that were applied
+        """
+        return migrations.migrate(self)
 
     def insert(self, table_name, col_names, col_params, pk):
         """
@@ -322,21 +1039,117 @@ class Database:
         :param col_params: the data to insert
         :return: return the ID
         """
+        col_names = tuple(col_names)
 
-        q1 = SQL.SQL("insert into {} ({}) values ({}) returning {}").format(SQL.Identifier(table_name),
-                                                                            SQL.SQL(', ').join(
-                                                                                map(SQL.Identifier, col_names)),
-                                                                            SQL.SQL(', ').join(
-                                                                                SQL.Placeholder() * len(col_names)),
-                                                                            SQL.Identifier(pk))
-        print(list(col_params))
+        q1 = self.statements.get(('insert', table_name, col_names, pk),
+                                 lambda: build_insert(table_name, col_names, pk))
 
         row_id = self.safe_execute(q1, list(col_params))[pk]
 
-        self.conn.commit()
+        self.commit()
+        self.invalidate(table_name, inserted_rows(col_names, col_params, pk, row_id))
 
         return row_id
 
+    def insert_many(self, table_name, col_names, rows, returning=None):
+        """
+        inserts several rows with a single multi-row INSERT statement and one commit
+        :param table_name: name of the table to insert into
+        :param col_names: the names of the columns
+        :param rows: a list of sequences, one per row, in the same order as col_names
+        :param returning: optional; name of a column to return for every inserted row
+        :return: a list of the returning column's values in insert order, or None if returning is not set
+        """
+        if not rows:
+            return [] if returning else None
+
+        sql = SQL.SQL("INSERT INTO {} ({}) VALUES %s").format(SQL.Identifier(table_name),
+                                                              SQL.SQL(', ').join(map(SQL.Identifier, col_names)))
+        if returning:
+            sql += SQL.SQL(" RETURNING {}").format(SQL.Identifier(returning))
+
+        result = None
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                # a page as large as the input keeps this to one statement and one round trip
+                with self.instrument(cur, 'insert_many:{}'.format(table_name)):
+                    extras.execute_values(cur, sql.as_string(cur), [tuple(row) for row in rows],
+                                          page_size=len(rows))
+                if returning:
+                    result = [row[returning] for row in cur.fetchall()]
+
+        self.commit()
+        self.invalidate(table_name)
+
+        return result
+
+    def ensure_partitions(self, time=None):
+        """
+        makes sure the monthly workout and erg partitions exist from the month of time through
+        PARTITION_MONTHS_AHEAD months past it. run on start up and before each write of a workout time, past or
+        future, so a month gets its partitions before its first workout instead of filing it into the default
+        partitions, where it would keep the month from ever getting one. months this process already covered
+        are skipped without a round trip
+        :param time: optional; the datetime about to be written, defaults to now
+        :return: the number of partitions created
+        """
+        time = time or datetime.datetime.utcnow()
+        if datetime.date(time.year, time.month, 1) in self._partitioned_months:
+            return 0
+
+        created = migrations.ensure_partitions(self, now=time)
+        # a transaction that rolls back takes the partitions with it
+        if not self.in_transaction():
+            self._partitioned_months.update(migrations.partition_months(time))
+        return created
+
+    def insert_workout(self, user_id, time, by_distance, name, pieces):
+        """
+        creates a workout and all of its erg pieces in a single statement, and so a single transaction
+        :param user_id: the id of the user the workout belongs to
+        :param time: the time stamp of the workout
+        :param by_distance: true if the pieces were rowed for distance, false if for time
+        :param name: the name of the workout, e.g. 2x2000m
+        :param pieces: a list of (distance, minutes, seconds) tuples; may be empty, then only the workout is
+        created
+        :return: the id of the new workout
+        """
+        if not pieces:
+            # VALUES needs at least one row
+            col_names = ('user_id', 'time', 'by_distance', 'name')
+            sql = self.statements.get(('insert', 'workout', col_names, 'workout_id'),
+                                      lambda: build_insert('workout', col_names, 'workout_id'))
+        # one prepared shape per piece count; the casts type the VALUES list for the INSERT ... SELECT
+        else:
+            sql = self.statements.get(('insert_workout', len(pieces)), lambda: SQL.SQL(
+                '''WITH new_workout AS (
+                    INSERT INTO workout (user_id, time, by_distance, name)
+                    VALUES ({}, {}, {}, {})
+                    RETURNING workout_id, time
+                 )
+                 INSERT INTO erg (workout_id, workout_time, distance, minutes, seconds)
+                 SELECT new_workout.workout_id, new_workout.time, pieces.distance, pieces.minutes, pieces.seconds
+                 FROM new_workout, (VALUES {}) AS pieces (distance, minutes, seconds)
+                 RETURNING workout_id'''
+            ).format(SQL.Placeholder(), SQL.Placeholder(), SQL.Placeholder(), SQL.Placeholder(),
+                     SQL.SQL(', ').join([SQL.SQL('({}::INTEGER, {}::INTEGER, {}::FLOAT)').format(
+                         SQL.Placeholder(), SQL.Placeholder(), SQL.Placeholder())] * len(pieces))))
+
+        params = [user_id, time, by_distance, name]
+        for piece in pieces:
+            params.extend(piece)
+
+        self.ensure_partitions(time)
+
+        workout_id = self.safe_execute(sql, params)['workout_id']
+
+        self.commit()
+        self.invalidate('workout', {'user_id': {user_id}})
+        self.invalidate('erg')
+        self.mark_write(user_id)
+
+        return workout_id
+
     def delete_entry(self, table_name, id_col_name, item_id):
         """
         :param id_col_name: the name of the column name containing the numerical ID
@@ -345,13 +1158,14 @@ class Database:
         :return: nothing
         """
 
-        sql = SQL.SQL("DELETE FROM {} WHERE {}={}").format(SQL.Identifier(table_name), SQL.Identifier(id_col_name),
-                                                           SQL.Literal(item_id))
-        self.safe_execute_sql_only(sql)
-        self.conn.commit()
+        sql = self.statements.get(('delete', table_name, id_col_name), lambda: SQL.SQL("DELETE FROM {} WHERE {}={}").format(
+            SQL.Identifier(table_name), SQL.Identifier(id_col_name), SQL.Placeholder()))
+        self.safe_execute_sql_only(sql, (item_id,))
+        self.commit()
+        self.invalidate(table_name, {id_col_name: {item_id}}, cascade=True)
 
     def select(self, table_name, select_cols, where_cols=None, where_params=None, operators=None, order_by=None,
-               group_by=None, fetchone=True):
+               group_by=None, fetchone=True, stream=False, itersize=None, row_format='dict'):
         """
         selects from database; can set select_cols to ['ALL'] to use '*' SQL operator
         :param group_by:
@@ -362,48 +1176,53 @@ class Database:
         :param select_cols: list of the names of the columns for the select clause
         :param where_cols: list of the names of the columns specified in the where clause
         :param where_params: list of the parameter values to compare the where columns to
+        :param stream: true to yield the rows lazily from a server-side cursor instead of returning a list;
+        implies fetchone=False
+        :param itersize: optional; rows fetched per round trip when streaming
+        :param row_format: how rows are returned; see safe_execute
         :return: the row(s), if any, matching the query
         """
 
         # TODO implement group by
 
-        # set up ordering
-        if order_by:
-            order = SQL.SQL(" ORDER BY {}").format(SQL.SQL(", ").join(map(SQL.Identifier, order_by)))
-        else:
-            order = SQL.SQL('')
-
-        # determine select - All or individual attributes
-        if select_cols == ['ALL']:
-            select_cols_to_str = SQL.SQL('*')
-        else:
-            select_cols_to_str = SQL.SQL(', ').join(map(SQL.Identifier, select_cols))
+        select_cols = tuple(select_cols)
+        order_by = tuple(order_by) if order_by else None
 
         # select all rows in table if no where clause is specified
         if where_cols is None:
-            sql = SQL.SQL("SELECT {} FROM {}{}").format(select_cols_to_str, SQL.Identifier(table_name), order)
-            result = self.safe_execute(sql, params=None, fetchone=False)
+            sql = self.statements.get(('select', table_name, select_cols, None, None, order_by),
+                                      lambda: build_select(table_name, select_cols, order_by=order_by))
+            result = self.fetch_all(sql, None, stream, itersize, row_format)
             return result
 
-        # set up 'WHERE' part of query
-        where_col_to_str = set_where_clause(where_cols, operators)
-
         params_tuple = tuple(where_params)
         if type(params_tuple[0]) == list:
+            # IN lists vary in length, so they are not worth preparing
             user_id_list = SQL.SQL(', ').join(map(SQL.Literal, params_tuple[0]))
-            sql = SQL.SQL("SELECT {} FROM {} WHERE {} IN ({});").format(select_cols_to_str, SQL.Identifier(table_name),
+            sql = SQL.SQL("SELECT {} FROM {} WHERE {} IN ({});").format(select_list(select_cols),
+                                                                        SQL.Identifier(table_name),
                                                                         SQL.Identifier(where_cols[0]), user_id_list)
-            result = self.safe_execute(sql, params=None, fetchone=False)
+            result = self.fetch_all(sql, None, stream, itersize, row_format)
             return result
-        else:
-            sql = SQL.SQL("SELECT {} FROM {} WHERE {}").format(select_cols_to_str, SQL.Identifier(table_name),
-                                                               where_col_to_str)
 
-        if order_by:
-            sql += order
+        where_cols = tuple(where_cols)
+        operators = tuple(operators) if operators else None
+
+        sql = self.statements.get(('select', table_name, select_cols, where_cols, operators, order_by),
+                                  lambda: build_select(table_name, select_cols, where_cols, operators, order_by))
 
         # execute the query
-        result = self.safe_execute(sql, params_tuple, fetchone=fetchone)
+        if stream:
+            return self.safe_stream(sql, params_tuple, itersize, row_format)
+        if row_format != 'dict':
+            return self.safe_execute(sql, params_tuple, fetchone=fetchone, row_format=row_format)
+
+        if len(where_cols) == 1 and (not operators or operators[0] == '='):
+            deps = [(table_name, where_cols[0], params_tuple[0])]
+        else:
+            deps = [(table_name, None)]
+        result = self.cached((sql.key, fetchone, params_tuple), deps,
+                             lambda: self.safe_execute(sql, params_tuple, fetchone=fetchone))
 
         return result
 
@@ -418,41 +1237,108 @@ class Database:
         :param operators: optional array; mathematical operators for 'WHERE' clause
         :return:
         """
+        update_cols = tuple(update_cols)
+        where_cols = tuple(where_cols)
+        operators = tuple(operators) if operators else None
 
-        set_str = [SQL.SQL("{}={}").format(SQL.Identifier(update_cols[i]), SQL.Placeholder()) for i in
-                   range(len(update_cols))]
-        set_str = SQL.SQL(", ").join(set_str)
-
-        where_str = set_where_clause(where_cols, operators)
-
-        sql = SQL.SQL("UPDATE {} SET {} WHERE {}").format(SQL.Identifier(table_name), set_str, where_str)
+        sql = self.statements.get(('update', table_name, update_cols, where_cols, operators),
+                                  lambda: build_update(table_name, update_cols, where_cols, operators))
 
         params = tuple(update_params) + tuple(where_params)
 
         self.safe_execute_sql_only(sql, params)
 
-        self.conn.commit()
+        self.commit()
+        self.invalidate(table_name, updated_rows(update_cols, update_params, where_cols, where_params, operators))
 
-    def get_workouts(self, user_id):
+    def column_types(self, table_name, col_names):
+        """
+        looks up (and caches) the SQL types of some columns of a table
+        :param table_name: the name of the table
+        :param col_names: the names of the columns
+        :return: a list of type names, e.g. ['integer', 'double precision'], in the order of col_names
+        """
+        key = (table_name, tuple(col_names))
+        if key not in self._column_types:
+            sql = self.statements.get(('column_types',), lambda: SQL.SQL(
+                '''SELECT attname, format_type(atttypid, atttypmod) AS type
+                 FROM pg_attribute
+                 WHERE attrelid = {}::regclass
+                 AND attname = ANY({})
+                 AND NOT attisdropped'''
+            ).format(SQL.Placeholder(), SQL.Placeholder()))
+
+            result = self.safe_execute(sql, (table_name, list(col_names)), fetchone=False)
+            types = {row['attname']: row['type'] for row in result}
+            self._column_types[key] = [types[col] for col in col_names]
+
+        return self._column_types[key]
+
+    def update_many(self, table_name, key_col, update_cols, rows):
+        """
+        applies many row updates with one UPDATE ... FROM (VALUES ...) statement
+        :param table_name: string; the name of the table to update
+        :param key_col: string; the column identifying each row, e.g. the primary key
+        :param update_cols: array; the names of the columns being updated
+        :param rows: array of sequences of the form (key, value for update_cols[0], value for update_cols[1], ...)
+        :return: nothing
+        """
+        if not rows:
+            return
+
+        cols = [key_col] + list(update_cols)
+
+        # VALUES lists carry no column types, so every value is cast to the type of the column it updates
+        template = SQL.SQL('({})').format(SQL.SQL(', ').join(
+            [SQL.SQL('%s::{}').format(SQL.SQL(col_type)) for col_type in self.column_types(table_name, cols)]))
+
+        set_str = SQL.SQL(', ').join([SQL.SQL("{}=v.{}").format(SQL.Identifier(col), SQL.Identifier(col))
+                                      for col in update_cols])
+
+        sql = SQL.SQL("UPDATE {} AS t SET {} FROM (VALUES %s) AS v ({}) WHERE t.{} = v.{}").format(
+            SQL.Identifier(table_name), set_str, SQL.SQL(', ').join(map(SQL.Identifier, cols)),
+            SQL.Identifier(key_col), SQL.Identifier(key_col))
+
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                with self.instrument(cur, 'update_many:{}'.format(table_name)):
+                    extras.execute_values(cur, sql.as_string(cur), [tuple(row) for row in rows],
+                                          template=template.as_string(cur), page_size=len(rows))
+
+        self.commit()
+        self.invalidate(table_name, {key_col: {row[0] for row in rows}})
+
+    def get_workouts(self, user_id, stream=False, itersize=None):
         """
         joins workouts and ergs and returns the result
         :param user_id: the id of the current user
+        :param stream: true to yield the rows lazily instead of returning a list
+        :param itersize: optional; rows fetched per round trip when streaming
         :return: array of dictionaries representing table rows
         """
 
-        sql = SQL.SQL(
-          '''SELECT *
-          FROM workout AS w
-          JOIN erg AS e
-          ON e.workout_id = w.workout_id
-          WHERE w.user_id={}
-          ORDER BY w.time DESC'''
-        ).format(SQL.Literal(user_id))
+        sql = self.named_query('get_workouts')
 
-        result = self.safe_execute(sql, params=None, fetchone=False)
+        result = self.fetch_all(sql, (user_id,), stream, itersize)
 
         return result
 
+    @read_only
+    def get_workouts_page(self, user_id, limit, before=None):
+        """
+        one page of get_workouts, seeking on (time, workout_id) so every page costs the same
+        :param user_id: the id of the current user
+        :param limit: the most workouts on the page; all of their pieces are returned
+        :param before: the cursor returned with the previous page, None for the first page
+        :return: a (pieces, cursor) tuple; cursor is None on the last page
+        """
+        time_before, id_before = before or KEYSET_START
+
+        result = self.safe_execute(self.named_query('get_workouts_page'),
+                                   (user_id, time_before, time_before, id_before, limit), fetchone=False)
+
+        return result, page_cursor(result, limit)
+
     def get_workouts_by_id(self, user_id, workout_id):
         """
         joins workouts and ergs and returns the result of a single workout specified by the workout id
@@ -461,88 +1347,82 @@ class Database:
         :return: array of dictionaries representing table rows
         """
 
-        sql = SQL.SQL(
-            '''SELECT *, to_char(time, 'yyyy-mm-ddThh24:mi:ss.000Z') as time
-             FROM workout AS w
-             JOIN erg AS e
-             ON e.workout_id = w.workout_id
-             WHERE w.user_id={}
-             AND e.workout_id={}
-             ORDER BY e.erg_id'''
-        ).format(SQL.Placeholder(), SQL.Placeholder())
+        sql = self.named_query('get_workouts_by_id')
 
         result = self.safe_execute(sql, (user_id, workout_id), fetchone=False)
 
-        print(result)
         return result
 
-    def get_aggregate_workouts_by_name(self, user_id, workout_name):
+    @read_only
+    def get_aggregate_workouts_by_name(self, user_id, workout_name, row_format='dict'):
         """
         ** gets all workouts for a specific user with a specific workout name
         for each workout of a specific type (for which there may be several pieces),
         take the average distance and time of all the pieces in the workout
         :param user_id:
         :param workout_name:
+        :param row_format: how rows are returned; see safe_execute
         :return: an array of dictionaries, each representing a workout with
         aggregated totals for distance and time
         """
 
-        sql = SQL.SQL(
-            '''SELECT distance, total_seconds, w.workout_id, w.time, w.by_distance
-             FROM workout AS w
-             JOIN
-                  (SELECT AVG(e.distance) AS distance,
-                  AVG((e.minutes*60)+e.seconds) AS total_seconds, e.workout_id
-                  FROM workout AS w
-                  JOIN erg AS e
-                  ON e.workout_id = w.workout_id
-                  WHERE w.user_id={}
-                  AND w.name={}
-                  GROUP BY e.workout_id) AS agg_table
-             ON w.workout_id = agg_table.workout_id
-             ORDER BY w.time'''
-        ).format(SQL.Placeholder(), SQL.Placeholder())
-
-        result = self.safe_execute(sql, (user_id, workout_name), fetchone=False)
+        sql = self.named_query('get_aggregate_workouts_by_name')
+
+        result = self.safe_execute(sql, (user_id, workout_name), fetchone=False, row_format=row_format)
 
         return result
 
-    def get_aggregate_workouts_by_id(self, user_id):
+    @read_only
+    def get_aggregate_workouts_by_id(self, user_id, stream=False, itersize=None, row_format='dict'):
         """
         ** gets all workouts for a specific user
         for each workout for a specific user (for which there may be several pieces),
         take the average distance and time of all the pieces in the workout
         :param user_id: the id of the user for which to gather all workouts
+        :param stream: true to yield the workouts lazily instead of returning a list
+        :param itersize: optional; rows fetched per round trip when streaming
+        :param row_format: 'dict', or 'columns' / 'numpy' for one list or array per column with the split
+        math done column-wise
         :return: an array of dictionaries, each representing a workout with
         aggregated totals for distance and time
         """
-        sql = SQL.SQL(
-            '''SELECT distance, total_seconds, w.workout_id, w.time, w.by_distance, w.name
-             FROM workout AS w
-             JOIN
-                  (SELECT AVG(e.distance) AS distance,
-                  AVG((e.minutes*60)+e.seconds) AS total_seconds, e.workout_id
-                  FROM workout AS w
-                  JOIN erg AS e
-                  ON e.workout_id = w.workout_id
-                  WHERE w.user_id={}
-                  GROUP BY e.workout_id) AS agg_table
-             ON w.workout_id = agg_table.workout_id
-             ORDER BY w.time DESC'''
-        ).format(SQL.Placeholder())
+        sql = self.named_query('get_aggregate_workouts_by_id')
+
+        if stream:
+            return (format_aggregate_workout(res) for res in self.safe_stream(sql, (user_id,), itersize))
+
+        if row_format in COLUMN_FORMATS:
+            return format_aggregate_columns(self.safe_execute(sql, (user_id,), fetchone=False, row_format=row_format))
 
         result = self.safe_execute(sql, (user_id,), fetchone=False)
 
         for res in result:
-            res['total_seconds'] = float(res['total_seconds'])
-            res['distance'] = float(res['distance'])
-            res['time'] = res['time'].strftime('%Y-%m-%dT%H:%M:00.000Z')
-            splits = float(res['distance']) / float(500)
-            res['avg_sec'] = format(((res['total_seconds'] / splits) % 60), '.2f')
-            res['avg_min'] = int(res['total_seconds'] / splits / 60)
+            format_aggregate_workout(res)
 
         return result
 
+    @read_only
+    def get_aggregate_workouts_page(self, user_id, limit, before=None):
+        """
+        one page of get_aggregate_workouts_by_id, seeking on (time, workout_id) so every page costs the same
+        :param user_id: the id of the user for which to gather workouts
+        :param limit: the most workouts on the page
+        :param before: the cursor returned with the previous page, None for the first page
+        :return: a (workouts, cursor) tuple; cursor is None on the last page
+        """
+        time_before, id_before = before or KEYSET_START
+
+        result = self.safe_execute(self.named_query('get_aggregate_workouts_page'),
+                                   (user_id, time_before, time_before, id_before, limit), fetchone=False)
+
+        # the cursor needs the full time stamp, which formatting truncates
+        cursor = page_cursor(result, limit)
+        for res in result:
+            format_aggregate_workout(res)
+
+        return result, cursor
+
+    @read_only
     def find_all_workout_names(self, user_id):
         """
         returns all the distinct names of the workouts
@@ -551,144 +1431,205 @@ class Database:
         :param user_id: the id of the current user
         :return: a list of strings (workout names)
         """
-        print(user_id)
-        sql = SQL.SQL(
-            '''SELECT DISTINCT name
-             FROM workout
-             WHERE user_id={}
-             GROUP BY name
-             HAVING COUNT(workout_id) > 1'''
-        ).format(SQL.Placeholder())
+        sql = self.named_query('find_all_workout_names')
 
-        result = self.safe_execute(sql, (user_id,), fetchone=False)
+        result = self.cached((sql.key, user_id), [('workout', 'user_id', user_id)],
+                             lambda: self.safe_execute(sql, (user_id,), fetchone=False))
 
         return result
 
+    @read_only
     def get_total_meters(self, user_id):
         """
         aggregates all of the total meters for a user
         :param user_id: the current user to aggregate all meters for
         :return: a integer; total meters rowed by individual
         """
-        sql = SQL.SQL(
-            '''SELECT SUM(e.distance) AS total_meters
-             FROM workout AS w
-             JOIN erg AS e
-             ON e.workout_id = w.workout_id
-             WHERE w.user_id={}
-             GROUP BY user_id'''
-        ).format(SQL.Placeholder())
+        sql = self.named_query('get_total_meters')
 
         result = self.safe_execute(sql, (user_id,), fetchone=True)
         return result
 
     def get_user(self, user_id):
-        sql = SQL.SQL(
-            '''SELECT *
-             FROM users as u
-             JOIN profile as p
-             ON u.user_id = p.user_id
-             WHERE u.user_id={}'''
-        ).format(SQL.Placeholder())
+        sql = self.named_query('get_user')
 
-        result = self.safe_execute(sql, (user_id,), fetchone=True)
+        result = self.cached((sql.key, user_id), [('users', 'user_id', user_id), ('profile', 'user_id', user_id)],
+                             lambda: self.safe_execute(sql, (user_id,), fetchone=True))
         return result
 
     def get_names(self):
-        sql = SQL.SQL("SELECT ARRAY_AGG(username) as names FROM users")
+        sql = self.named_query('get_names')
 
-        result = self.safe_execute(sql, params=None, fetchone=True)
+        result = self.cached(sql.key, [('users', None)], lambda: self.safe_execute(sql, params=None, fetchone=True))
 
         if result:
             return result['names']
         return None
 
     def get_emails(self):
-        sql = SQL.SQL("SELECT ARRAY_AGG(email) as emails FROM users")
+        sql = self.named_query('get_emails')
 
-        result = self.safe_execute(sql, params=None, fetchone=True)
+        result = self.cached(sql.key, [('users', None)], lambda: self.safe_execute(sql, params=None, fetchone=True))
 
         if result:
             return result['emails']
         return None
 
-    def get_leader_board_meters(self, date):
+    @read_only
+    def get_leader_board(self, date, teams=None, user_ids=None, row_format='dict', use_rollup=False):
+        """
+        gets the total meters, total seconds and split of every rower from a certain cutoff date in one
+        query; rows are unsorted, each board orders them its own way
+        :param date: the datetime cutoff date
+        :param teams: optional; only the athletes of these teams, e.g. ['vm']
+        :param user_ids: optional; only these athletes
+        :param row_format: how rows are returned; see safe_execute
+        :param use_rollup: true to sum the weekly rollup instead of the workouts; date must end a week
+        :return: rows with username, total_meters, total_seconds and split
+        """
+        if user_ids is not None and not user_ids:
+            return []
+        name, params = leader_board_query(None, date, teams, user_ids, use_rollup)
+
+        result = self.safe_execute(self.named_query(name), params, fetchone=False, row_format=row_format)
+        return result
+
+    @read_only
+    def get_leader_board_top(self, date, username, k=5, teams=None, user_ids=None, row_format='dict',
+                             use_rollup=False):
+        """
+        ranks every rower from a certain cutoff date on the meters, minutes and split boards, and returns only
+        the rows placed in the top k of a board plus the row of one athlete
+        :param date: the datetime cutoff date
+        :param username: the athlete whose row is always returned, if they rowed and are in scope; None for
+        only the top places
+        :param k: how many places of each board to return; 0 for only the athlete's row
+        :param teams: optional; only rank the athletes of these teams, e.g. ['vm']
+        :param user_ids: optional; only rank these athletes
+        :param row_format: how rows are returned; see safe_execute
+        :param use_rollup: true to sum the weekly rollup instead of the workouts; date must end a week
+        :return: rows with username, total_meters, total_seconds, split and the rank and place on each board
+        """
+        if user_ids is not None and not user_ids:
+            return []
+        name, params = leader_board_query('top', date, teams, user_ids, use_rollup)
+
+        result = self.safe_execute(self.named_query(name), params + (k, username), fetchone=False,
+                                   row_format=row_format)
+        return result
+
+    @read_only
+    def get_leader_board_window(self, start, end, username, k=5, teams=None, user_ids=None, row_format='dict'):
+        """
+        same as get_leader_board_top, over the local days start through end instead of since a cutoff; each
+        athlete's totals are two lookups of their running daily totals, however long the window
+        :param start: the date of the first day of the window
+        :param end: the date of the last day of the window
+        :param username: the athlete whose row is always returned, if they rowed and are in scope; None for
+        only the top places
+        :param k: how many places of each board to return; 0 for only the athlete's row
+        :param teams: optional; only rank the athletes of these teams, e.g. ['vm']
+        :param user_ids: optional; only rank these athletes
+        :param row_format: how rows are returned; see safe_execute
+        :return: rows with username, total_meters, total_seconds, split and the rank and place on each board
+        """
+        if user_ids is not None and not user_ids:
+            return []
+        name, params = window_leader_board_query(start, end, teams, user_ids)
+
+        result = self.safe_execute(self.named_query(name), params + (k, username), fetchone=False,
+                                   row_format=row_format)
+        return result
+
+    def archive_leader_board_weeks(self, current_week=None):
+        """
+        archives the standings of every finished week that is not archived yet; a job, run at migration time and
+        weekly by the archive-weeks command in main.py, never while serving a page. safe to run any time and from
+        several processes. an archived week follows later edits to its workouts by itself (migration 0012)
+        :param current_week: optional; the date of the monday the running week started on, defaults to this
+        week's in UTC; weeks before it are finished
+        :return: the number of rows archived
+        """
+        if current_week is None:
+            today = datetime.datetime.utcnow().date()
+            current_week = today - datetime.timedelta(days=today.weekday())
+
+        result = self.safe_execute(self.named_query('archive_leader_board_weeks'), (current_week,))
+        self.commit()
+        return result['archived']
+
+    @read_only
+    def get_leader_board_archive(self, week_start, username, k=5, row_format='dict'):
+        """
+        the frozen standings of a finished week, trimmed like get_leader_board_top
+        :param week_start: the date of the monday the week started on
+        :param username: the athlete whose row is always returned, if they rowed that week
+        :param k: how many places of each board to return
+        :param row_format: how rows are returned; see safe_execute
+        :return: rows with username, total_meters, total_seconds, split and the rank and place on each board
+        """
+        q1 = self.named_query('get_leader_board_archive')
+
+        result = self.safe_execute(q1, (week_start, k, username), fetchone=False, row_format=row_format)
+        return result
+
+    @read_only
+    def get_leader_board_archive_weeks(self, week_start):
+        """
+        :param week_start: the date of a week's monday
+        :return: a dictionary with the archived weeks just before ('previous') and after ('next') it, or None
+        """
+        q1 = self.named_query('get_leader_board_archive_weeks')
+
+        return self.safe_execute(q1, (week_start, week_start))
+
+    def get_activity_today(self):
+        """
+        :return: the team's local date today, the day daily_activity files a workout logged now under
+        """
+        return self.safe_execute(self.named_query('get_activity_today'), params=None)['today']
+
+    @read_only
+    def get_leader_board_meters(self, date, row_format='dict', use_rollup=False):
         """
         gets the total meters for every rower from a certain cutoff date
         :param date: the datetime cutoff date for meters
+        :param row_format: how rows are returned; see safe_execute
+        :param use_rollup: true to sum the weekly rollup instead of the workouts; date must end a week
         :return:
         """
-        q = SQL.SQL(
-            '''
-            SELECT SUM(tbl.distance) AS total_meters,  u.username
-            FROM (
-                SELECT distance, user_id
-                FROM workout AS w
-                JOIN erg AS e 
-                ON w.workout_id = e.workout_id
-                WHERE w.time>{}
-                ) AS tbl
-            JOIN users AS u
-            ON u.user_id = tbl.user_id
-            GROUP BY u.username
-            ORDER BY total_meters DESC
-            '''
-        ).format(SQL.Placeholder())
-
-        result = self.safe_execute(q, (date,), fetchone=False)
+        name, params = leader_board_query('meters', date, use_rollup=use_rollup)
+
+        result = self.safe_execute(self.named_query(name), params, fetchone=False, row_format=row_format)
         return result
 
-    def get_leader_board_minutes(self, date):
+    @read_only
+    def get_leader_board_minutes(self, date, row_format='dict', use_rollup=False):
         """
         gets total minutes of each athlete from present until the cutoff date
         :param date: the datetime object of the cuttoff date
+        :param row_format: how rows are returned; see safe_execute
+        :param use_rollup: true to sum the weekly rollup instead of the workouts; date must end a week
         :return:
         """
-        q = SQL.SQL(
-            '''
-            SELECT (SUM(tbl.minutes) * 60) + SUM(tbl.seconds) AS total_seconds,  u.username
-            FROM (
-                SELECT user_id, minutes, seconds
-                FROM workout AS w
-                JOIN erg AS e 
-                ON w.workout_id = e.workout_id
-                WHERE w.time>{}
-                ) AS tbl
-            JOIN users AS u
-            ON u.user_id = tbl.user_id
-            GROUP BY u.username
-            ORDER BY total_seconds DESC
-            '''
-        ).format(SQL.Placeholder())
-
-        result = self.safe_execute(q, (date,), fetchone=False)
+        name, params = leader_board_query('minutes', date, use_rollup=use_rollup)
+
+        result = self.safe_execute(self.named_query(name), params, fetchone=False, row_format=row_format)
         return result
 
 
-    def get_leader_board_split(self, date):
+    @read_only
+    def get_leader_board_split(self, date, row_format='dict', use_rollup=False):
         """
         gets aggregated split of each athlete from present until the cutoff date
         :param date: the datetime object of the cuttoff date
+        :param row_format: how rows are returned; see safe_execute
+        :param use_rollup: true to sum the weekly rollup instead of the workouts; date must end a week
         :return:
         """
-        q = SQL.SQL(
-            '''
-            SELECT (((SUM(tbl.minutes) * 60) + SUM(tbl.seconds))::FLOAT / SUM(tbl.distance)) * 500 AS split,  u.username
-            FROM (
-                SELECT user_id, minutes, seconds, distance
-                FROM workout AS w
-                JOIN erg AS e 
-                ON w.workout_id = e.workout_id
-                WHERE w.time>{}
-                ) AS tbl
-            JOIN users AS u
-            ON u.user_id = tbl.user_id
-            GROUP BY u.username
-            ORDER BY split
-            '''
-        ).format(SQL.Placeholder())
-
-        result = self.safe_execute(q, (date,), fetchone=False)
+        name, params = leader_board_query('split', date, use_rollup=use_rollup)
+
+        result = self.safe_execute(self.named_query(name), params, fetchone=False, row_format=row_format)
         return result
 
     def get_profile_stats(self, user_id):
@@ -700,36 +1641,29 @@ class Database:
         :return:
         """
 
-        q = SQL.SQL(
-            '''
-            SELECT weight, height, show_age, show_height, show_weight, EXTRACT(YEAR FROM AGE(birthday))::INTEGER AS age
-            FROM profile
-            WHERE user_id={}
-            '''
-        ).format(SQL.Literal(user_id))
+        q = self.named_query('get_profile_stats')
 
-        result = self.safe_execute(q)
+        result = self.safe_execute(q, (user_id,))
         return result
 
-    def get_heat_map_calendar_results(self, user_id):
+    @read_only
+    def get_heat_map_calendar_results(self, user_id, start=None, end=None):
         """
-        take a user ID and a time offset (from GMT to user's local time) and return the counts of each day
-        :param user_id:
-        :return:
+        the workout count, meters and minutes of each day a user rowed, from the daily activity rollup;
+        days are the team's local calendar days
+        :param user_id: the id of the user
+        :param start: optional; the first date of the range
+        :param end: optional; the last date of the range
+        :return: a list of rows with date, count, meters and minutes, oldest first
         """
 
-        q1 = SQL.SQL(
-            '''
-            SELECT COUNT(time) as count, time as date
-            FROM workout
-            WHERE user_id={}
-            GROUP BY date;
-            '''
-        ).format(SQL.Placeholder())
+        q1 = self.named_query('get_heat_map_calendar_results')
 
-        result = self.safe_execute(q1, (user_id,), fetchone=False)
+        result = self.safe_execute(q1, (user_id, start or datetime.date.min, end or datetime.date.max),
+                                   fetchone=False)
         return result
 
+    @read_only
     def get_last_three_workouts(self, user_id):
         """
         ** gets all workouts for a specific user
@@ -739,30 +1673,11 @@ class Database:
         :return: an array of dictionaries, each representing a workout with
         aggregated totals for distance and time
         """
-        sql = SQL.SQL(
-            '''SELECT distance, total_seconds, w.workout_id, w.time, w.by_distance, w.name
-             FROM workout AS w
-             JOIN
-                  (SELECT AVG(e.distance) AS distance,
-                  AVG((e.minutes*60)+e.seconds) AS total_seconds, e.workout_id
-                  FROM workout AS w
-                  JOIN erg AS e
-                  ON e.workout_id = w.workout_id
-                  WHERE w.user_id={}
-                  GROUP BY e.workout_id) AS agg_table
-             ON w.workout_id = agg_table.workout_id
-             ORDER BY w.time DESC
-             LIMIT 3'''
-        ).format(SQL.Placeholder())
+        sql = self.named_query('get_last_three_workouts')
 
         result = self.safe_execute(sql, (user_id,), fetchone=False)
 
         for res in result:
-            res['total_seconds'] = float(res['total_seconds'])
-            res['distance'] = float(res['distance'])
-            # res['time'] = res['time'].strftime('%Y-%m-%dT%H:%M:00.000Z')
-            splits = float(res['distance']) / float(500)
-            res['avg_sec'] = format(((res['total_seconds'] / splits) % 60), '.2f')
-            res['avg_min'] = int(res['total_seconds'] / splits / 60)
+            format_aggregate_workout(res)
 
         return result
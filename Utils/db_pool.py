@@ -0,0 +1,194 @@
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extras
+
+from Utils.log import log
+from Utils.statements import StatementConnection
+
+
+def connect(connect_str):
+    """
+    open a connection that returns rows as dictionaries and can track its prepared statements
+    :param connect_str: the libpq connection string
+    :return: a new psycopg2 connection
+    """
+    return psycopg2.connect(connect_str, connection_factory=StatementConnection,
+                            cursor_factory=extras.RealDictCursor)
+
+
+class PoolTimeout(Exception):
+    """
+    raised when no connection could be checked out of the pool before the checkout timeout
+    """
+    pass
+
+
+class ConnectionPool:
+    """
+    a thread-safe pool of psycopg2 connections; every checkout hands a connection to exactly
+    one thread until it is returned with putconn
+    """
+
+    def __init__(self, connect_str, min_size=1, max_size=10, timeout=5.0, health_check_interval=30.0):
+        """
+
+        :param connect_str: the libpq connection string used to open new connections
+        :param min_size: number of connections opened up front and kept idle
+        :param max_size: the most connections the pool will ever have open at once
+        :param timeout: seconds to wait for a free connection before raising PoolTimeout
+        :param health_check_interval: seconds a connection may sit idle before it is pinged on checkout
+        """
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('pool size must satisfy 0 <= min_size <= max_size and max_size >= 1')
+
+        self.connect_str = connect_str
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = []  # list of (connection, time it was returned)
+        self._size = 0
+
+        # wait-time metrics
+        self._checkouts = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+
+        for i in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        return connect(self.connect_str)
+
+    def _is_healthy(self, conn, idle_since):
+        """
+        a connection is healthy if it is open, not mid-transaction and, once it has been idle
+        for longer than the health check interval, answers a trivial query
+        """
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        log.info('Discarding pooled connection {}'.format(id(conn)))
+        self._discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """
+        check out a connection, blocking for at most the pool timeout
+        :return: a psycopg2 connection owned by the caller until putconn is called
+        """
+        start = time.monotonic()
+        deadline = start + self.timeout
+        waited = False
+
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout('no database connection free after {}s'.format(self.timeout))
+                    waited = True
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    # reserve the slot before connecting so other threads do not overshoot max_size
+                    self._size += 1
+
+            # health checks and new connections happen outside the lock
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except psycopg2.Error:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn, idle_since):
+                with self._cond:
+                    self._discard(conn)
+                    self._size -= 1
+                    self._cond.notify()
+                continue
+
+            with self._cond:
+                self._record_checkout(start, waited)
+            return conn
+
+    def _record_checkout(self, start, waited):
+        wait = time.monotonic() - start
+        self._checkouts += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        if waited:
+            self._waits += 1
+
+    def putconn(self, conn, discard=False):
+        """
+        return a connection to the pool
+        :param conn: a connection previously handed out by getconn
+        :param discard: true if the connection is broken and should be closed instead of reused
+        :return: nothing
+        """
+        with self._cond:
+            if discard or conn.closed or len(self._idle) >= self.max_size:
+                self._discard(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn, idle_since in self._idle:
+                conn.close()
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        """
+        :return: a dictionary of pool size and checkout wait-time metrics
+        """
+        with self._cond:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'open': self._size,
+                'idle': len(self._idle),
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+                'discarded': self._discarded,
+                'total_wait': self._total_wait,
+                'max_wait': self._max_wait,
+                'avg_wait': self._total_wait / self._checkouts if self._checkouts else 0.0,
+            }
+
+    def __repr__(self):
+        return '<ConnectionPool {}/{} open>'.format(self._size, self.max_size)
@@ -0,0 +1,97 @@
+import bisect
+import random
+import threading
+
+from Utils.log import log
+
+
+# upper bounds (seconds) of the latency histogram buckets; the last bucket catches everything slower
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class ShapeStats:
+    """
+    running totals for every execution of one statement shape
+    """
+
+    __slots__ = ('count', 'errors', 'rows', 'total_time', 'max_time', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def as_dict(self):
+        labels = ['<={}'.format(bound) for bound in LATENCY_BUCKETS] + ['>{}'.format(LATENCY_BUCKETS[-1])]
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'rows': self.rows,
+            'total_time': self.total_time,
+            'avg_time': self.total_time / self.count if self.count else 0.0,
+            'max_time': self.max_time,
+            'histogram': dict(zip(labels, self.buckets))
+        }
+
+
+class QueryStats:
+    """
+    per statement shape latency histograms, row counts and error counts; the query text is only
+    formatted for statements that are sampled, slow or failed
+    """
+
+    def __init__(self, sample_rate=0.0, slow_threshold=0.5):
+        """
+
+        :param sample_rate: fraction (0-1) of statements whose text is logged at INFO
+        :param slow_threshold: seconds after which a statement's text is logged as a WARNING
+        """
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._shapes = {}
+
+    def record(self, shape, duration, rows=0, error=False, query_text=None):
+        """
+        :param shape: a label identifying the statement shape
+        :param duration: seconds the statement took
+        :param rows: the number of rows it returned or touched
+        :param error: true if the statement raised
+        :param query_text: optional function returning the statement text; only called when it is logged
+        :return: nothing
+        """
+        with self._lock:
+            stats = self._shapes.get(shape)
+            if stats is None:
+                stats = self._shapes[shape] = ShapeStats()
+            stats.count += 1
+            stats.total_time += duration
+            stats.max_time = max(stats.max_time, duration)
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+            if error:
+                stats.errors += 1
+            elif rows > 0:
+                stats.rows += rows
+
+        if query_text is None:
+            return
+        if error:
+            log.error('{} failed after {:.4f}s: {}'.format(shape, duration, query_text()))
+        elif duration >= self.slow_threshold:
+            log.warning('{} slow ({:.4f}s): {}'.format(shape, duration, query_text()))
+        elif self.sample_rate and random.random() < self.sample_rate:
+            log.info('{} ({:.4f}s): {}'.format(shape, duration, query_text()))
+
+    def snapshot(self):
+        """
+        :return: a dictionary of shape label to its aggregated statistics
+        """
+        with self._lock:
+            return {shape: stats.as_dict() for shape, stats in self._shapes.items()}
+
+    def reset(self):
+        with self._lock:
+            self._shapes = {}
@@ -0,0 +1,95 @@
+import threading
+import time
+
+
+class LeaderBoardCache:
+    """
+    the top places of the leader boards of each cutoff week and scope, kept until a workout write could change
+    them. a board for the cutoff c covers every workout after c, so a write to a workout at time t invalidates
+    the weeks with c < t. the boards don't depend on who views them; the viewer's own row is looked up apart.
+
+    writes made by other processes are not seen; max_age bounds how long such a board is served
+    """
+
+    def __init__(self, max_age=60.0, max_weeks=256):
+        """
+
+        :param max_age: seconds a board is served before it is recomputed anyway; None to keep it until
+        invalidated
+        :param max_weeks: most boards kept; past it the oldest are dropped
+        """
+        self.max_age = max_age
+        self.max_weeks = max_weeks
+        self._lock = threading.Lock()
+        # (cutoff, scope) -> (computed at, boards)
+        self._boards = {}
+        # bumped on every invalidation, so boards computed while a write was made are not stored
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, cutoff, compute, scope=None):
+        """
+        :param cutoff: the datetime cutoff of the week, as get_last_sunday makes it
+        :param compute: called with no arguments on a miss; returns the boards of the week
+        :param scope: optional; a hashable of what else the boards depend on, e.g. the squads ranked
+        :return: the boards of the week; shared between callers, so they must not be modified
+        """
+        key = (cutoff, scope)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._boards.get(key)
+            if cached is not None and not self._expired(cached, now):
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            generation = self._generation
+
+        boards = compute()
+
+        with self._lock:
+            if generation == self._generation:
+                self._boards[key] = (now, boards)
+                self._prune(now)
+        return boards
+
+    def _expired(self, cached, now):
+        return self.max_age is not None and now - cached[0] >= self.max_age
+
+    def _prune(self, now):
+        # expired boards would only be recomputed, and past windows are never asked for again
+        for key in [key for key, cached in self._boards.items() if self._expired(cached, now)]:
+            del self._boards[key]
+        if len(self._boards) > self.max_weeks:
+            by_age = sorted(self._boards, key=lambda key: self._boards[key][0])
+            for key in by_age[:len(self._boards) - self.max_weeks]:
+                del self._boards[key]
+
+    def invalidate(self, workout_time=None):
+        """
+        drops the boards a workout write could have changed
+        :param workout_time: optional; the time of the written workout, as a datetime. without it every
+        week is dropped, e.g. for edits that may have moved a workout
+        :return: nothing
+        """
+        with self._lock:
+            self._generation += 1
+            for key in list(self._boards):
+                if workout_time is None or key[0] < workout_time:
+                    del self._boards[key]
+                    self.invalidations += 1
+
+    def stats(self):
+        """
+        :return: a dictionary with the number of cached weeks, hits, misses and invalidations
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'weeks': len(self._boards),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'invalidations': self.invalidations
+            }
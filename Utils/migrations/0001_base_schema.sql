@@ -0,0 +1,133 @@
+-- the schema Database.init_tables used to rebuild on every start up; safe to run against a database
+-- that already has it
+
+CREATE TABLE IF NOT EXISTS users ();
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS password      VARCHAR(255);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS user_id       SERIAL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS role          INTEGER;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS first         VARCHAR(20);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last          VARCHAR(20);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS username      VARCHAR(20);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS email         VARCHAR(255);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS confirm_email BOOLEAN;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS address       VARCHAR(150);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS city          VARCHAR(255);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS state         VARCHAR(255);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS zip           INTEGER;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS num_seats     INTEGER;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS phone         BIGINT;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS team          VARCHAR(20);
+ALTER TABLE users ADD COLUMN IF NOT EXISTS x             REAL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS y             REAL;
+
+CREATE TABLE IF NOT EXISTS workout (
+    workout_id  SERIAL         PRIMARY KEY,
+    user_id     INTEGER        NOT NULL,
+    time        TIMESTAMP      NOT NULL,
+    by_distance BOOLEAN        NOT NULL,
+    name        VARCHAR(25)    NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS erg (
+    erg_id     SERIAL  NOT NULL PRIMARY KEY,
+    workout_id INTEGER NOT NULL,
+    distance   INTEGER NOT NULL,
+    minutes    INTEGER NOT NULL,
+    seconds    FLOAT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS profile (
+    user_id     INTEGER          UNIQUE PRIMARY KEY NOT NULL,
+    picture     VARCHAR(255)     NOT NULL DEFAULT ('defaults/profile.jpg'),
+    bio         VARCHAR(250)     NOT NULL,
+    birthday    DATE,
+    height      DOUBLE PRECISION DEFAULT(0),
+    weight      DOUBLE PRECISION DEFAULT(0),
+    show_age    BOOLEAN          DEFAULT(FALSE),
+    show_height BOOLEAN          DEFAULT(FALSE),
+    show_weight BOOLEAN          DEFAULT(FALSE)
+);
+
+-- remove pieces in workout if workout is deleted
+CREATE OR REPLACE FUNCTION remove_all_pieces() RETURNS trigger AS
+$$
+BEGIN
+    DELETE FROM erg
+    WHERE erg.workout_id IN (
+        SELECT erg.workout_id
+        FROM erg
+        WHERE erg.workout_id = old.workout_id
+    );
+    RETURN NEW;
+END;
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS delete_all_pieces ON workout;
+
+CREATE TRIGGER delete_all_pieces
+    AFTER DELETE
+    ON workout
+    FOR EACH ROW
+    EXECUTE PROCEDURE remove_all_pieces();
+
+-- remove workouts once their last piece is deleted
+CREATE OR REPLACE FUNCTION remove_workouts_without_pieces() RETURNS trigger AS
+$$
+BEGIN
+    DELETE FROM workout
+    WHERE workout.workout_id NOT IN (
+        SELECT erg.workout_id
+        FROM erg
+        GROUP BY erg.workout_id
+    );
+    RETURN NEW;
+END
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS delete_workouts_without_pieces ON erg;
+
+CREATE TRIGGER delete_workouts_without_pieces
+    AFTER DELETE
+    ON erg
+    EXECUTE PROCEDURE remove_workouts_without_pieces();
+
+-- deleting a profile deletes its user
+CREATE OR REPLACE FUNCTION remove_user() RETURNS trigger AS
+$$
+BEGIN
+    DELETE FROM users
+    WHERE users.user_id = old.user_id;
+    RETURN NEW;
+END;
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS delete_user ON profile;
+
+CREATE TRIGGER delete_user
+    AFTER DELETE
+    ON profile
+    FOR EACH ROW
+    EXECUTE PROCEDURE remove_user();
+
+-- deleting a user deletes their profile
+CREATE OR REPLACE FUNCTION remove_profile() RETURNS trigger AS
+$$
+BEGIN
+    DELETE FROM profile
+    WHERE profile.user_id IN (old.user_id);
+    RETURN NEW;
+END;
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS delete_profile ON users;
+
+CREATE TRIGGER delete_profile
+    AFTER DELETE
+    ON users
+    FOR EACH ROW
+    EXECUTE PROCEDURE remove_profile();
@@ -0,0 +1,14 @@
+-- secondary indexes for the columns every page filters or joins on
+
+-- workouts of one user, newest first (get_aggregate_workouts_by_id, get_last_three_workouts, heat map)
+CREATE INDEX IF NOT EXISTS workout_user_id_time_idx ON workout (user_id, time DESC);
+
+-- leader boards filter every workout since last sunday
+CREATE INDEX IF NOT EXISTS workout_time_idx ON workout (time);
+
+-- pieces of a workout
+CREATE INDEX IF NOT EXISTS erg_workout_id_idx ON erg (workout_id);
+
+-- sign in, password recovery and email confirmation
+CREATE INDEX IF NOT EXISTS users_username_idx ON users (username);
+CREATE INDEX IF NOT EXISTS users_email_idx ON users (email);
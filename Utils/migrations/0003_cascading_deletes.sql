@@ -0,0 +1,60 @@
+-- child rows are removed by ON DELETE CASCADE foreign keys instead of row triggers, and a workout
+-- whose last piece is deleted is found through the deleted rows instead of scanning every workout
+
+-- users.user_id never got its primary key from the old column list
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'users'::regclass AND contype = 'p') THEN
+        ALTER TABLE users ADD PRIMARY KEY (user_id);
+    END IF;
+END
+$$;
+
+-- rows the old triggers missed would block the constraints
+DELETE FROM profile
+WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.user_id = profile.user_id);
+
+DELETE FROM workout
+WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.user_id = workout.user_id);
+
+DELETE FROM erg
+WHERE NOT EXISTS (SELECT 1 FROM workout WHERE workout.workout_id = erg.workout_id);
+
+ALTER TABLE workout
+    ADD CONSTRAINT workout_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE;
+
+ALTER TABLE erg
+    ADD CONSTRAINT erg_workout_id_fkey FOREIGN KEY (workout_id) REFERENCES workout (workout_id) ON DELETE CASCADE;
+
+ALTER TABLE profile
+    ADD CONSTRAINT profile_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE;
+
+-- replaced by erg_workout_id_fkey and profile_user_id_fkey
+DROP TRIGGER IF EXISTS delete_all_pieces ON workout;
+DROP FUNCTION IF EXISTS remove_all_pieces();
+
+DROP TRIGGER IF EXISTS delete_profile ON users;
+DROP FUNCTION IF EXISTS remove_profile();
+
+-- deleting a profile still deletes its user (delete_user); a foreign key only cascades the other way
+
+-- remove the workouts that lost their last piece in this statement
+CREATE OR REPLACE FUNCTION remove_workouts_without_pieces() RETURNS trigger AS
+$$
+BEGIN
+    DELETE FROM workout
+    WHERE workout.workout_id IN (SELECT DISTINCT old_pieces.workout_id FROM old_pieces)
+      AND NOT EXISTS (SELECT 1 FROM erg WHERE erg.workout_id = workout.workout_id);
+    RETURN NULL;
+END
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS delete_workouts_without_pieces ON erg;
+
+CREATE TRIGGER delete_workouts_without_pieces
+    AFTER DELETE
+    ON erg
+    REFERENCING OLD TABLE AS old_pieces
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE remove_workouts_without_pieces();
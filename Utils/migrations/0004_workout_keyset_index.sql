@@ -0,0 +1,5 @@
+-- workout history pages seek on (time, workout_id) within a user, newest first
+CREATE INDEX IF NOT EXISTS workout_user_id_time_workout_id_idx ON workout (user_id, time DESC, workout_id DESC);
+
+-- covered by the index above
+DROP INDEX IF EXISTS workout_user_id_time_idx;
@@ -0,0 +1,96 @@
+-- every workout carries the totals of its pieces, so the dashboard reads never join erg
+
+ALTER TABLE workout ADD COLUMN IF NOT EXISTS piece_count    INTEGER          NOT NULL DEFAULT 0;
+ALTER TABLE workout ADD COLUMN IF NOT EXISTS total_distance INTEGER          NOT NULL DEFAULT 0;
+ALTER TABLE workout ADD COLUMN IF NOT EXISTS total_seconds  DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE workout ADD COLUMN IF NOT EXISTS avg_distance   DOUBLE PRECISION;
+ALTER TABLE workout ADD COLUMN IF NOT EXISTS avg_seconds    DOUBLE PRECISION;
+-- seconds per 500m over all of the workout's pieces
+ALTER TABLE workout ADD COLUMN IF NOT EXISTS avg_split      DOUBLE PRECISION;
+
+-- recompute the totals of some workouts from their pieces; each costs one erg(workout_id) index scan
+CREATE OR REPLACE FUNCTION refresh_workout_totals(workout_ids INTEGER[]) RETURNS void AS
+$$
+    UPDATE workout AS w
+    SET piece_count    = t.piece_count,
+        total_distance = t.total_distance,
+        total_seconds  = t.total_seconds,
+        avg_distance   = t.total_distance::FLOAT / NULLIF(t.piece_count, 0),
+        avg_seconds    = t.total_seconds / NULLIF(t.piece_count, 0),
+        avg_split      = t.total_seconds / NULLIF(t.total_distance, 0) * 500
+    FROM (
+        SELECT ids.workout_id,
+               COUNT(e.erg_id)                                  AS piece_count,
+               COALESCE(SUM(e.distance), 0)                     AS total_distance,
+               COALESCE(SUM((e.minutes * 60) + e.seconds), 0)   AS total_seconds
+        FROM unnest(workout_ids) AS ids (workout_id)
+        LEFT JOIN erg AS e
+        ON e.workout_id = ids.workout_id
+        GROUP BY ids.workout_id
+    ) AS t
+    WHERE w.workout_id = t.workout_id;
+$$
+LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION refresh_inserted_workout_totals() RETURNS trigger AS
+$$
+BEGIN
+    PERFORM refresh_workout_totals(ARRAY(SELECT DISTINCT workout_id FROM new_pieces));
+    RETURN NULL;
+END
+$$
+LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_updated_workout_totals() RETURNS trigger AS
+$$
+BEGIN
+    PERFORM refresh_workout_totals(ARRAY(SELECT workout_id FROM old_pieces
+                                         UNION
+                                         SELECT workout_id FROM new_pieces));
+    RETURN NULL;
+END
+$$
+LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION refresh_deleted_workout_totals() RETURNS trigger AS
+$$
+BEGIN
+    PERFORM refresh_workout_totals(ARRAY(SELECT DISTINCT workout_id FROM old_pieces));
+    RETURN NULL;
+END
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS workout_totals_insert ON erg;
+DROP TRIGGER IF EXISTS workout_totals_update ON erg;
+DROP TRIGGER IF EXISTS workout_totals_delete ON erg;
+
+CREATE TRIGGER workout_totals_insert
+    AFTER INSERT
+    ON erg
+    REFERENCING NEW TABLE AS new_pieces
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE refresh_inserted_workout_totals();
+
+CREATE TRIGGER workout_totals_update
+    AFTER UPDATE
+    ON erg
+    REFERENCING OLD TABLE AS old_pieces NEW TABLE AS new_pieces
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE refresh_updated_workout_totals();
+
+CREATE TRIGGER workout_totals_delete
+    AFTER DELETE
+    ON erg
+    REFERENCING OLD TABLE AS old_pieces
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE refresh_deleted_workout_totals();
+
+-- backfill
+SELECT refresh_workout_totals(ARRAY(SELECT workout_id FROM workout));
+
+-- the history reads are answered from the index alone
+CREATE INDEX IF NOT EXISTS workout_user_history_idx ON workout (user_id, time DESC, workout_id DESC)
+    INCLUDE (name, by_distance, piece_count, total_distance, avg_distance, avg_seconds);
+
+DROP INDEX IF EXISTS workout_user_id_time_workout_id_idx;
@@ -0,0 +1,61 @@
+-- per (user, week) totals behind the team page leader boards; weeks start on monday, like get_last_sunday
+CREATE TABLE IF NOT EXISTS leader_board_week (
+    week_start DATE             NOT NULL,
+    user_id    INTEGER          NOT NULL,
+    meters     BIGINT           NOT NULL DEFAULT 0,
+    seconds    DOUBLE PRECISION NOT NULL DEFAULT 0,
+    pieces     INTEGER          NOT NULL DEFAULT 0,
+    PRIMARY KEY (week_start, user_id)
+);
+
+CREATE OR REPLACE FUNCTION add_to_leader_board_week(athlete_id INTEGER, workout_time TIMESTAMP, add_meters BIGINT,
+                                                    add_seconds DOUBLE PRECISION, add_pieces INTEGER) RETURNS void AS
+$$
+    INSERT INTO leader_board_week AS lb (week_start, user_id, meters, seconds, pieces)
+    VALUES (date_trunc('week', workout_time)::DATE, athlete_id, add_meters, add_seconds, add_pieces)
+    ON CONFLICT (week_start, user_id) DO UPDATE
+    SET meters  = lb.meters + EXCLUDED.meters,
+        seconds = lb.seconds + EXCLUDED.seconds,
+        pieces  = lb.pieces + EXCLUDED.pieces;
+
+    DELETE FROM leader_board_week
+    WHERE week_start = date_trunc('week', workout_time)::DATE
+    AND user_id = athlete_id
+    AND pieces <= 0;
+$$
+LANGUAGE sql;
+
+-- move a workout's totals out of its old week and into its new one; the erg triggers keep the totals
+-- on workout current, so this sees every piece insert, edit and delete
+CREATE OR REPLACE FUNCTION update_leader_board_week() RETURNS trigger AS
+$$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.piece_count > 0 THEN
+        PERFORM add_to_leader_board_week(OLD.user_id, OLD.time, -OLD.total_distance, -OLD.total_seconds,
+                                         -OLD.piece_count);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.piece_count > 0 THEN
+        PERFORM add_to_leader_board_week(NEW.user_id, NEW.time, NEW.total_distance, NEW.total_seconds,
+                                         NEW.piece_count);
+    END IF;
+    RETURN NULL;
+END
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS leader_board_week_totals ON workout;
+
+CREATE TRIGGER leader_board_week_totals
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, time, piece_count, total_distance, total_seconds
+    ON workout
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_leader_board_week();
+
+-- backfill
+TRUNCATE leader_board_week;
+
+INSERT INTO leader_board_week (week_start, user_id, meters, seconds, pieces)
+SELECT date_trunc('week', time)::DATE, user_id, SUM(total_distance), SUM(total_seconds), SUM(piece_count)
+FROM workout
+WHERE piece_count > 0
+GROUP BY date_trunc('week', time)::DATE, user_id;
@@ -0,0 +1,67 @@
+-- per (user, local day) totals behind the heat map calendar
+
+-- the calendar day a workout falls on for the team; workout times are stored in UTC. changing the zone
+-- means redefining this function in a new migration and rebuilding daily_activity
+CREATE OR REPLACE FUNCTION activity_day(workout_time TIMESTAMP) RETURNS DATE AS
+$$
+    SELECT ((workout_time AT TIME ZONE 'UTC') AT TIME ZONE 'America/Chicago')::DATE;
+$$
+LANGUAGE sql IMMUTABLE;
+
+CREATE TABLE IF NOT EXISTS daily_activity (
+    user_id  INTEGER          NOT NULL,
+    day      DATE             NOT NULL,
+    workouts INTEGER          NOT NULL DEFAULT 0,
+    meters   BIGINT           NOT NULL DEFAULT 0,
+    seconds  DOUBLE PRECISION NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day)
+);
+
+CREATE OR REPLACE FUNCTION add_to_daily_activity(athlete_id INTEGER, workout_time TIMESTAMP, add_workouts INTEGER,
+                                                 add_meters BIGINT, add_seconds DOUBLE PRECISION) RETURNS void AS
+$$
+    INSERT INTO daily_activity AS da (user_id, day, workouts, meters, seconds)
+    VALUES (athlete_id, activity_day(workout_time), add_workouts, add_meters, add_seconds)
+    ON CONFLICT (user_id, day) DO UPDATE
+    SET workouts = da.workouts + EXCLUDED.workouts,
+        meters   = da.meters + EXCLUDED.meters,
+        seconds  = da.seconds + EXCLUDED.seconds;
+
+    DELETE FROM daily_activity
+    WHERE user_id = athlete_id
+    AND day = activity_day(workout_time)
+    AND workouts <= 0;
+$$
+LANGUAGE sql;
+
+-- a workout counts once it has pieces, like the leader boards
+CREATE OR REPLACE FUNCTION update_daily_activity() RETURNS trigger AS
+$$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.piece_count > 0 THEN
+        PERFORM add_to_daily_activity(OLD.user_id, OLD.time, -1, -OLD.total_distance, -OLD.total_seconds);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.piece_count > 0 THEN
+        PERFORM add_to_daily_activity(NEW.user_id, NEW.time, 1, NEW.total_distance, NEW.total_seconds);
+    END IF;
+    RETURN NULL;
+END
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS daily_activity_totals ON workout;
+
+CREATE TRIGGER daily_activity_totals
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, time, piece_count, total_distance, total_seconds
+    ON workout
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_daily_activity();
+
+-- backfill
+TRUNCATE daily_activity;
+
+INSERT INTO daily_activity (user_id, day, workouts, meters, seconds)
+SELECT user_id, activity_day(time), COUNT(*), SUM(total_distance), SUM(total_seconds)
+FROM workout
+WHERE piece_count > 0
+GROUP BY user_id, activity_day(time);
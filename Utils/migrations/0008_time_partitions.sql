@@ -0,0 +1,205 @@
+-- workout and erg are range partitioned by month of the workout's time, so reads bounded in time only
+-- touch the months they ask for. needs PostgreSQL 11 or newer.
+--
+-- a partitioned table only enforces keys that include its partition key, so workout_id is no longer
+-- unique on its own (the sequence still hands out unique ids) and erg can't keep a foreign key to it;
+-- erg carries its workout's time instead and the triggers below do what erg_workout_id_fkey did
+
+ALTER TABLE erg DROP CONSTRAINT IF EXISTS erg_workout_id_fkey;
+
+ALTER TABLE workout RENAME TO workout_unpartitioned;
+ALTER TABLE erg RENAME TO erg_unpartitioned;
+
+-- keep the id sequences when the old tables are dropped
+ALTER SEQUENCE workout_workout_id_seq OWNED BY NONE;
+ALTER SEQUENCE erg_erg_id_seq OWNED BY NONE;
+
+CREATE TABLE workout (LIKE workout_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (time);
+
+CREATE TABLE erg (
+    LIKE erg_unpartitioned INCLUDING DEFAULTS,
+    workout_time TIMESTAMP NOT NULL
+) PARTITION BY RANGE (workout_time);
+
+-- rows outside every monthly partition, e.g. back dated workouts
+CREATE TABLE workout_default PARTITION OF workout DEFAULT;
+CREATE TABLE erg_default PARTITION OF erg DEFAULT;
+
+-- creates the monthly partitions of workout and erg from first_month through last_month that don't exist
+-- yet; a month that already has rows in a default partition is left there, since splitting it out would
+-- mean moving them
+CREATE OR REPLACE FUNCTION ensure_time_partitions(first_month DATE, last_month DATE) RETURNS INTEGER AS
+$$
+DECLARE
+    part_start DATE := date_trunc('month', first_month)::DATE;
+    part_end   DATE;
+    created    INTEGER := 0;
+BEGIN
+    WHILE part_start <= last_month LOOP
+        part_end := (part_start + INTERVAL '1 month')::DATE;
+
+        IF to_regclass('workout_' || to_char(part_start, 'YYYY_MM')) IS NULL THEN
+            IF EXISTS (SELECT 1 FROM workout_default WHERE time >= part_start AND time < part_end) THEN
+                RAISE NOTICE 'workouts of % are in workout_default; not creating its partition', part_start;
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF workout FOR VALUES FROM (%L) TO (%L)',
+                               'workout_' || to_char(part_start, 'YYYY_MM'), part_start, part_end);
+                created := created + 1;
+            END IF;
+        END IF;
+
+        IF to_regclass('erg_' || to_char(part_start, 'YYYY_MM')) IS NULL THEN
+            IF EXISTS (SELECT 1 FROM erg_default WHERE workout_time >= part_start AND workout_time < part_end) THEN
+                RAISE NOTICE 'pieces of % are in erg_default; not creating its partition', part_start;
+            ELSE
+                EXECUTE format('CREATE TABLE %I PARTITION OF erg FOR VALUES FROM (%L) TO (%L)',
+                               'erg_' || to_char(part_start, 'YYYY_MM'), part_start, part_end);
+                created := created + 1;
+            END IF;
+        END IF;
+
+        part_start := part_end;
+    END LOOP;
+    RETURN created;
+END
+$$
+LANGUAGE plpgsql;
+
+-- a partition for every month that has workouts; the app creates the coming months on start up
+SELECT ensure_time_partitions(part_month, part_month)
+FROM (SELECT DISTINCT date_trunc('month', time)::DATE AS part_month FROM workout_unpartitioned) AS months;
+
+INSERT INTO workout SELECT * FROM workout_unpartitioned;
+
+INSERT INTO erg (erg_id, workout_id, distance, minutes, seconds, workout_time)
+SELECT e.erg_id, e.workout_id, e.distance, e.minutes, e.seconds, w.time
+FROM erg_unpartitioned AS e
+JOIN workout_unpartitioned AS w
+ON w.workout_id = e.workout_id;
+
+-- takes their indexes and triggers along
+DROP TABLE erg_unpartitioned;
+DROP TABLE workout_unpartitioned;
+
+ALTER SEQUENCE workout_workout_id_seq OWNED BY workout.workout_id;
+ALTER SEQUENCE erg_erg_id_seq OWNED BY erg.erg_id;
+
+ALTER TABLE workout ADD PRIMARY KEY (workout_id, time);
+ALTER TABLE erg ADD PRIMARY KEY (erg_id, workout_time);
+
+ALTER TABLE workout
+    ADD CONSTRAINT workout_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE;
+
+CREATE INDEX workout_time_idx ON workout (time);
+CREATE INDEX workout_user_history_idx ON workout (user_id, time DESC, workout_id DESC)
+    INCLUDE (name, by_distance, piece_count, total_distance, avg_distance, avg_seconds);
+CREATE INDEX erg_workout_id_idx ON erg (workout_id, workout_time);
+
+-- pieces follow their workout: deleted with it, and moved when its time changes. an update that moves a
+-- workout to another month's partition runs as a delete and an insert, so a deleted workout whose id
+-- still exists has only moved
+CREATE OR REPLACE FUNCTION sync_workout_pieces() RETURNS trigger AS
+$$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        UPDATE erg
+        SET workout_time = NEW.time
+        WHERE workout_id = NEW.workout_id
+        AND workout_time = OLD.time;
+    ELSIF EXISTS (SELECT 1 FROM workout WHERE workout_id = OLD.workout_id) THEN
+        UPDATE erg
+        SET workout_time = w.time
+        FROM workout AS w
+        WHERE w.workout_id = OLD.workout_id
+        AND erg.workout_id = OLD.workout_id
+        AND erg.workout_time = OLD.time;
+    ELSE
+        DELETE FROM erg
+        WHERE workout_id = OLD.workout_id
+        AND workout_time = OLD.time;
+    END IF;
+    RETURN NULL;
+END
+$$
+LANGUAGE plpgsql;
+
+CREATE TRIGGER workout_pieces_delete
+    AFTER DELETE
+    ON workout
+    FOR EACH ROW
+    EXECUTE PROCEDURE sync_workout_pieces();
+
+CREATE TRIGGER workout_pieces_update
+    AFTER UPDATE OF time
+    ON workout
+    FOR EACH ROW
+    EXECUTE PROCEDURE sync_workout_pieces();
+
+-- the pieces of each workout are looked up in its own month
+CREATE OR REPLACE FUNCTION refresh_workout_totals(workout_ids INTEGER[]) RETURNS void AS
+$$
+    UPDATE workout AS w
+    SET piece_count    = t.piece_count,
+        total_distance = t.total_distance,
+        total_seconds  = t.total_seconds,
+        avg_distance   = t.total_distance::FLOAT / NULLIF(t.piece_count, 0),
+        avg_seconds    = t.total_seconds / NULLIF(t.piece_count, 0),
+        avg_split      = t.total_seconds / NULLIF(t.total_distance, 0) * 500
+    FROM (
+        SELECT cur.workout_id,
+               cur.time,
+               COUNT(e.erg_id)                                  AS piece_count,
+               COALESCE(SUM(e.distance), 0)                     AS total_distance,
+               COALESCE(SUM((e.minutes * 60) + e.seconds), 0)   AS total_seconds
+        FROM workout AS cur
+        LEFT JOIN erg AS e
+        ON e.workout_id = cur.workout_id
+        AND e.workout_time = cur.time
+        WHERE cur.workout_id = ANY(workout_ids)
+        GROUP BY cur.workout_id, cur.time
+    ) AS t
+    WHERE w.workout_id = t.workout_id
+    AND w.time = t.time;
+$$
+LANGUAGE sql;
+
+-- the triggers of migrations 0003, 0005, 0006 and 0007, on the new tables
+CREATE TRIGGER delete_workouts_without_pieces
+    AFTER DELETE
+    ON erg
+    REFERENCING OLD TABLE AS old_pieces
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE remove_workouts_without_pieces();
+
+CREATE TRIGGER workout_totals_insert
+    AFTER INSERT
+    ON erg
+    REFERENCING NEW TABLE AS new_pieces
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE refresh_inserted_workout_totals();
+
+CREATE TRIGGER workout_totals_update
+    AFTER UPDATE
+    ON erg
+    REFERENCING OLD TABLE AS old_pieces NEW TABLE AS new_pieces
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE refresh_updated_workout_totals();
+
+CREATE TRIGGER workout_totals_delete
+    AFTER DELETE
+    ON erg
+    REFERENCING OLD TABLE AS old_pieces
+    FOR EACH STATEMENT
+    EXECUTE PROCEDURE refresh_deleted_workout_totals();
+
+CREATE TRIGGER leader_board_week_totals
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, time, piece_count, total_distance, total_seconds
+    ON workout
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_leader_board_week();
+
+CREATE TRIGGER daily_activity_totals
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, time, piece_count, total_distance, total_seconds
+    ON workout
+    FOR EACH ROW
+    EXECUTE PROCEDURE update_daily_activity();
@@ -0,0 +1,6 @@
+-- squad leader boards start from the athletes of a team and look up each one's weekly totals
+
+CREATE INDEX IF NOT EXISTS users_team_user_id_idx ON users (team, user_id) INCLUDE (username);
+
+CREATE INDEX IF NOT EXISTS leader_board_week_user_id_idx ON leader_board_week (user_id, week_start)
+    INCLUDE (meters, seconds);
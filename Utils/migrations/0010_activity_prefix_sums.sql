@@ -0,0 +1,63 @@
+-- running totals per athlete through each active day, so the totals of any range of days are the
+-- running total at its end minus the one before its start
+
+ALTER TABLE daily_activity ADD COLUMN IF NOT EXISTS cum_workouts BIGINT           NOT NULL DEFAULT 0;
+ALTER TABLE daily_activity ADD COLUMN IF NOT EXISTS cum_meters   BIGINT           NOT NULL DEFAULT 0;
+ALTER TABLE daily_activity ADD COLUMN IF NOT EXISTS cum_seconds  DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+-- a workout logged today only touches today's row; a back dated one shifts the days after it
+CREATE OR REPLACE FUNCTION add_to_daily_activity(athlete_id INTEGER, workout_time TIMESTAMP, add_workouts INTEGER,
+                                                 add_meters BIGINT, add_seconds DOUBLE PRECISION) RETURNS void AS
+$$
+    INSERT INTO daily_activity AS da (user_id, day, workouts, meters, seconds)
+    VALUES (athlete_id, activity_day(workout_time), add_workouts, add_meters, add_seconds)
+    ON CONFLICT (user_id, day) DO UPDATE
+    SET workouts = da.workouts + EXCLUDED.workouts,
+        meters   = da.meters + EXCLUDED.meters,
+        seconds  = da.seconds + EXCLUDED.seconds;
+
+    UPDATE daily_activity
+    SET cum_workouts = cum_workouts + add_workouts,
+        cum_meters   = cum_meters + add_meters,
+        cum_seconds  = cum_seconds + add_seconds
+    WHERE user_id = athlete_id
+    AND day > activity_day(workout_time);
+
+    UPDATE daily_activity AS da
+    SET cum_workouts = da.workouts + COALESCE(prev.cum_workouts, 0),
+        cum_meters   = da.meters + COALESCE(prev.cum_meters, 0),
+        cum_seconds  = da.seconds + COALESCE(prev.cum_seconds, 0)
+    FROM (SELECT 1) AS one
+    LEFT JOIN LATERAL (
+        SELECT cum_workouts, cum_meters, cum_seconds
+        FROM daily_activity
+        WHERE user_id = athlete_id
+        AND day < activity_day(workout_time)
+        ORDER BY day DESC
+        LIMIT 1
+    ) AS prev ON TRUE
+    WHERE da.user_id = athlete_id
+    AND da.day = activity_day(workout_time);
+
+    -- the running totals of later days already include everything up to here
+    DELETE FROM daily_activity
+    WHERE user_id = athlete_id
+    AND day = activity_day(workout_time)
+    AND workouts <= 0;
+$$
+LANGUAGE sql;
+
+-- backfill
+UPDATE daily_activity AS da
+SET cum_workouts = running.cum_workouts,
+    cum_meters   = running.cum_meters,
+    cum_seconds  = running.cum_seconds
+FROM (
+    SELECT user_id, day,
+           SUM(workouts) OVER (PARTITION BY user_id ORDER BY day) AS cum_workouts,
+           SUM(meters) OVER (PARTITION BY user_id ORDER BY day)   AS cum_meters,
+           SUM(seconds) OVER (PARTITION BY user_id ORDER BY day)  AS cum_seconds
+    FROM daily_activity
+) AS running
+WHERE da.user_id = running.user_id
+AND da.day = running.day;
@@ -0,0 +1,18 @@
+-- the final standings of every finished week, archived once the week is over; a past week is read with one
+-- primary key range scan. migration 0012 keeps an archived week in sync with later edits to its workouts
+CREATE TABLE IF NOT EXISTS leader_board_archive (
+    week_start    DATE             NOT NULL,
+    user_id       INTEGER          NOT NULL,
+    username      VARCHAR(20),
+    total_meters  BIGINT           NOT NULL,
+    total_seconds DOUBLE PRECISION NOT NULL,
+    split         DOUBLE PRECISION,
+    meters_rank   INTEGER          NOT NULL,
+    minutes_rank  INTEGER          NOT NULL,
+    split_rank    INTEGER          NOT NULL,
+    meters_place  INTEGER          NOT NULL,
+    minutes_place INTEGER          NOT NULL,
+    split_place   INTEGER          NOT NULL,
+    archived_at   TIMESTAMP        NOT NULL DEFAULT (now()),
+    PRIMARY KEY (week_start, user_id)
+);
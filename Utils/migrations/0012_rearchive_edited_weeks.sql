@@ -0,0 +1,61 @@
+-- a finished week's archive follows later edits to its workouts: each change to the week's totals ranks the
+-- week again. edits to past weeks are rare, and a week that isn't archived yet is skipped with one lookup
+
+-- (re)archives one week from its totals and returns the number of rows archived
+CREATE OR REPLACE FUNCTION archive_leader_board_week(week DATE) RETURNS INTEGER AS
+$$
+    DELETE FROM leader_board_archive WHERE week_start = week;
+
+    WITH archived AS (
+        INSERT INTO leader_board_archive (week_start, user_id, username, total_meters, total_seconds, split,
+                                          meters_rank, minutes_rank, split_rank,
+                                          meters_place, minutes_place, split_place)
+        SELECT week, user_id, username, total_meters, total_seconds, split,
+               rank() OVER (ORDER BY total_meters DESC),
+               rank() OVER (ORDER BY total_seconds DESC),
+               rank() OVER (ORDER BY split NULLS LAST),
+               row_number() OVER (ORDER BY total_meters DESC, username),
+               row_number() OVER (ORDER BY total_seconds DESC, username),
+               row_number() OVER (ORDER BY split NULLS LAST, username)
+        FROM (
+            SELECT lb.user_id, u.username,
+                   lb.meters AS total_meters,
+                   lb.seconds AS total_seconds,
+                   (lb.seconds / NULLIF(lb.meters, 0)::FLOAT) * 500 AS split
+            FROM leader_board_week AS lb
+            JOIN users AS u
+            ON u.user_id = lb.user_id
+            WHERE lb.week_start = week
+        ) AS totals
+        -- another process archiving the same week at the same time already did
+        ON CONFLICT (week_start, user_id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM archived;
+$$
+LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION rearchive_leader_board_week() RETURNS trigger AS
+$$
+DECLARE
+    week DATE := CASE WHEN TG_OP = 'DELETE' THEN OLD.week_start ELSE NEW.week_start END;
+BEGIN
+    IF EXISTS (SELECT 1 FROM leader_board_archive WHERE week_start = week) THEN
+        PERFORM archive_leader_board_week(week);
+    END IF;
+    RETURN NULL;
+END
+$$
+LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS leader_board_archive_edits ON leader_board_week;
+
+CREATE TRIGGER leader_board_archive_edits
+    AFTER INSERT OR UPDATE OR DELETE
+    ON leader_board_week
+    FOR EACH ROW
+    EXECUTE PROCEDURE rearchive_leader_board_week();
+
+-- weeks archived before this migration may already be stale
+SELECT archive_leader_board_week(week_start)
+FROM (SELECT DISTINCT week_start FROM leader_board_archive) AS weeks;
@@ -0,0 +1,160 @@
+import datetime
+import os
+import re
+
+import psycopg2
+
+from Utils.log import log
+
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# migration files are applied in order of their four digit prefix, e.g. 0002_lookup_indexes.sql
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+# key of the advisory lock held while migrating, so two app instances starting together don't race
+MIGRATION_LOCK = 7142253
+
+# months past the current one that get their workout and erg partitions ahead of time (migration 0008)
+PARTITION_MONTHS_AHEAD = 3
+
+SCHEMA_VERSION_TABLE = '''CREATE TABLE IF NOT EXISTS schema_version (
+                            version    INTEGER     PRIMARY KEY,
+                            name       VARCHAR(100) NOT NULL,
+                            applied_at TIMESTAMP    NOT NULL DEFAULT (now())
+                        )'''
+
+
+def available():
+    """
+    :return: a list of (version, name, path) tuples for every migration file, in version order
+    """
+    found = []
+    for file_name in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(file_name)
+        if match:
+            found.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, file_name)))
+    found.sort()
+    return found
+
+
+def latest_version():
+    """
+    :return: the version of the newest migration file, 0 if there are none
+    """
+    migrations = available()
+    return migrations[-1][0] if migrations else 0
+
+
+def _read_version(cur):
+    cur.execute('SELECT MAX(version) AS version FROM schema_version')
+    return cur.fetchone()['version'] or 0
+
+
+def current_version(db):
+    """
+    :param db: a Database
+    :return: the newest migration applied to the database, 0 if it has never been migrated
+    """
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            try:
+                version = _read_version(cur)
+            except psycopg2.ProgrammingError:
+                # no schema_version table yet
+                conn.rollback()
+                return 0
+    db.commit()
+    return version
+
+
+def migrate(db):
+    """
+    applies every migration newer than the database's schema version, each in its own transaction
+    :param db: a Database
+    :return: the list of versions that were applied
+    """
+    applied = []
+    target = latest_version()
+    if current_version(db) >= target:
+        return applied
+
+    for version, name, path in available():
+        with open(path) as f:
+            statements = f.read()
+
+        with db.transaction():
+            with db.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK,))
+                    cur.execute(SCHEMA_VERSION_TABLE)
+                    # another instance may have applied it while we waited for the lock
+                    if _read_version(cur) >= version:
+                        continue
+                    log.info('Applying migration {:04d}_{}'.format(version, name))
+                    cur.execute(statements)
+                    cur.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+        applied.append(version)
+
+    return applied
+
+
+def check(db):
+    """
+    warns if the database is behind the migration files
+    :param db: a Database
+    :return: true if the schema is up to date
+    """
+    version = current_version(db)
+    target = latest_version()
+    if version < target:
+        log.warning('Database schema is at version {} but migrations go up to {}; '
+                    'start with REQ_DB_INIT set to apply them'.format(version, target))
+        return False
+    return True
+
+
+def last_partition_month(now, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    :param now: a date or datetime
+    :param months_ahead: how many months past the one of now to cover
+    :return: the first day of the last month ensure_partitions covers from now
+    """
+    month_index = now.year * 12 + now.month - 1 + months_ahead
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_months(now, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    :param now: a date or datetime
+    :param months_ahead: how many months past the one of now to cover
+    :return: the first days of the months ensure_partitions covers from now, in order
+    """
+    first_index = now.year * 12 + now.month - 1
+    return [datetime.date(index // 12, index % 12 + 1, 1)
+            for index in range(first_index, first_index + months_ahead + 1)]
+
+
+def ensure_partitions(db, months_ahead=PARTITION_MONTHS_AHEAD, now=None):
+    """
+    creates the monthly workout and erg partitions from the current month through months_ahead months
+    past it; workouts in months without one land in the default partitions
+    :param db: a Database whose schema is up to date
+    :param months_ahead: how many months past the current one to cover
+    :param now: optional; a date or datetime to cover from instead of the current month
+    :return: the number of partitions created
+    """
+    now = now or datetime.datetime.utcnow()
+    first_month = datetime.date(now.year, now.month, 1)
+    last_month = last_partition_month(now, months_ahead)
+
+    with db.transaction():
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK,))
+                cur.execute('SELECT ensure_time_partitions(%s, %s) AS created', (first_month, last_month))
+                created = cur.fetchone()['created']
+
+    if created:
+        log.info('Created {} monthly partitions through {}'.format(created, last_month))
+    return created
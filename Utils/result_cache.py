@@ -0,0 +1,212 @@
+import collections
+import copy
+import sys
+import threading
+
+
+# deleting from a table also deletes from these, through ON DELETE CASCADE foreign keys and triggers
+CASCADES = {
+    'users': ('profile', 'workout'),
+    'profile': ('users',),
+    'workout': ('erg',),
+    'erg': ('workout',)
+}
+
+# any write to a table also writes these, through triggers: erg keeps the totals of its workout (migration 0005),
+# workout moves its pieces with its time (0008), both roll up into the weekly and daily totals (0006, 0007) and
+# the weekly totals of an archived week are archived again (0012)
+TRIGGERED = {
+    'workout': ('erg', 'leader_board_week', 'daily_activity'),
+    'erg': ('workout', 'leader_board_week', 'daily_activity'),
+    'leader_board_week': ('leader_board_archive',)
+}
+
+
+def cascaded_tables(table, delete=True):
+    """
+    :param table: the table a row was written to
+    :param delete: true if the write was a delete, so the CASCADES are followed too
+    :return: every other table the write can reach
+    """
+    seen = {table}
+    pending = [table]
+    while pending:
+        current = pending.pop()
+        children = TRIGGERED.get(current, ()) + (CASCADES.get(current, ()) if delete else ())
+        for child in children:
+            if child not in seen:
+                seen.add(child)
+                pending.append(child)
+    seen.discard(table)
+    return seen
+
+
+def approximate_size(value):
+    """
+    :param value: a cached result; a row, a list of rows or a scalar
+    :return: a rough size in bytes, counting the containers and the values of each row
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+
+def normalize_dep(dep):
+    """
+    :param dep: a (table, None) or (table, column, value) dependency
+    :return: the dependency with its value as a string, so 5 and '5' name the same row
+    """
+    if dep[1] is None:
+        return dep
+    return dep[0], dep[1], str(dep[2])
+
+
+class CacheEntry:
+    __slots__ = ('value', 'size', 'deps')
+
+    def __init__(self, value, size, deps):
+        self.value = value
+        self.size = size
+        self.deps = deps
+
+
+class ResultCache:
+    """
+    an LRU cache of query results, capped by an approximate memory size. each entry lists the rows it
+    read as dependencies: (table, None) for the whole table or (table, column, value) for the rows where
+    column = value. writes invalidate the entries they could have changed.
+
+    the cache lives in one process; writes made by other processes or straight through SQL are not seen,
+    so it should only be turned on where this process makes every write
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        """
+
+        :param max_bytes: the approximate memory the cached results may take before the least recently
+        used are evicted
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._by_table = collections.defaultdict(set)
+        # bumped on every invalidation, so a read that raced a write is not stored
+        self._generations = collections.defaultdict(int)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        :param key: a hashable statement shape and parameters
+        :return: a (hit, value) tuple; the value is a copy, so callers may modify it
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            value = entry.value
+        return True, copy.deepcopy(value)
+
+    def token(self, deps):
+        """
+        :param deps: the dependencies of a read that is about to run
+        :return: a token for put(); a read whose tables were written to in the meantime is not stored
+        """
+        with self._lock:
+            return tuple(self._generations[dep[0]] for dep in deps)
+
+    def put(self, key, value, deps, token):
+        """
+        :param key: a hashable statement shape and parameters
+        :param value: the result of the read
+        :param deps: the dependencies of the read
+        :param token: the token taken before the read ran
+        :return: nothing
+        """
+        size = approximate_size(value)
+        if size > self.max_bytes:
+            return
+        value = copy.deepcopy(value)
+        deps = [normalize_dep(dep) for dep in deps]
+
+        with self._lock:
+            if token != tuple(self._generations[dep[0]] for dep in deps):
+                return
+            self._remove(key)
+            self._entries[key] = CacheEntry(value, size, deps)
+            self.bytes += size
+            for dep in deps:
+                self._by_table[dep[0]].add(key)
+
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        for dep in entry.deps:
+            self._by_table[dep[0]].discard(key)
+
+    def invalidate(self, table, rows=None):
+        """
+        drop the entries a write to a table could have changed
+        :param table: the table written to
+        :param rows: optional dictionary of column to the set of values identifying the written rows; entries
+        that read other rows of the table by the same column are kept. without it every entry of the table goes
+        :return: nothing
+        """
+        if rows is not None:
+            # ids arrive as ints from the db and as strings from forms and flask-login
+            rows = {col: {str(value) for value in values} for col, values in rows.items()}
+
+        with self._lock:
+            self._generations[table] += 1
+            for key in list(self._by_table[table]):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if rows is None or any(dep[0] == table and not self._unaffected(dep, rows) for dep in entry.deps):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    @staticmethod
+    def _unaffected(dep, rows):
+        # a dependency on other values of a column the write was identified by
+        return dep[1] is not None and dep[1] in rows and dep[2] not in rows[dep[1]]
+
+    def clear(self):
+        with self._lock:
+            for table in self._by_table:
+                self._generations[table] += 1
+            self._entries.clear()
+            self._by_table.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        :return: a dictionary with the entry count, size and hit ratio of the cache
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
@@ -0,0 +1,136 @@
+import collections
+import datetime
+import queue
+import re
+import threading
+
+import psycopg2
+
+from Utils.db_pool import connect
+from Utils.log import log
+
+
+# only plain reads are re-run under EXPLAIN ANALYZE; anything that writes is captured without a plan
+READ_ONLY_STATEMENT = re.compile(r'^\s*(SELECT|WITH)\b', re.IGNORECASE)
+WRITE_KEYWORDS = re.compile(r'\b(INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+
+class SlowQueryLog:
+    """
+    captures statements slower than a threshold, along with an EXPLAIN (ANALYZE, BUFFERS) plan,
+    into a ring buffer; plans are gathered on a background thread with its own connections so the
+    request that ran the slow statement never waits for them. a statement is explained on the database
+    that ran it, so replica reads are planned, and their cost paid, on the replica
+    """
+
+    def __init__(self, threshold=0.5, capacity=100, max_pending=20):
+        """
+
+        :param threshold: seconds a statement must take to be captured
+        :param capacity: how many captured statements the ring buffer keeps
+        :param max_pending: how many statements may wait for a plan; later ones are dropped until the queue drains
+        """
+        self.threshold = threshold
+        self.capacity = capacity
+        self.dropped = 0
+        self._entries = collections.deque(maxlen=capacity)
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._connect_strs = {}
+        # replica flag -> the worker's connection to that database
+        self._conns = {}
+        self._thread = None
+
+    def start(self, connect_str, replica_connect_str=None):
+        """
+        start the background worker
+        :param connect_str: the libpq connection string of the primary
+        :param replica_connect_str: optional; the libpq connection string of the read replica
+        :return: nothing
+        """
+        if self._thread is not None:
+            return
+        self._connect_strs = {False: connect_str, True: replica_connect_str}
+        self._thread = threading.Thread(target=self._run, name='slow-query-explain', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        stop the background worker once it has captured the statements already queued, and close its connections
+        :return: nothing
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, shape, duration, query, replica=False):
+        """
+        queue a slow statement for capture; never blocks
+        :param shape: the statement shape label
+        :param duration: seconds the statement took
+        :param query: the statement text with its parameters already bound
+        :param replica: true if the statement ran on the read replica
+        :return: nothing
+        """
+        entry = {
+            'shape': shape,
+            'duration': duration,
+            'query': query,
+            'replica': replica,
+            'plan': None,
+            'captured_at': datetime.datetime.utcnow().isoformat()
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _explain(self, query, replica):
+        connect_str = self._connect_strs.get(replica)
+        if connect_str is None:
+            return None
+        conn = self._conns.get(replica)
+        if conn is None or conn.closed:
+            conn = self._conns[replica] = connect(connect_str)
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query)
+                return '\n'.join(row['QUERY PLAN'] for row in cur.fetchall())
+        finally:
+            # ANALYZE runs the statement for real; never keep anything it did
+            conn.rollback()
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            query = entry['query']
+            if READ_ONLY_STATEMENT.match(query) and not WRITE_KEYWORDS.search(query):
+                try:
+                    entry['plan'] = self._explain(query, entry['replica'])
+                except psycopg2.Error as e:
+                    entry['plan'] = 'EXPLAIN failed: {}'.format(e)
+            log.warning('slow query {} ({:.4f}s): {}\n{}'.format(entry['shape'], entry['duration'], query,
+                                                              entry['plan']))
+            self._entries.append(entry)
+
+        for conn in self._conns.values():
+            conn.close()
+        self._conns = {}
+
+    def entries(self):
+        """
+        :return: the captured statements, oldest first
+        """
+        return list(self._entries)
+
+    def stats(self):
+        return {
+            'threshold': self.threshold,
+            'captured': len(self._entries),
+            'pending': self._queue.qsize(),
+            'dropped': self.dropped
+        }
@@ -0,0 +1,156 @@
+import re
+import threading
+
+from psycopg2 import extensions
+
+
+class StatementConnection(extensions.connection):
+    """
+    psycopg2 connection that remembers which named statements have been PREPAREd on it
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def shape_label(key):
+    """
+    :param key: a registry key such as ('select', 'users', ('username',), ('user_id',), None, None)
+    :return: a readable label such as 'select:users:username:user_id'
+    """
+    parts = []
+    for part in key:
+        if part is None:
+            continue
+        if isinstance(part, tuple):
+            part = ','.join(map(str, part))
+        parts.append(str(part))
+    return ':'.join(parts)
+
+
+class PreparedStatement:
+    """
+    a query shape compiled once; it is PREPAREd lazily on each connection that runs it
+    """
+
+    def __init__(self, name, key, query):
+        """
+
+        :param name: the server-side statement name
+        :param key: the tuple identifying the query shape in the registry
+        :param query: a psycopg2 Composable using only Placeholders for its parameters
+        """
+        self.name = name
+        self.key = key
+        self.label = shape_label(key)
+        self.query = query
+        self.num_params = 0
+        self.prepare_sql = None
+        self.execute_sql = None
+
+    def compile(self, conn):
+        """
+        render the query once, swapping psycopg2 '%s' placeholders for positional '$n' parameters
+        :param conn: any open connection, needed to quote identifiers
+        :return: nothing
+        """
+        if self.prepare_sql is not None:
+            return
+
+        parts = re.split(r'(%%|%s)', self.query.as_string(conn))
+        count = 0
+        text = []
+        for part in parts:
+            if part == '%s':
+                count += 1
+                text.append('${}'.format(count))
+            elif part == '%%':
+                text.append('%')
+            else:
+                text.append(part)
+
+        self.num_params = count
+        if count:
+            self.execute_sql = 'EXECUTE {} ({})'.format(self.name, ', '.join(['%s'] * count))
+        else:
+            self.execute_sql = 'EXECUTE {}'.format(self.name)
+        # set last; other threads treat a non-empty prepare_sql as fully compiled
+        self.prepare_sql = 'PREPARE {} AS {}'.format(self.name, ''.join(text))
+
+    def __repr__(self):
+        return '<PreparedStatement {} {}>'.format(self.name, self.key)
+
+
+class StatementRegistry:
+    """
+    keeps one PreparedStatement per query shape and counts how often a connection
+    could reuse an existing server-side plan (hit) versus having to PREPARE it (miss)
+    """
+
+    def __init__(self, enabled=True):
+        """
+
+        :param enabled: false to run the compiled queries directly instead of through PREPARE/EXECUTE
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._statements = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        """
+        :param key: a hashable tuple describing the query shape, e.g. ('select', 'users', ...)
+        :param build: a function returning the Composable for the shape; only called the first time
+        :return: the PreparedStatement for the shape
+        """
+        statement = self._statements.get(key)
+        if statement is None:
+            with self._lock:
+                statement = self._statements.get(key)
+                if statement is None:
+                    name = 'athl_{}'.format(len(self._statements))
+                    statement = PreparedStatement(name, key, build())
+                    self._statements[key] = statement
+        return statement
+
+    def execute(self, cur, statement, params=None):
+        """
+        run a statement on the cursor's connection, preparing it first if that connection has not seen it
+        :param cur: an open cursor
+        :param statement: a PreparedStatement from this registry
+        :param params: the positional parameters of the statement
+        :return: nothing; results are read from the cursor
+        """
+        if not self.enabled:
+            cur.execute(statement.query, params)
+            return
+
+        conn = cur.connection
+        statement.compile(conn)
+
+        if statement.name in conn.prepared:
+            with self._lock:
+                self.hits += 1
+        else:
+            cur.execute(statement.prepare_sql)
+            conn.prepared.add(statement.name)
+            with self._lock:
+                self.misses += 1
+
+        cur.execute(statement.execute_sql, params)
+
+    def stats(self):
+        """
+        :return: a dictionary with the number of compiled shapes and the prepare hit/miss counters
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'statements': len(self._statements),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0
+            }
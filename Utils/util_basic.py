@@ -14,7 +14,7 @@ import requests
 from Forms import web_forms
 from Utils.log import log
 
-from Utils.config import db
+from Utils.config import LEADER_BOARD_CACHE, async_db, db
 from Utils.config import password_recovery_email, password_recovery_email_creds
 
 
@@ -34,13 +34,9 @@ except KeyError:
 def create_workout(user_id, db, meters, minutes, seconds, by_distance):
     # TODO should this be a part of user??
 
-    # get time stamp without seconds
+    # get time stamp without microseconds
     date_stamp = datetime.datetime.utcnow()
-    stamp = "{}-{}-{} {}:{}:{}".format(date_stamp.year, date_stamp.month, date_stamp.day, date_stamp.hour,
-                                           date_stamp.minute, date_stamp.second)
-    # stamp = '0000-00-00 00:00:00'
-    print(stamp)
-    # utc_date_stamp = time.time() // 1
+    stamp = date_stamp.replace(microsecond=0)
 
     # name the piece
     name = str(len(meters)) + 'x'
@@ -52,67 +48,115 @@ def create_workout(user_id, db, meters, minutes, seconds, by_distance):
         else:
             name += str(seconds[0]) + '\"'
 
-    # create workout
-    workout_id = db.insert('workout', ['user_id', 'time', 'by_distance', 'name'],
-                           [user_id, stamp, by_distance, name], 'workout_id')
-
-    # create erg workout
-    for meter, minute, second in zip(meters, minutes, seconds):
-        print(meter, minute, second)
-        db.insert('erg', ['workout_id', 'distance', 'minutes', 'seconds'], [workout_id, meter, minute, second], 'erg_id')
+    # create workout and erg pieces in one round trip
+    db.insert_workout(user_id, stamp, by_distance, name, list(zip(meters, minutes, seconds)))
+    LEADER_BOARD_CACHE.invalidate(date_stamp)
 
     return name
 
 
 def build_graph_data(results, workout_name):
-    data_arr = []
-    label_arr = []
-    _ids = []
+    """
+    :param results: get_aggregate_workouts_by_name columns, fetched with row_format='numpy'
+    :param workout_name: the name of the workouts
+    :return: the chart data as JSON
+    """
+    by_distance = results['by_distance']
 
+    # workouts rowed for a distance plot their time, workouts rowed for a time plot their distance
+    data_arr = np.where(by_distance == 0, results['distance'].astype(float),
+                        results['total_seconds'].astype(float) / 60)
+    # no workouts of that name, e.g. all of them were deleted
     y_axis = ''
-
-    for res in results:
-        if res['by_distance'] == 0:
-            data_arr.append(float(res['distance']))
-            y_axis = 'Meters'
-        else:
-            data_arr.append(float(res['total_seconds'])/float(60))
-            y_axis = 'Minutes'
-        label_arr.append(res['time'].strftime('%m-%d-%y'))
-        _ids.append(res['workout_id'])
+    if len(by_distance):
+        y_axis = 'Meters' if by_distance[-1] == 0 else 'Minutes'
 
     data = {
-        'data': data_arr,
-        'labels': label_arr,
+        'data': data_arr.tolist(),
+        'labels': [stamp.strftime('%m-%d-%y') for stamp in results['time']],
         'name': workout_name,
         'y_axis': y_axis,
-        '_ids': _ids
+        '_ids': results['workout_id'].tolist()
     }
     js = json.dumps(data)
 
     return js
 
 
+def stream_json_array(rows):
+    """
+    serialize rows as a JSON array one row at a time, so a streamed result never sits in memory whole
+    :param rows: an iterable of JSON serializable rows, e.g. from db.select(..., stream=True)
+    :return: a generator of JSON text chunks
+    """
+    yield '['
+    first = True
+    for row in rows:
+        if not first:
+            yield ','
+        first = False
+        yield json.dumps(row)
+    yield ']'
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def parse_page_args(args):
+    """
+    read the page size and cursor of a paginated request
+    :param args: the request's query arguments; 'limit' and 'before', both optional
+    :return: a (limit, cursor) tuple; limit is clamped to MAX_PAGE_SIZE and cursor is None for the first page
+    :raises ValueError: if either argument is malformed
+    """
+    limit = min(max(int(args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+
+    before = args.get('before')
+    if not before:
+        return limit, None
+    time_str, workout_id = before.rsplit('_', 1)
+    return limit, (datetime.datetime.strptime(time_str, CURSOR_TIME_FORMAT), int(workout_id))
+
+
+def format_page_cursor(cursor):
+    """
+    :param cursor: a (time, workout_id) cursor from the db, or None
+    :return: the cursor as the 'before' argument of the next request, or None on the last page
+    """
+    if cursor is None:
+        return None
+    return '{}_{}'.format(cursor[0].strftime(CURSOR_TIME_FORMAT), cursor[1])
+
+
 def edit_erg_workout(request, db):
     by_distance = int(request.form.get('by_distance'))
     erg_ids = request.form.getlist('erg_ids[]')
 
-    if by_distance == 1:
-        meters = request.form.getlist('meters[]')
-        for i in range(len(erg_ids)):
-            db.update('erg', ['distance'], [int(meters[i])], ['erg_id'], [int(erg_ids[i])])
-    else:
-        minutes = request.form.getlist('minutes[]')
-        seconds = request.form.getlist('seconds[]')
-
-        for i in range(len(erg_ids)):
-            db.update('erg', ['minutes', 'seconds'], [int(minutes[i]), float(seconds[i])], ['erg_id'], [erg_ids[i]])
-
     workout_id = request.form.get('workout_id')
     if workout_id:
-        new_date = request.form.get('new_date') + ":00"
-        print(new_date)
-        db.update('workout', ['time'], [new_date], ['workout_id'], [workout_id])
+        new_date = datetime.datetime.fromisoformat(request.form.get('new_date') + ":00")
+        # before the transaction, so it doesn't hold the partition lock
+        db.ensure_partitions(new_date)
+
+    # every piece and the new date are saved together or not at all
+    with db.transaction():
+        if by_distance == 1:
+            meters = request.form.getlist('meters[]')
+            db.update_many('erg', 'erg_id', ['distance'],
+                           [(int(erg_ids[i]), int(meters[i])) for i in range(len(erg_ids))])
+        else:
+            minutes = request.form.getlist('minutes[]')
+            seconds = request.form.getlist('seconds[]')
+            db.update_many('erg', 'erg_id', ['minutes', 'seconds'],
+                           [(int(erg_ids[i]), int(minutes[i]), float(seconds[i])) for i in range(len(erg_ids))])
+
+        if workout_id:
+            db.update('workout', ['time'], [new_date], ['workout_id'], [workout_id])
+
+    # the workout may have moved between weeks
+    LEADER_BOARD_CACHE.invalidate()
 
 
 def set_up_profile_form(user, profile):
@@ -232,59 +276,150 @@ def get_last_sunday(curr_date):
     return last_sunday_stamp
 
 
+# places shown on each leader board, besides the viewer's own row
+LEADER_BOARD_TOP = 5
+
+
 def format_leader_arr(arr, key_name, username):
     """
-
-    :param arr:
-    :param key_name:
-    :param username:
-    :return:
+    the rows shown on one board: the top five, then the viewer's row if they are placed lower, or the
+    sixth place if they are not; missing rows are filled in
+    :param arr: the rows of the board, best first; only the top six and the viewer's row are needed
+    :param key_name: the column the board ranks by
+    :param username: the viewer
+    :return: a list of six rows
     """
 
-    ret_val = []
-    found_user = False
-    count = 0
-
-    for user in arr:
-        if count < 5:
-            ret_val.append(user)
-            count += 1
-        elif count < 6 and found_user:
-            ret_val.append(user)
-            count += 1
-        if user['username'] == username:
-            found_user = True
-        if count > 5:
-            break
-
-    if not found_user:
-        ret_val.append({'username': username, key_name: 0})
-
-    while len(ret_val) < 6:
+    ret_val = arr[:LEADER_BOARD_TOP]
+
+    if any(user['username'] == username for user in ret_val):
+        ret_val += arr[LEADER_BOARD_TOP:LEADER_BOARD_TOP + 1]
+    else:
+        own = next((user for user in arr if user['username'] == username), None)
+        ret_val.append(own or {'username': username, key_name: 0})
+
+    while len(ret_val) < LEADER_BOARD_TOP + 1:
         ret_val.append({'username': 'Unclaimed', key_name: 0})
 
     return ret_val
 
 
-def generate_leader_board(username):
+# the rolling windows /team can rank over, besides the week since last sunday
+LEADER_BOARD_WINDOWS = {
+    '7d': 'the last 7 days',
+    '30d': 'the last 30 days',
+    'season': 'this season',
+    'all': 'all time'
+}
+
+# the season starts in september
+SEASON_START_MONTH = 9
+
+
+def leader_board_window(window, today):
+    """
+    :param window: a key of LEADER_BOARD_WINDOWS
+    :param today: the team's local date today
+    :return: the (start, end) dates of the window, both included
+    """
+    if window == '7d':
+        return today - datetime.timedelta(days=6), today
+    if window == '30d':
+        return today - datetime.timedelta(days=29), today
+    if window == 'season':
+        year = today.year if today.month >= SEASON_START_MONTH else today.year - 1
+        return datetime.date(year, SEASON_START_MONTH, 1), today
+    return datetime.date.min, today
+
+
+def rank_leader_boards(rows, username):
+    """
+    :param rows: rows of db.get_leader_board_top or db.get_leader_board_window for the top six places
+    :param username: the viewer
+    :return: the meters, minutes and split boards, each best first and holding only the rows
+    format_leader_arr needs
+    """
+    boards = []
+    for place in ['meters_place', 'minutes_place', 'split_place']:
+        board = [row for row in rows if row[place] <= LEADER_BOARD_TOP + 1 or row['username'] == username]
+        boards.append(sorted(board, key=lambda row: row[place]))
+    return tuple(boards)
+
+
+def generate_leader_board(username, teams=None, window=None):
     """
 
     :param username:
+    :param teams: optional; a list of team codes, e.g. ['vm'], to rank only those squads
+    :param window: optional; a key of LEADER_BOARD_WINDOWS, otherwise the week since last sunday
     :return:
     """
 
-    last_sunday = get_last_sunday(datetime.datetime.utcnow())
+    teams = sorted(set(teams)) if teams else None
 
-    agg_meters = db.get_leader_board_meters(last_sunday)
-    meters = format_leader_arr(agg_meters, 'total_meters', username)
+    # the database ranks and trims the boards, so the rows sent stay the same as the roster grows
+    if window is None:
+        cutoff = get_last_sunday(datetime.datetime.utcnow())
+        scope = tuple(teams or ())
+        fetch = lambda viewer, k: db.get_leader_board_top(cutoff, viewer, k, teams=teams, use_rollup=True)
+    else:
+        start, end = leader_board_window(window, db.get_activity_today())
+        # no workout before midnight UTC of the first day is inside the window
+        cutoff = datetime.datetime.combine(start, datetime.time.min)
+        scope = (tuple(teams or ()), end)
+        fetch = lambda viewer, k: db.get_leader_board_window(start, end, viewer, k, teams=teams)
+
+    # the top places are the same for every viewer; a viewer placed below them is ranked on their own
+    rows = LEADER_BOARD_CACHE.get(cutoff, lambda: fetch(None, LEADER_BOARD_TOP + 1), scope)
+    if not any(row['username'] == username for row in rows):
+        rows = rows + fetch(username, 0)
+    ranked_meters, ranked_minutes, ranked_split = rank_leader_boards(rows, username)
+
+    meters = format_leader_arr(ranked_meters, 'total_meters', username)
+    minutes = format_leader_arr(ranked_minutes, 'total_seconds', username)
+    split = format_leader_arr(ranked_split, 'split', username)
 
-    agg_minutes = db.get_leader_board_minutes(last_sunday)
-    minutes = format_leader_arr(agg_minutes, 'total_seconds', username)
+    return meters, minutes, split
 
-    agg_split = db.get_leader_board_split(last_sunday)
-    split = format_leader_arr(agg_split, 'split', username)
 
-    return meters, minutes, split
+def current_week_start(now):
+    """
+    :param now: a utc datetime
+    :return: the date of the monday the leader board week containing now started on
+    """
+    return (get_last_sunday(now) + datetime.timedelta(seconds=1)).date()
+
+
+def generate_archived_leader_board(username, week_start=None):
+    """
+    the frozen boards of a finished week
+    :param username: the viewer
+    :param week_start: optional; the monday of the week, defaults to the last finished week
+    :return: a dictionary with the week, the archived weeks before and after it, and the three boards, or None if
+    no week is archived
+    """
+    if week_start is None:
+        week_start = db.get_leader_board_archive_weeks(current_week_start(datetime.datetime.utcnow()))['previous']
+        if week_start is None:
+            return None
+
+    # the neighbouring weeks and the boards are independent reads
+    if async_db is not None:
+        weeks, rows = async_db.gather(async_db.get_leader_board_archive_weeks(week_start),
+                                      async_db.get_leader_board_archive(week_start, username, LEADER_BOARD_TOP + 1))
+    else:
+        weeks = db.get_leader_board_archive_weeks(week_start)
+        rows = db.get_leader_board_archive(week_start, username, LEADER_BOARD_TOP + 1)
+    ranked_meters, ranked_minutes, ranked_split = rank_leader_boards(rows, username)
+
+    return {
+        'week': week_start.isoformat(),
+        'previous': weeks['previous'].isoformat() if weeks['previous'] else None,
+        'next': weeks['next'].isoformat() if weeks['next'] else None,
+        'meters': format_leader_arr(ranked_meters, 'total_meters', username),
+        'minutes': format_leader_arr(ranked_minutes, 'total_seconds', username),
+        'split': format_leader_arr(ranked_split, 'split', username)
+    }
 
 
 def send_email(email_address, html, subject):
@@ -5,6 +5,7 @@ import datetime
 from urllib.parse import urlparse, urljoin, parse_qs
 
 import boto3
+import click
 from flask import Flask, render_template, request, redirect, url_for, Response, json, abort, flash
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from passlib.hash import pbkdf2_sha256
@@ -13,9 +14,10 @@ from twilio.rest import Client
 import Forms.web_forms as web_forms
 from itsdangerous import URLSafeTimedSerializer
 
+from User.roles import Role
 from User.user import User
 from Utils import util_basic, hashes
-from Utils.config import db
+from Utils.config import LEADER_BOARD_CACHE, db
 from Utils.driver_generation import generate_cars, modified_k_means
 from Utils.log import log
 from Utils.util_basic import bucket_name, verify_user_address
@@ -245,12 +247,15 @@ def profile():
         for attribute in profile_attrs:
             profile_cols.append((form.data[attribute]))
 
-        if len(profile_update_values) > 0:
-            db.update('users', profile_update_col_names, profile_update_values, ['user_id'], [current_user.user_id])
+        with db.transaction():
+            if len(profile_update_values) > 0:
+                db.update('users', profile_update_col_names, profile_update_values, ['user_id'],
+                          [current_user.user_id])
 
-        db.update('profile', profile_attrs, profile_cols, ['user_id'], [current_user.user_id])
+            db.update('profile', profile_attrs, profile_cols, ['user_id'], [current_user.user_id])
 
-    # gather user profile
+    # gather user profile; read after the update above, and alone: get_user already ran in load_user before this
+    # view, so there is no independent read to fan out with through async_db
     user_profile = db.select('profile', ['ALL'], ['user_id'], [current_user.get_id()])
 
     if current_user.num_seats > 0:
@@ -311,9 +316,38 @@ def workouts():
 @application.route('/team')
 @login_required
 def team():
-    meters_ranking, most_minutes, best_split = util_basic.generate_leader_board(current_user.username)
+    # /team?team=vm ranks one squad, repeat it for several, e.g. ?team=vm&team=nm
+    squads = dict(web_forms.ProfileForm.teams[1:])
+    teams = request.args.getlist('team')
+    # /team?window=30d ranks a rolling window instead of the week since sunday
+    window = request.args.get('window')
+    if any(code not in squads for code in teams) or (window is not None and
+                                                    window not in util_basic.LEADER_BOARD_WINDOWS):
+        abort(400)
+    meters_ranking, most_minutes, best_split = util_basic.generate_leader_board(current_user.username, teams,
+                                                                               window)
     return render_template('team.html', meters_ranking=meters_ranking, most_minutes=most_minutes,
-                           best_split=best_split)
+                           best_split=best_split, squad=' & '.join(squads[code] for code in teams),
+                           window=util_basic.LEADER_BOARD_WINDOWS.get(window))
+
+
+@application.route('/team/history', methods=['GET'])
+@login_required
+def team_history():
+    # /team/history?week=2024-03-04 for the week containing that day, the last finished week without it
+    week_start = None
+    if 'week' in request.args:
+        try:
+            day = datetime.datetime.strptime(request.args['week'], '%Y-%m-%d').date()
+        except ValueError:
+            return Response(json.dumps({'error': 'week must be YYYY-MM-DD'}), status=400,
+                            mimetype='application/json')
+        week_start = day - datetime.timedelta(days=day.weekday())
+
+    history = util_basic.generate_archived_leader_board(current_user.username, week_start)
+    if history is None:
+        return Response(json.dumps({'error': 'no finished weeks yet'}), status=404, mimetype='application/json')
+    return Response(json.dumps(history), status=200, mimetype='application/json')
 
 
 @application.route('/profile/settings', methods=['GET', 'POST'])
@@ -424,14 +458,21 @@ def get_a_workout():
 @application.route('/get_all_workouts', methods=['GET'])
 @login_required
 def get_all_workouts():
-    workouts = db.get_aggregate_workouts_by_id(current_user.user_id)
-    return Response(json.dumps(workouts), status=200, mimetype='application/json')
+    try:
+        limit, before = util_basic.parse_page_args(request.args)
+    except ValueError:
+        return Response(json.dumps({'error': 'invalid page'}), status=400, mimetype='application/json')
+
+    workouts, cursor = db.get_aggregate_workouts_page(current_user.user_id, limit, before)
+    js = json.dumps({'workouts': workouts, 'next': util_basic.format_page_cursor(cursor)})
+    return Response(js, status=200, mimetype='application/json')
 
 
 @application.route('/edit_workout', methods=['POST'])
 @login_required
 def edit_workout():
     util_basic.edit_erg_workout(request, db)
+    db.mark_write(current_user.user_id)
     return Response(json.dumps({}), status=201, mimetype='application/json')
 
 
@@ -442,9 +483,9 @@ def generate_graph_data():
         workout_name = request.form.get('share')
 
         if workout_name:
-            results = db.get_aggregate_workouts_by_name(current_user.user_id, workout_name)
+            results = db.get_aggregate_workouts_by_name(current_user.user_id, workout_name, row_format='numpy')
 
-            if results and len(results) > 0:
+            if results and len(results['workout_id']) > 0:
                 js = build_graph_data(results, workout_name)
 
                 return Response(js, status=200, mimetype='application/json')
@@ -465,24 +506,36 @@ def get_workout_names():
 def delete_workout():
     workout_id = request.form.get('workout_id')
     db.delete_entry('workout', 'workout_id', workout_id)
+    db.mark_write(current_user.user_id)
+    LEADER_BOARD_CACHE.invalidate()
     return Response(json.dumps({}), 201, mimetype='application/json')
 
 
 @application.route('/get_all_athletes', methods=['GET'])
 @login_required
 def get_all_athletes():
-    users = db.select('users', ['ALL'], fetchone=False)
-    js = json.dumps(users)
-    return Response(js, status=200, mimetype='application/json')
+    users = db.select('users', ['ALL'], stream=True)
+    return Response(util_basic.stream_json_array(users), status=200, mimetype='application/json')
 
 
 @application.route('/generate_individual_heatmap', methods=['GET'])
 @login_required
 def generate_individual_heatmap():
-    heatmap = db.get_heat_map_calendar_results(current_user.user_id)
+    # a year ending today, the team's local day daily_activity files workouts under, unless the calendar asks for
+    # another range
+    try:
+        end = datetime.datetime.strptime(request.args['end'], '%Y-%m-%d').date() if 'end' in request.args \
+            else db.get_activity_today()
+        start = datetime.datetime.strptime(request.args['start'], '%Y-%m-%d').date() if 'start' in request.args \
+            else end - datetime.timedelta(days=365)
+    except ValueError:
+        return Response(json.dumps({'error': 'dates must be YYYY-MM-DD'}), status=400, mimetype='application/json')
+
+    heatmap = db.get_heat_map_calendar_results(current_user.user_id, start, end)
+    for day in heatmap:
+        # no time zone, so the browser reads it as local midnight of that day
+        day['date'] = day['date'].strftime('%Y-%m-%dT00:00:00')
     js = json.dumps(heatmap)
-    print(heatmap)
-    print(js)
     return Response(js, status=200, mimetype='application/json')
 
 
@@ -494,6 +547,46 @@ def get_past_three_workouts():
     return Response(js, status=200, mimetype='application/json')
 
 
+@application.route('/admin/metrics', methods=['GET'])
+@login_required
+def metrics():
+    if current_user.role != Role.ADMIN:
+        abort(403)
+    return Response(json.dumps(dict(db.stats(), leader_board_cache=LEADER_BOARD_CACHE.stats())), status=200,
+                    mimetype='application/json')
+
+
+@application.cli.command('archive-weeks')
+def archive_weeks_command():
+    """
+    archives the standings of the weeks that finished since the last run; pages only read the archive, so
+    schedule it weekly just after the week ends on sunday night, e.g. from cron at 00:05 UTC every monday:
+    5 0 * * 1  FLASK_APP=main.py flask archive-weeks
+    """
+    archived = db.archive_leader_board_weeks()
+    log.info('Archived {} leader board rows'.format(archived))
+    click.echo('archived {} rows'.format(archived))
+
+
+@application.route('/admin/archive_weeks', methods=['POST'])
+@login_required
+def archive_weeks():
+    # a manual run of the archive-weeks job
+    if current_user.role != Role.ADMIN:
+        abort(403)
+    archived = db.archive_leader_board_weeks()
+    return Response(json.dumps({'archived': archived}), status=200, mimetype='application/json')
+
+
+@application.route('/admin/slow_queries', methods=['GET'])
+@login_required
+def slow_queries():
+    if current_user.role != Role.ADMIN:
+        abort(403)
+    entries = db.slow_query_log.entries() if db.slow_query_log is not None else []
+    return Response(json.dumps(entries), status=200, mimetype='application/json')
+
+
 @application.route('/roster', methods=['GET', 'POST'])
 @login_required
 def roster():
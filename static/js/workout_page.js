@@ -291,36 +291,56 @@ function format_date_and_time(time_stamp){
 
 function update_workout_table(){
   var table = document.getElementById('myTable');
-  var columns = document.getElementById('new_stuff');
   if (table){
-    $.get('/get_all_workouts',
-      function(data, status){
-        $("#myTable > tbody").empty();
+    $("#myTable > tbody").empty();
+    $("#load_more_workouts").remove();
+    load_workout_page(null);
+  }
+  return 0;
+}
 
-        for (var i = 0; i < data.length; i++) {
+function load_workout_page(before){
+  // the server sends one page of workouts at a time plus the cursor of the next page
+  var params = {};
+  if (before){
+    params['before'] = before;
+  }
+  $.get('/get_all_workouts', params,
+    function(page, status){
+      var data = page['workouts'];
+      var offset = $("#myTable > tbody > tr").length;
 
-          var newRow = $("<tr>");
-          var cols = "";
+      for (var i = 0; i < data.length; i++) {
 
-          curr_date = format_date_and_time(data[i]['time'])['date'];
+        var newRow = $("<tr>");
+        var cols = "";
 
-          cols += '<td>' + curr_date + '</td>';
-          cols += '<td>' + data[i]['name'] + '</td>';
-          if (data[i]['avg_sec'] < 10){
-            cols += '<td>' + data[i]['avg_min'] + ':0' + data[i]['avg_sec'] + '</td>';
-          }
-          else{
-            cols += '<td>' + data[i]['avg_min'] + ':' + data[i]['avg_sec'] + '</td>';
-          }
-          cols += '<td><button type=\"button\" onclick=\"modal_edit(\'' + data[i]['workout_id'] + '\', \'get_a_workout\')\" class=\"btn btn-outline-warning btn-sm\">Edit</button></td>';
-          cols += '<td><button type=\"button\" class=\"btn btn-sm btn-outline-danger\" onclick=\"delete_workout(\'' + data[i]['workout_id'] + '\',\'' + i + '\')\">Delete</button></td>';
+        curr_date = format_date_and_time(data[i]['time'])['date'];
 
-          newRow.append(cols);
-          $("#myTable > tbody").append(newRow);
+        cols += '<td>' + curr_date + '</td>';
+        cols += '<td>' + data[i]['name'] + '</td>';
+        if (data[i]['avg_sec'] < 10){
+          cols += '<td>' + data[i]['avg_min'] + ':0' + data[i]['avg_sec'] + '</td>';
         }
-      });
-  }
-  return 0;
+        else{
+          cols += '<td>' + data[i]['avg_min'] + ':' + data[i]['avg_sec'] + '</td>';
+        }
+        cols += '<td><button type=\"button\" onclick=\"modal_edit(\'' + data[i]['workout_id'] + '\', \'get_a_workout\')\" class=\"btn btn-outline-warning btn-sm\">Edit</button></td>';
+        cols += '<td><button type=\"button\" class=\"btn btn-sm btn-outline-danger\" onclick=\"delete_workout(\'' + data[i]['workout_id'] + '\',\'' + (offset + i) + '\')\">Delete</button></td>';
+
+        newRow.append(cols);
+        $("#myTable > tbody").append(newRow);
+      }
+
+      $("#load_more_workouts").remove();
+      if (page['next']){
+        var button = $('<button type="button" id="load_more_workouts" class="btn btn-sm btn-outline-primary">Load more</button>');
+        button.click(function(){
+          load_workout_page(page['next']);
+        });
+        $("#myTable").after(button);
+      }
+    });
 }
 
 function delete_workout(workout_id, idx){